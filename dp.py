@@ -1,7 +1,13 @@
 import pandas as pd
 import numpy as np
 import random
-from hydrology import run_hydro, run_hydro_hru, find_cfc, find_cn, find_cns, find_rzdf
+import os
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+from hydrology import run_hydro, run_hydro_hru, run_hydro_ens, get_hru_basis, find_exeed_flow, find_cn, find_cns, \
+    find_rzdf, route_nash, get_hydro_state
 from tools import stringsf
 
 
@@ -21,21 +27,24 @@ def find_pv(p0, p1, p2):
     """
     def_r = p2 / 100
     def_pv = p0 / ((1 + def_r)**p1)
-    return round(def_pv, 2)
+    return np.round(def_pv, 2)
 
 
 def find_xc(p0, p1, p2, p3, p4, p5, p6):
     """
 
-    :param p0: LOCAL LULC tuple (w, u, f, p, c, nbsf, nbsp, nbsc)
+    :param p0: LOCAL LULC tuple (w, u, f, p, c, nbsf, nbsp, nbsc) or 2d array of candidates LULC (n, 8)
     :param p1: watershed area in km2
     :param p2: cycle in years
     :param p3: operation data tuple
-    :param p4: expansion set (nbsf, nbsp, nbsc)
+    :param p4: expansion set (nbsf, nbsp, nbsc) or 2d array of candidates expansion sets (n, 3)
     :param p5: available area in km2
     :param p6: installation data tuple
-    :return:
+    :return: expansion cost (array of expansion costs (n,) for 2d inputs)
     """
+    # candidates matrix goes to the array kernel:
+    if np.ndim(p0) == 2:
+        return find_xc_batch(np.asarray(p0, dtype=float), p1, p2, p3, np.asarray(p4, dtype=float), p5, p6)
     # get data
     avail_area_ha = p5 * 100
     watershed_area_ha = p1 * 100
@@ -81,14 +90,45 @@ def find_xc(p0, p1, p2, p3, p4, p5, p6):
     return xc
 
 
-def find_q(area, p, pet, lulc, soils, param):
+def find_xc_batch(p0, p1, p2, p3, p4, p5, p6):
+    """
+    batch version of find_xc
+    :param p0: 2d array of LOCAL LULC (n, 8)
+    :param p1: watershed area in km2
+    :param p2: cycle in years
+    :param p3: operation data tuple
+    :param p4: 2d array of expansion sets (n, 3)
+    :param p5: available area in km2
+    :param p6: installation data tuple
+    :return: array of expansion costs (n,)
+    """
+    avail_area_ha = p5 * 100
+    watershed_area_ha = p1 * 100
+    # operation cost model xc_oprt = A * Area + B
+    xc_oprt_nbsf = (p3[0] * (watershed_area_ha * p0[:, 5] / 100)) + p3[1]
+    xc_oprt_nbsp = (p3[2] * (watershed_area_ha * p0[:, 6] / 100)) + p3[3]
+    xc_oprt_nbsc = (p3[4] * (watershed_area_ha * p0[:, 7] / 100)) + p3[5]
+    xc_oprt = p2 * (xc_oprt_nbsf + xc_oprt_nbsp + xc_oprt_nbsc) * 0.1
+    #
+    # installation cost model xc_inst = A * Area + B
+    xc_inst_nbsf = (p6[0] * (avail_area_ha * p4[:, 0] / 100)) + p6[1]
+    xc_inst_nbsp = (p6[2] * (avail_area_ha * p4[:, 1] / 100)) + p6[3]
+    xc_inst_nbsc = (p6[4] * (avail_area_ha * p4[:, 2] / 100)) + p6[5]
+    xc_inst = xc_inst_nbsf + xc_inst_nbsp + xc_inst_nbsc
+    #
+    xc = np.round(xc_oprt + xc_inst, 2)
+    return xc
+
+
+def find_q(area, p, pet, lulc, soils, param, basis=None):
     """
 
     :param p: p tuple
     :param pet: pet tuple
     :param lulc: %lulc tuple (u, w, f, p, c, nbsf, nbsp, nbsc)
     :param soils: (a, b, c, d) x (u, w, f, p, c, nbsf, nbsp, nbsc)
-    :param param: (iaf, swmax, gwmax, knash, nnash)
+    :param param: (iaf, swmax, gwmax, knash, nnash, routing engine)
+    :param basis: stage HRU response basis dict (see get_stage_basis)
     :return:
     """
     # run hydrology model and get stream flow
@@ -100,15 +140,217 @@ def find_q(area, p, pet, lulc, soils, param):
     # print('Rzdf: {}'.format(rzdf))
     #
     #q = run_hydro(area, p, pet, cn, rzdf, param[0], param[1], param[2], param[3], param[4])
-    q = run_hydro_hru(area, p, pet, lulc, cns, param[0], param[1], param[2], param[3], param[4], export='')
+    q = run_hydro_hru(area, p, pet, lulc, cns, param[0], param[1], param[2], param[3], param[4], export='',
+                      basis=basis, routing=param[5])
     #
     # find q90:
-    cfc = find_cfc(q['Q'])
-    q90 = cfc[1][10]
+    q90 = find_exeed_flow(q['Q'], 90)
     return (q['Q'], q['CN'][0], q['Rzd'][0], q90, q['Qb'])
 
 
+def get_stage_basis(p, pet, soils, param):
+    """
+    get the HRU response basis of a DP stage, so every decision set of the
+    stage is evaluated as a weighted combination of the HRU simulations
+    :param p: stage p array
+    :param pet: stage pet array
+    :param soils: (a, b, c, d) x (u, w, f, p, c, nbsf, nbsp, nbsc)
+    :param param: (iaf, swmax, gwmax, knash, nnash, routing engine)
+    :return: dict of HRU response basis
+    """
+    # the CN of each HRU does not depend on the LULC fractions:
+    cns = find_cns((1, 1, 1, 1, 1, 1, 1, 1), soils)
+    basis = get_hru_basis(p, pet, cns, param[0], param[1], param[2])
+    return basis
+
+
+def get_warm_basis(p, pet, stg, soils, param):
+    """
+    get the warm start HRU response basis of all DP stages. The land phase of a HRU does not depend
+    on the LULC fractions, so it is simulated once and continuously over the whole horizon, and each
+    stage carries on the stocks at the end of its predecessor (no spin-up by stage)
+    :param p: p array of the horizon
+    :param pet: pet array of the horizon
+    :param stg: tuple of stages
+    :param soils: (a, b, c, d) x (u, w, f, p, c, nbsf, nbsp, nbsc)
+    :param param: (iaf, swmax, gwmax, knash, nnash, routing engine, warm start)
+    :return: tuple of stage HRU response basis dicts (index 0 is the stage 0 and is None)
+    """
+    cns = find_cns((1, 1, 1, 1, 1, 1, 1, 1), soils)
+    land = get_hru_basis(p, pet, cns, param[0], param[1], param[2], state=get_hydro_state(len(cns), param[4]))
+    # slice the HRU arrays (HRU, days) by stage:
+    roff = slice_ts(land['Roff'].T, stg)
+    gw = slice_ts(land['Gw'].T, stg)
+    bases = [None]
+    for t in range(1, len(stg)):
+        bases.append({'Roff': np.ascontiguousarray(roff[t].T), 'Gw': np.ascontiguousarray(gw[t].T)})
+    return tuple(bases)
+
+
+def find_stage_basis(dpp, t):
+    """
+    get the HRU response basis of a DP stage: the warm start basis slice or a stage cold start basis
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param t: stage index
+    :return: dict of HRU response basis
+    """
+    if dpp['Hy_param'][6]:
+        return dpp['Hy_warm'][t]
+    return get_stage_basis(dpp['P_stg'][t], dpp['PET_stg'][t], dpp['Soils'], dpp['Hy_param'])
+
+
+def get_q_cache(size=2048, keep=False):
+    """
+    get a new memo cache for the stage hydrology (see find_q_batch)
+    :param size: max number of stored hydrology results (least recently used are dropped). None is unbounded
+    :param keep: boolean to also keep every new hydrology result in the Keep dict, regardless of the
+    cache size (used to build the hydrology store, see save_hydro_store)
+    :return: cache dict
+    """
+    cache = {'Size': size, 'Memo': OrderedDict(), 'Hits': 0, 'Misses': 0, 'Keep': None}
+    if keep:
+        cache['Keep'] = dict()
+    return cache
+
+
+def get_q_cache_report(cache):
+    """
+    get the memo cache statistics report string
+    :param cache: cache dict (see get_q_cache)
+    :return: string
+    """
+    total = cache['Hits'] + cache['Misses']
+    rate = 0.0
+    if total > 0:
+        rate = 100 * cache['Hits'] / total
+    def_str = '\nHydrology cache: {} hits, {} misses ({:.1f}% hit rate, ' \
+              'cache size: {})'.format(cache['Hits'], cache['Misses'], rate, cache['Size'])
+    return def_str
+
+
+def find_q_batch(area, p, pet, lulcs, soils, param, basis=None, cache=None, t=0, last_lulcs=None, last_basis=None):
+    """
+    batch version of find_q. The hydrology of all new LULCs is run at once as an ensemble (see run_hydro_ens)
+    :param lulcs: 2d array of %lulc (n, 8)
+    :param basis: stage HRU response basis dict (see get_stage_basis)
+    :param cache: hydrology memo cache dict (see get_q_cache)
+    :param t: stage index (cache key)
+    :param last_lulcs: 2d array of the predecessor %lulc (n, 8), for the warm start (param[6])
+    :param last_basis: predecessor stage warm basis (see get_warm_basis), None in the first stage
+    :return: dict of arrays: Q and Qb (n, days), CN, Rzd and q90 (n,)
+    """
+    warm = len(param) > 6 and param[6]
+    q_tpls = [None] * len(lulcs)
+    # find the LULCs to simulate (cache misses, once each):
+    new_ids = dict()
+    for i in range(0, len(lulcs)):
+        lulc = tuple(lulcs[i].tolist())
+        key = (t, lulc, param)
+        if warm:
+            # the stage routing carries on the predecessor storages:
+            key = (t, lulc, tuple(last_lulcs[i].tolist()), param)
+        if cache is not None and key in cache['Memo']:
+            cache['Hits'] = cache['Hits'] + 1
+            cache['Memo'].move_to_end(key)
+            q_tpls[i] = cache['Memo'][key]
+        elif key in new_ids:
+            if cache is not None:
+                cache['Hits'] = cache['Hits'] + 1
+            new_ids[key].append(i)
+        else:
+            if cache is not None:
+                cache['Misses'] = cache['Misses'] + 1
+            new_ids[key] = [i]
+    #
+    if len(new_ids) > 0:
+        keys = list(new_ids.keys())
+        new_lulcs = [key[1] for key in keys]
+        cns = [find_cns(lulc, soils) for lulc in new_lulcs]
+        state = None
+        if warm:
+            state = {'Vnash': np.zeros((len(keys), param[4]))}
+            if last_basis is not None:
+                # Nash cascade storages at the end of the predecessor stage (its memory is of a few days,
+                # so the predecessor is routed from empty storages):
+                last = np.array([key[2] for key in keys])
+                areasf = last / np.sum(last, axis=1)[:, np.newaxis]
+                vroff = np.dot(areasf, last_basis['Roff']) * area * 1000
+                state['Vnash'] = route_nash(vroff, param[3], param[4], engine=param[5], state=state['Vnash'])[1]
+        ens = run_hydro_ens(area, p, pet, new_lulcs, cns, param[0], param[1], param[2], param[3], param[4],
+                            basis=basis, routing=param[5], state=state)
+        # find q90 of all members:
+        q90 = find_exeed_flow(ens['Q'], 90)
+        for j in range(0, len(keys)):
+            q_tpl = (ens['Q'][j].copy(), float(ens['CN'][j]), float(ens['Rzd'][j]), q90[j], ens['Qb'][j].copy())
+            for i in new_ids[keys[j]]:
+                q_tpls[i] = q_tpl
+            if cache is not None and cache['Keep'] is not None:
+                cache['Keep'][keys[j]] = q_tpl
+            if cache is not None and (cache['Size'] is None or cache['Size'] > 0):
+                cache['Memo'][keys[j]] = q_tpl
+                if cache['Size'] is not None and len(cache['Memo']) > cache['Size']:
+                    cache['Memo'].popitem(last=False)
+    out = {'Q': np.array([q_tpl[0] for q_tpl in q_tpls]), 'Qb': np.array([q_tpl[4] for q_tpl in q_tpls]),
+           'CN': np.array([q_tpl[1] for q_tpl in q_tpls]), 'Rzd': np.array([q_tpl[2] for q_tpl in q_tpls]),
+           'q90': np.array([q_tpl[3] for q_tpl in q_tpls])}
+    return out
+
+
+def find_sc_exp_price(w, k=1, e=-0.17):
+    """
+    water price of the exponential (constant elasticity) demand model W = K * P^e
+    :param w: array of water volumes in m3/d
+    :param k: demand model K
+    :param e: price elasticity of demand
+    :return: array of prices in $/m3
+    """
+    with np.errstate(divide='ignore'):
+        p = np.power(w / k, 1 / e)
+    return p
+
+
+def find_sc_exp(q, wp, pp, k=1, e=-0.17):
+    """
+    scarcity cost time series of the exponential demand model: the area under the demand curve
+    P = (W / K)^(1/e) from the available water Q to the projected consumption Wp, minus the tariff.
+    The power law integral is taken analytically, for any array shape (1d series or 2d batch of series)
+    :param q: array of available water in m3/d
+    :param wp: projected water consumption in m3/d
+    :param pp: projected tariff in $/m3
+    :param k: demand model K
+    :param e: price elasticity of demand
+    :return: array of scarcity costs in $ (0 where there is no scarcity)
+    """
+    scarce = q < wp
+    # no scarcity days get a null interval:
+    w1 = np.where(scarce, q, wp)
+    c = 1 + 1 / e
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if c == 0:
+            area = k * np.log(wp / w1)
+        else:
+            area = k * (np.power(wp / k, c) - np.power(w1 / k, c)) / c
+    sc_cost_ts = np.where(scarce, area - ((wp - w1) * pp), 0.0)
+    return sc_cost_ts
+
+
 def find_sc(q, wp, pp, a, b, k=1, e=-0.17, type='lin', full=False):
+    """
+    scarcity cost model
+    :param q: streamflow in m3/s - 1d series (days,) or 2d array of candidates series (n, days)
+    :param wp: projected water consumption in m3/d
+    :param pp: projected tariff in $/m3
+    :param a: linear demand model A
+    :param b: linear demand model B
+    :param k: exponential demand model K
+    :param e: price elasticity of demand
+    :param type: demand model: 'lin' or 'exp'
+    :param full: boolean to return the time series
+    :return: dict of SC and Risk (arrays of (n,) for 2d inputs)
+    """
+    # candidates matrix goes to the array kernel:
+    if np.ndim(q) == 2 and not full:
+        return find_sc_batch(q, wp, pp, a, b, k=k, e=e, type=type)
     #
     # convert streamflow from m3/s to m3/d
     q = q * 86400
@@ -125,32 +367,18 @@ def find_sc(q, wp, pp, a, b, k=1, e=-0.17, type='lin', full=False):
         # For linear model: SC=(P - Pp)*(Q - Wp)/2  is just a rectangular triangle
         sc_cost_ts = diff_p * w_sc / 2
     elif type == 'exp':
-        # print('develop code')
-        sc_cost_ts = list()
-        for i in range(0, len(q)):
-            # p = (w / K) ** (1 / e)
-            # numerical integration procedure
-            if q[i] < wp:
-                print('Scarcity condition Q: {}\tWp: {}'.format(q[i], wp))
-                w1 = q[i]
-                w2 = wp
-                n_delta = 1000
-                delta = (w2 - w1) / n_delta
-                w_array = np.linspace(w1, w2, n_delta)
-                p_array = np.power(w_array / k, 1 / e)
-                sc_cost_lcl = np.sum(p_array * delta) - ((w2 - w1) * pp)
-                sc_cost_ts.append(sc_cost_lcl)
-            else:
-                sc_cost_ts.append(0)
-        sc_cost_ts = np.array(sc_cost_ts)
+        # water price time series under scarcity (demand model W = K * P^e at the available water):
+        p = np.where(w_sc > 0, find_sc_exp_price(q, k, e), 0.0)
+        diff_p = (p - pp) * (w_sc > 0)
+        sc_cost_ts = find_sc_exp(q, wp, pp, k, e)
     #
     # total scarcity cost:
-    sc_cost = np.sum(sc_cost_ts)
+    sc_cost = np.sum(sc_cost_ts, axis=-1)
     # sc_cost = 0.0
     #
     # finally, get some stats:
-    sc_n = np.sum((wp - q) > 0)
-    total_n = len(q)
+    sc_n = np.sum((wp - q) > 0, axis=-1)
+    total_n = np.shape(q)[-1]
     sc_risk = 100 * sc_n / total_n
     #
     # output full dict:
@@ -173,7 +401,47 @@ def find_sc(q, wp, pp, a, b, k=1, e=-0.17, type='lin', full=False):
     return out
 
 
+def find_sc_batch(q, wp, pp, a, b, k=1, e=-0.17, type='lin'):
+    """
+    batch version of find_sc
+    :param q: 2d array of streamflow in m3/s (n, days)
+    :return: dict of arrays: SC and Risk (n,)
+    """
+    if type == 'lin':
+        # convert streamflow from m3/s to m3/d
+        q = q * 86400
+        # water scarcity, water price and price difference arrays:
+        w_sc = (wp - q) * ((wp - q) > 0)
+        p = ((w_sc - b) / a) * (w_sc > 0)
+        diff_p = (p - pp) * (w_sc > 0)
+        sc_cost = np.sum(diff_p * w_sc / 2, axis=-1)
+        sc_n = np.sum((wp - q) > 0, axis=-1)
+        sc_risk = 100 * sc_n / q.shape[-1]
+    else:
+        # exponential demand model, with the analytic integral for the whole batch:
+        q = q * 86400
+        sc_cost = np.sum(find_sc_exp(q, wp, pp, k, e), axis=-1)
+        sc_n = np.sum((wp - q) > 0, axis=-1)
+        sc_risk = 100 * sc_n / q.shape[-1]
+    out = {'SC': sc_cost, 'Risk': sc_risk}
+    return out
+
+
 def find_tc(q, qb, wp, lulc, a, b):
+    """
+    treatment cost model
+    :param q: streamflow in m3/s - 1d series (days,) or 2d array of candidates series (n, days)
+    :param qb: baseflow in m3/s - same shape of q
+    :param wp: projected water consumption in m3/d
+    :param lulc: %lulc tuple (8,) or 2d array of candidates %lulc (n, 8)
+    :param a: treatment cost model A
+    :param b: treatment cost model B
+    :return: treatment cost (array of treatment costs (n,) for 2d inputs)
+    """
+    # candidates matrix goes to the array kernel:
+    if np.ndim(q) == 2:
+        lulc = np.broadcast_to(np.atleast_2d(np.asarray(lulc, dtype=float)), (np.shape(q)[0], 8))
+        return find_tc_batch(q, qb, wp, lulc, a, b)
     # get scf from lulc:
     scfa = lulc[2] + lulc[5] + lulc[6] + lulc[7]
     scf = 100 * scfa / sum(lulc)
@@ -201,6 +469,33 @@ def find_tc(q, qb, wp, lulc, a, b):
     return tc
 
 
+def find_tc_batch(q, qb, wp, lulc, a, b):
+    """
+    batch version of find_tc
+    :param q: 2d array of streamflow in m3/s (n, days)
+    :param qb: 2d array of baseflow in m3/s (n, days)
+    :param lulc: 2d array of %lulc (n, 8)
+    :return: array of treatment costs (n,)
+    """
+    # get scf from lulc (summed in the same order as find_tc):
+    scfa = lulc[:, 2] + lulc[:, 5] + lulc[:, 6] + lulc[:, 7]
+    lulc_sum = 0
+    for j in range(0, lulc.shape[1]):
+        lulc_sum = lulc_sum + lulc[:, j]
+    scf = 100 * scfa / lulc_sum
+    #
+    # one value by candidate (pow keeps it bitwise equal to find_tc):
+    tcu = np.array([a / pow(lcl_scf, b) for lcl_scf in scf.tolist()])
+    tcu_qb = a / pow(100, b)
+    qbf = qb / q
+    #
+    q = q * 86400  # convert m3/s to m3/d
+    tw = q * (q < wp) + wp * (q >= wp)  # treatment water array
+    tc_array = tw * ((qbf * tcu_qb) + ((1 - qbf) * tcu[:, np.newaxis]))
+    tc = np.sum(tc_array, axis=-1)
+    return tc
+
+
 def find_lulc(p0, p1, p2, p3=1):
     """
 
@@ -269,6 +564,42 @@ def find_lulc(p0, p1, p2, p3=1):
         return def_output
 
 
+def find_lulc_batch(p0, p1, p2, p3=1):
+    """
+    batch version of find_lulc
+    :param p0: 2d array of last lulc (n, 8)
+    :param p1: 2d array of decision sets (n, 3)
+    :param p2: available area, in % of total area
+    :return: 2d array of lulc (n, 8)
+    """
+    # get local available area:
+    lcl_avail_area = p0[:, 3] + p0[:, 4]
+    expand_bool = lcl_avail_area > 0
+    #
+    # find % of NBS in lulc
+    new_x_nbsf = p1[:, 0] * p2 / 100
+    new_x_nbsp = p1[:, 1] * p2 / 100
+    new_x_nbsc = p1[:, 2] * p2 / 100
+    # find total % of converted area
+    conv_area = new_x_nbsp + new_x_nbsf + new_x_nbsc
+    # proportional expansion partition (see find_lulc):
+    lcl_avail_area = np.where(expand_bool, lcl_avail_area, 1)
+    ratio_p = p0[:, 3] / lcl_avail_area
+    ratio_c = p0[:, 4] / lcl_avail_area
+    new_lulc = np.column_stack((p0[:, 0],
+                                p0[:, 1],
+                                p0[:, 2],
+                                p0[:, 3] - (conv_area * ratio_p),
+                                p0[:, 4] - (conv_area * ratio_c),
+                                new_x_nbsf + p0[:, 5],
+                                new_x_nbsp + p0[:, 6],
+                                new_x_nbsc + p0[:, 7]))
+    new_lulc = np.round(new_lulc, p3)
+    # where it can`t expand the LULC doesnt change:
+    def_output = np.where(expand_bool[:, np.newaxis], new_lulc, p0)
+    return def_output
+
+
 def get_lulc(p0, p1=1):
     lst = list()
     s = sum(p0)
@@ -278,15 +609,22 @@ def get_lulc(p0, p1=1):
     return tuple(lst)
 
 
-def get_dp_status(p0, p1, p2=3.3):
+def get_dp_status(p0, p1, p2=None):
+    """
+    get the DP status string
+    :param p0: batch (number of evaluated candidates)
+    :param p1: DP size
+    :param p2: elapsed time in seconds (omitted if None)
+    :return: string
+    """
     def_flt = 100 * p0 / p1
     aux_len = len(str(p1))
     if aux_len <= 3:
-        def_str = 'DP Status: {:>7.2f}%    Batch: {:>4} of {:<4}    ' \
-                  'Enlapsed time: {:8>.1f} secs'.format(def_flt, p0, p1, p2)
+        def_str = 'DP Status: {:>7.2f}%    Batch: {:>4} of {:<4}'.format(def_flt, p0, p1)
     else:
-        def_str = 'DP Status: {:>7.3f}%    Batch: {:>8} of {:<8}    ' \
-                  'Enlapsed time: {:8>.1f} secs'.format(def_flt, p0, p1, p2)
+        def_str = 'DP Status: {:>7.3f}%    Batch: {:>8} of {:<8}'.format(def_flt, p0, p1)
+    if p2 is not None:
+        def_str = def_str + '    Enlapsed time: {:8>.1f} secs'.format(p2)
     return def_str
 
 
@@ -337,6 +675,23 @@ def size_dp(p0, p1, p2):
     return size
 
 
+def size_dp_grid(p0, p1):
+    """
+    size a full DP grid without building its decision sets (same as size_dp)
+    :param p0: number of states
+    :param p1: number of stages (stage 0 included)
+    :return: number of dp simulation batches
+    """
+    # number of possible xds of the state j is (j + 1)(j + 2)/2
+    npx = [(j + 1) * (j + 2) // 2 for j in range(0, p0)]
+    size = sum(npx)  # first stage comes from state 0 only
+    aux_int = 0
+    for j in range(0, p0):
+        aux_int = aux_int + sum(npx[:j + 1])
+    size = size + (p1 - 2) * aux_int
+    return size
+
+
 def get_xds(p0, p1):
     """
 
@@ -423,678 +778,478 @@ def set_dp(p0, p1, p2, p3):
     return def_output
 
 
-def run_sim(setts, data, pol, sim=False, prt_sts=False):
+def get_dp_param(setts, data):
     """
-    run DP for NBS expansion optimization
+    get the DP parameters from settings and data
     :param setts: tuple with dp parameters (settings)
     :param data: dp data
-    :param prt_sts: boolean to control status screen printouts
-    :return:
+    :return: dict of DP parameters
     """
-    import time
-    sim_policy = pol
-    drifter = 1
-    if sim:
-        drifter = 1000 * 1000 * 1000
-    baseline_bool = False
-    simpol_bool = False
-    # get current time:
-    dp_t0 = time.time()
-    # get run timestamp
-    run_ts = stringsf.nowsep()
-    #
-    # get parameters:
     stg = setts[0]  # get stages tuple
-    stt = setts[1]  # get states tuple
-    y = setts[2]  # get Y from settings
-    size = setts[3]  # get size of dp
-    all_xds = setts[4]  # get all decisions sets
-    cycle = stg[1] - stg[0]  # get cycle in years
     #
     # get data:
     lulc0A = data['Lulc0']  # in km2
-    area = sum(lulc0A)  # in km2
-    availarea = lulc0A[3] + lulc0A[4]  # in km2
     lulc0 = get_lulc(lulc0A)  # in %
-    availareaf = lulc0[3] + lulc0[4]  # in %
-    soils = data['Soils']
-    dp_rr = data['RR']  # in %
-    # get time series:
-    p_ts = data['P']
-    pet_ts = data['PET']
-    #
-    # get Scarcity model parameters:
-    sc_a_p = data['SC_param'][0] # array by stg
-    sc_b_p = data['SC_param'][1]
-    sc_k_p = data['SC_param'][2]
-    sc_e_p = data['SC_param'][3]
-    trf = data['Tariff']
-    wconsr = data['Wconsr']
-    #
-    # slice time series to suit dp stages
-    p_stg = slice_ts(p_ts, stg)
-    pet_stg = slice_ts(pet_ts, stg)
     #
     # hydrology hard parameters
     hydro_p = data['Hydro_p']
-    hy_iaf = hydro_p['iaf']
-    hy_swmax = hydro_p['swmax']
-    hy_gwmax = hydro_p['gwmax']
-    hy_knash = hydro_p['knash']
-    hy_nnash = int(hydro_p['nnash'])
-    hy_param = (hy_iaf, hy_swmax, hy_gwmax, hy_knash, hy_nnash)
-    cn0 = hydro_p['CN']
-    rzdf0 = hydro_p['Rzdf']
-    q90_0 = hydro_p['q90']
-    #
-    # treatment cost model parameters
-    tc_p = data['TC_p']
-    tc_p_a = tc_p['A']
-    tc_p_b = tc_p['B']
-    #
-    # operation cost parameters
-    oprt_p_nbsf = data['Oprt_p'][0]
-    oprt_p_nbsp = data['Oprt_p'][1]
-    oprt_p_nbsc = data['Oprt_p'][2]
-    oprt_nbsf_a = oprt_p_nbsf['A']
-    oprt_nbsf_b = oprt_p_nbsf['B']
-    oprt_nbsp_a = oprt_p_nbsp['A']
-    oprt_nbsp_b = oprt_p_nbsp['B']
-    oprt_nbsc_a = oprt_p_nbsc['A']
-    oprt_nbsc_b = oprt_p_nbsc['B']
-    oprt_data = (oprt_nbsf_a, oprt_nbsf_b, oprt_nbsp_a, oprt_nbsp_b, oprt_nbsc_a, oprt_nbsc_b)
-    #
-    # installation cost parameters
-    inst_p_nbsf = data['Inst_p'][0]
-    inst_p_nbsp = data['Inst_p'][1]
-    inst_p_nbsc = data['Inst_p'][2]
-    inst_nbsf_a = inst_p_nbsf['A']
-    inst_nbsf_b = inst_p_nbsf['B']
-    inst_nbsp_a = inst_p_nbsp['A']
-    inst_nbsp_b = inst_p_nbsp['B']
-    inst_nbsc_a = inst_p_nbsc['A']
-    inst_nbsc_b = inst_p_nbsc['B']
-    inst_data = (inst_nbsf_a, inst_nbsf_b, inst_nbsp_a, inst_nbsp_b, inst_nbsc_a, inst_nbsc_b)
-    #
-    # set counter:
-    dp_counter = 0
-    #
-    # create lists to store repost sections:
-    header_lst = ['\n\n****** PLANS - DYNAMIC PROGRAMMING PROCEDURE ******\n\n']
+    # the routing engine (see hydrology.route_nash) and the warm start between stages are optional:
+    hy_param = (hydro_p['iaf'], hydro_p['swmax'], hydro_p['gwmax'], hydro_p['knash'], int(hydro_p['nnash']),
+                hydro_p.get('routing', 'filter'), bool(hydro_p.get('warm', False)))
+    #
+    # operation and installation cost parameters
+    oprt_data = list()
+    inst_data = list()
+    for i in range(0, 3):
+        oprt_data.append(data['Oprt_p'][i]['A'])
+        oprt_data.append(data['Oprt_p'][i]['B'])
+        inst_data.append(data['Inst_p'][i]['A'])
+        inst_data.append(data['Inst_p'][i]['B'])
+    #
+    dpp = {'Stg': stg,
+           'Stt': setts[1],
+           'Y': setts[2],
+           'Size': setts[3],
+           'All_xds': setts[4],
+           'Cycle': stg[1] - stg[0],  # cycle in years
+           'Lulc0A': lulc0A,
+           'Area': sum(lulc0A),  # in km2
+           'Availarea': lulc0A[3] + lulc0A[4],  # in km2
+           'Lulc0': lulc0,
+           'Availareaf': lulc0[3] + lulc0[4],  # in %
+           'Soils': data['Soils'],
+           'RR': data['RR'],  # in %
+           'P_stg': slice_ts(data['P'], stg),  # time series sliced to suit dp stages
+           'PET_stg': slice_ts(data['PET'], stg),
+           'SC_param': data['SC_param'],  # arrays by stg (A, B, K, e)
+           'SC_type': data.get('SC_type', 'lin'),  # scarcity cost demand model: 'lin' or 'exp' (see find_sc)
+           'Tariff': data['Tariff'],
+           'Wconsr': data['Wconsr'],
+           'Hydro_p': hydro_p,
+           'Hy_param': hy_param,
+           'TC_p': (data['TC_p']['A'], data['TC_p']['B']),
+           'Oprt': tuple(oprt_data),
+           'Inst': tuple(inst_data)}
+    if hy_param[6]:
+        dpp['Hy_warm'] = get_warm_basis(data['P'], data['PET'], stg, data['Soils'], hy_param)
+    return dpp
+
+
+def get_dp_header(run_ts, dpp):
+    """
+    get the DP models parameters report section
+    :param run_ts: run timestamp string
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :return: list of report strings
+    """
+    hy_param = dpp['Hy_param']
+    inst_data = dpp['Inst']
     param_lst = ['\n\n\nDP MODELS PARAMETERS\n\n']
-    output_lst = ['\n\n\nDP OUTPUT\n\n']
-    policy_lst = ['\n\n\nDP GLOBAL POLICY OUTLOOK\n\n']
-    log_lst = ['\n\n\nDP LOG Report\n\n']
-    #
-    # report header prints:
-    while True:  # loop here is just to better organize
-        aux_str1 = 'Timestamp:' + run_ts
-        aux_str2 = '\n\nStages: ' + str(stg) + '\nStates: ' + str(stt) + \
-                   '\nReturn rate (%): ' + str(dp_rr) +  \
-                   '\n\nDP size: ' + str(size) + ' batches\n'
-        aux_str3 = '\nWatershed area in km2: {}\nLULC in Stage 0:'.format(area)
-        aux_tpl = ('urban', 'water', 'forest', 'pasture', 'crops', 'nbs_forest', 'nbs_pasture', 'nbs_crops')
-        df = pd.DataFrame({'Area in km2': lulc0A}, index=aux_tpl)
-        aux_str4 = df.to_string()
-        aux_str5 = 'Available area (pasture + crops): ' + str(availarea) + ' km2\n'
-        df = pd.DataFrame({'% of Watershed Area': lulc0}, index=aux_tpl)
-        aux_str4a = df.to_string()
-        aux_str5b = 'Available area (pasture + crops): ' + str(availareaf) + '%\n'
-        aux_str6 = '\n\nHydrology hard parameters:' \
-                   '\nIaf: {}\nSwmax: {}\nGWmax: {}\nK-Nash: {}' \
-                   '\nN-Nash: {}\n'.format(hy_iaf, hy_swmax, hy_gwmax, hy_knash, hy_nnash)
-        aux_str7 = '\nTreatment cost model parameters:' \
-                   '\nTC model parameter A: {}\nTC model parameter B: {}\n'.format(tc_p_a, tc_p_b)
-        aux_str8 = '\nInstallation cost model parameters:\n' \
-                   'NBS forest:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS pasture:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS crops:\n\tParameter A: {}\n\tParameter B: {}\n'.format(inst_nbsf_a, inst_nbsf_b, inst_nbsp_a,
-                                                                               inst_nbsp_b, inst_nbsc_a, inst_nbsc_b)
-        aux_str9 = '\nOperation cost model parameters:\n' \
-                   'NBS forest:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS pasture:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS crops:\n\tParameter A: {}\n\tParameter B: {}\n'.format(inst_nbsf_a, inst_nbsf_b, inst_nbsp_a,
-                                                                               inst_nbsp_b, inst_nbsc_a, inst_nbsc_b)
-        param_lst.append(aux_str1)
-        param_lst.append(aux_str2)
-        param_lst.append(aux_str3)
-        param_lst.append(aux_str4)
-        param_lst.append(aux_str5)
-        param_lst.append(aux_str4a)
-        param_lst.append(aux_str5b)
-        param_lst.append(aux_str6)
-        param_lst.append(aux_str7)
-        param_lst.append(aux_str8)
-        param_lst.append(aux_str9)
-        break
-    #
-    #
-    # create baseline scenario (do-nothing) setup:
-    c0 = [(0, 0, 0, (0, 0, 0), (0, 0, 0), (q90_0, cn0, rzdf0), 0)]
-    #
-    #
-    # create empty list of policies:
-    glb_policy = list()
-    for t in range(0, len(stg)):
-        glb_policy.append([(0, 0, 0, 0, (0, 0, 0), lulc0, 0, (0, (0, 0, 0)), (0, (0, 0, 0)), q90_0, cn0, rzdf0, 0)])
-    #
-    #
-    cn_lst = list()
-    rzdf_lst = list()
-    q90_lst = list()
-    #
-    # get DP procedure starting time
-    dp_t1 = time.time()
-    #
-    #
-    # forward movement loop (simulation happens here):
-    for t in range(1, len(stg)):
-        # printing section
-        log_str = '\n\n\nStage #' + str(t) + ' (' + str(stg[t]) + ')'
-        log_lst.append(log_str)
-        # get last stage list of best policies
-        last_stg_policy = glb_policy[t - 1]
-        # populate list of local best policies
-        stg_best_policy = list()
-        # Not recursive section. One-to-go stage, stg =1:
-        if t == 1:
-            # loop in all states
-            for s in range(0, len(stt)):
-                # last lulc:
-                last_lulc = lulc0
-                # populate all possible decisions
-                x = stt[s]  # is just one here
-                xds = all_xds[s]  # get decision sets - index s is the same as the state index
-                # printing section:
-                log_str = '\n\nStage #' + str(t) + '\tState #' + str(s) + ':\t S= ' \
-                           + str(stt[s]) + '\t\tXps= ' + str(x)
-                log_lst.append(log_str)
-                # load lists:
-                fps = list()  # possible fs
-                xps = list()  # possible xs
-                xdps = list()  # possible xdps
-                lulcps = list()  # possible lulcs
-                last_sttps = list()  # possible last states
-                cfvs = list()  # possible local costs in fv
-                cpvs = list()  # possible local costs in pv
-                q90s = list()
-                cns = list()
-                rzdfs = list()
-                risks = list()
-                # loop in all decision sets:
-                for e in xds:
-                    # not recursive section
-                    # checkers:
-                    if s == 0 and sum(e) == 0:
-                        baseline_bool = True
-                    else:
-                        baseline_bool = False
-                    #
-                    if e == sim_policy[t]:
-                        simpol_bool = True
-                        print('{} = {}'.format(e, sim_policy[t]))
-                    else:
-                        simpol_bool = False
-                    # find lulc
-                    lulc_lcl = find_lulc(last_lulc, e, availareaf)
-                    #
-                    # find q:
-                    q_tpl = find_q(area, p_stg[t], pet_stg[t], lulc_lcl, soils, hy_param)
-                    # get values:
-                    q_lcl = q_tpl[0]  # array
-                    cn_lcl = q_tpl[1]
-                    rzdf_lcl = q_tpl[2]
-                    q90_lcl = q_tpl[3]
-                    qb_lcl = q_tpl[4]
-                    #
-                    # find costs:
-                    # here the simulations batch happens:
-                    c_lcl_xcfv = find_xc(lulc_lcl, area, cycle, oprt_data, e, availarea, inst_data)  # expansion cost
-                    #
-                    # scarcity cost batch
-                    c_lcl_scfv_dct = find_sc(q_lcl, wconsr[t - 1], trf[t - 1], sc_a_p[t -1], sc_b_p[t -1],
-                                             sc_k_p[t -1], sc_e_p[t -1])
-                    c_lcl_scfv = c_lcl_scfv_dct['SC']  # scarcity cost
-                    sc_risk_lcl = c_lcl_scfv_dct['Risk']  # scarcity risk
-                    #
-                    # treatment cost batch:
-                    c_lcl_tcfv = find_tc(q_lcl, qb_lcl, wconsr[t - 1], lulc_lcl, tc_p_a, tc_p_b)  # treatment cost
-                    #
-                    # local costs in fv (scarcity, treatment, expansion):
-                    c_lcl_fv = (round(c_lcl_scfv + c_lcl_tcfv + c_lcl_xcfv, 2), (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv))
-                    #
-                    c_lcl_xcpv = find_pv(c_lcl_xcfv, stg[t] - stg[0], dp_rr)  # get present value
-                    c_lcl_scpv = find_pv(c_lcl_scfv, stg[t] - stg[0], dp_rr)  # get present value
-                    c_lcl_tcpv = find_pv(c_lcl_tcfv, stg[t] - stg[0], dp_rr)  # get present value
-                    #
-                    # total cost:
-                    c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2)
-                    #
-                    # local costs in pv (scarcity, treatment, expansion):
-                    c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                    #
-                    f_lcl = c_lcl  # no recursion
-                    #
-                    # baseline checker:
-                    if baseline_bool:
-                        c0.append((f_lcl, c_lcl_fv[0], c_lcl_pv[0],
-                                   (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv), (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv),
-                                   (q90_lcl, cn_lcl, rzdf_lcl), sc_risk_lcl))
-                    # policy simulation checker:
-                    if simpol_bool:
-                        # total cost:
-                        c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2)
-                        #
-                        # local costs in pv (scarcity, treatment, expansion):
-                        c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                        #
-                        f_lcl = c_lcl  # no recursion
-                    else:
-                        # total cost:
-                        c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2) * drifter
-                        #
-                        # local costs in pv (scarcity, treatment, expansion):
-                        c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                        #
-                        f_lcl = c_lcl  # no recursion
-                    #
-                    # get last state
-                    last_stt = stt[s] - x
-                    #
-                    # append to lists:
-                    fps.append(f_lcl)
-                    xps.append(x)
-                    xdps.append(e[:])
-                    lulcps.append(lulc_lcl[:])
-                    last_sttps.append(last_sttps)
-                    cfvs.append(c_lcl_fv[:])
-                    cpvs.append(c_lcl_pv[:])
-                    q90s.append(q90_lcl)
-                    cns.append(cn_lcl)
-                    rzdfs.append(rzdf_lcl)
-                    risks.append(sc_risk_lcl)
-                    #
-                    #
-                    # append to outer lists:
-                    cn_lst.append(cn_lcl)
-                    rzdf_lst.append(rzdf_lcl)
-                    q90_lst.append(q90_lcl)
-                    #
-                    #
-                    # update counter:
-                    dp_counter = dp_counter + 1
-                    # printing section:
-                    aux_flt = time.time() - dp_t1
-                    log_str = get_dp_status(dp_counter, size, aux_flt)
-                    log_lst.append(log_str)
-                    if prt_sts:
-                        print(log_str)
-                #
-                # get the best f from list:
-                best_f = min(fps)
-                # get best f index:
-                f_id = fps.index(best_f)
-                #
-                # retrieve best variables using f_id:
-                best_x = xps[f_id]  # best x
-                best_xd = xdps[f_id]  # best xd decision set
-                best_lcl_lulc = lulcps[f_id]  # best lulc
-                best_cfv = cfvs[f_id]
-                best_cpv = cpvs[f_id]
-                best_q90 = q90s[f_id]
-                best_cn = cns[f_id]
-                best_rzdf = rzdfs[f_id]
-                best_risk = risks[f_id]
-                #
-                # append policy list:
-                lcl_best_policy = (t, stt[s], best_f, best_x, best_xd, best_lcl_lulc, last_stt, best_cfv, best_cpv,
-                                   best_q90, best_cn, best_rzdf, best_risk)
-                stg_best_policy.append(lcl_best_policy)  # local best stage policy: f, state, decision
-                #
-                # printing section:
-                df = pd.DataFrame({'Decision X':xps, 'Decision set Xd':xdps, 'f value':fps, 'LULC':lulcps})
-                log_str = df.to_string()
-                log_lst.append('')
-                log_lst.append(log_str)
-                log_lst.append('')
-                aux_tpl = ('State S(t)', 'Best f value', 'Best Decision X', 'Best Decision Set Xd', 'Best LULC',
-                           'Coming from S(t-1)', 'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-                df = pd.DataFrame({'Best Policy': lcl_best_policy[1:]}, index=aux_tpl)
-                log_str = df.to_string()
-                log_lst.append(log_str)
-                #
-                # clear loop lists:
-                fps.clear()
-                xps.clear()
-                xdps.clear()
-                lulcps.clear()
-                last_sttps.clear()
-                cfvs.clear()
-                cpvs.clear()
-                q90s.clear()
-                cns.clear()
-                rzdfs.clear()
-                risks.clear()
-        # Recursive section. stg > 1:
-        else:
-            # loop all states
-            for s in range(0, len(stt)):
-                # populate all possible decisions
-                xs = stt[:s + 1]
-                # printing section:
-                log_str = '\n\nStage #' + str(t) + '\tState #' + str(s) + ':\t S= ' \
-                          + str(stt[s]) + '\t\tXps= ' + str(xs)
-                log_lst.append(log_str)
-                # loop in all possible decisions:
-                fps = list()  # possible fs
-                xps = list()  # possible xs
-                xdps = list()  # possible xdps
-                lulcps = list()  # possible lulcs
-                last_sttps = list()  # possible last states
-                cfvs = list()  # possible local costs in fv
-                cpvs = list()  # possible local costs in pv
-                lps = list()  # last local policies (for printing only)
-                q90s = list()
-                cns = list()
-                rzdfs = list()
-                risks = list()
-                for xp in range(0, len(xs)):
-                    # get local last policy
-                    last_stt = stt[s] - xs[xp]  # last state given current state and decision
-                    last_stt_id = stt.index(last_stt)
-                    last_lcl_policy = last_stg_policy[last_stt_id]  # retrieve last policy from stage policies list
-                    # last lulc:
-                    last_lulc = last_lcl_policy[5]  # retrieve from last lcl policy
-                    # populate all possible decision sets:
-                    xds = all_xds[xp]
-                    # loop in all decision sets:
-                    for e in xds:
-                        # recursive section
-                        # checkers:
-                        if s == 0 and sum(e) == 0:
-                            baseline_bool = True
-                        else:
-                            baseline_bool = False
-                        #
-                        if e == sim_policy[t]:
-                            simpol_bool = True
-                            print('{} = {}'.format(e, sim_policy[t]))
-                        else:
-                            simpol_bool = False
-                        # find lulc:
-                        lulc_lcl = find_lulc(last_lulc, e, availareaf)
-                        #
-                        # find q:
-                        q_tpl = find_q(area, p_stg[t], pet_stg[t], lulc_lcl, soils, hy_param)
-                        # get values:
-                        q_lcl = q_tpl[0]  # array
-                        cn_lcl = q_tpl[1]
-                        rzdf_lcl = q_tpl[2]
-                        q90_lcl = q_tpl[3]
-                        qb_lcl = q_tpl[4]
-                        #
-                        # find costs:
-                        # here the simulations batch happens:
-                        c_lcl_xcfv = find_xc(lulc_lcl, area, cycle, oprt_data, e, availarea, inst_data)  # expansion cost
-                        #
-                        # scarcity cost batch
-                        c_lcl_scfv_dct = find_sc(q_lcl, wconsr[t - 1], trf[t - 1], sc_a_p[t - 1], sc_b_p[t - 1],
-                                                 sc_k_p[t -1], sc_e_p[t -1])
-                        c_lcl_scfv = c_lcl_scfv_dct['SC']  # scarcity cost
-                        sc_risk_lcl = c_lcl_scfv_dct['Risk']  # scarcity risk
-                        #
-                        # treatment cost batch:
-                        c_lcl_tcfv = find_tc(q_lcl, qb_lcl, wconsr[t - 1], lulc_lcl, tc_p_a, tc_p_b)  # treatment cost
-                        #
-                        # local costs in fv (scarcity, treatment, expansion):
-                        c_lcl_fv = (round(c_lcl_scfv + c_lcl_tcfv + c_lcl_xcfv, 2), (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv))
-                        c_lcl_xcpv = find_pv(c_lcl_xcfv, stg[t] - stg[0], dp_rr)  # get present value
-                        c_lcl_scpv = find_pv(c_lcl_scfv, stg[t] - stg[0], dp_rr)  # get present value
-                        c_lcl_tcpv = find_pv(c_lcl_tcfv, stg[t] - stg[0], dp_rr)  # get present value
-                        #
-                        #
-                        # total cost:
-                        c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2)
-                        # local costs in pv (scarcity, treatment, expansion):
-                        c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                        # recursion happens here:
-                        f_lcl = round(c_lcl + last_lcl_policy[2], 2)  # index 2 is the f value index
-                        #
-                        # baseline checker:
-                        if baseline_bool:
-                            c0.append((f_lcl, c_lcl_fv[0], c_lcl_pv[0],
-                                       (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv), (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv),
-                                       (q90_lcl, cn_lcl, rzdf_lcl), sc_risk_lcl))
-                        # policy simulation checker:
-                        if simpol_bool:
-                            # total cost:
-                            c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2)
-                            # local costs in pv (scarcity, treatment, expansion):
-                            c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                            # recursion happens here:
-                            f_lcl = round(c_lcl + last_lcl_policy[2], 2)  # index 2 is the f value index
-                        else:
-                            # total cost:
-                            c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2) * drifter
-                            # local costs in pv (scarcity, treatment, expansion):
-                            c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                            # recursion happens here:
-                            f_lcl = round(c_lcl + last_lcl_policy[2], 2)  # index 2 is the f value index
-                        # append to DP lists:
-                        fps.append(f_lcl)
-                        xps.append(xs[xp])
-                        xdps.append(e[:])
-                        lulcps.append(lulc_lcl[:])
-                        last_sttps.append(last_stt)
-                        cfvs.append(c_lcl_fv[:])
-                        cpvs.append(c_lcl_pv[:])
-                        lps.append(last_lcl_policy[:])
-                        q90s.append(q90_lcl)
-                        cns.append(cn_lcl)
-                        rzdfs.append(rzdf_lcl)
-                        risks.append(sc_risk_lcl)
-                        #
-                        #
-                        # append to outer lists:
-                        cn_lst.append(cn_lcl)
-                        rzdf_lst.append(rzdf_lcl)
-                        q90_lst.append(q90_lcl)
-                        #
-                        # update counter:
-                        dp_counter = dp_counter + 1
-                        # printing section:
-                        aux_flt = time.time() - dp_t1
-                        log_str = get_dp_status(dp_counter, size, aux_flt)
-                        log_lst.append(log_str)
-                        if prt_sts:
-                            print(log_str)
-                # get the best f from list:
-                best_f = min(fps)
-                # get best f index:
-                f_id = fps.index(best_f)
-                #
-                # retrieve best variables using f_id:
-                best_x = xps[f_id]  # best x
-                best_xd = xdps[f_id]  # best xd decision set
-                best_lcl_lulc = lulcps[f_id]  # best lulc
-                best_cfv = cfvs[f_id]
-                best_cpv = cpvs[f_id]
-                best_q90 = q90s[f_id]
-                best_cn = cns[f_id]
-                best_rzdf = rzdfs[f_id]
-                best_risk = risks[f_id]
-                #
-                # get last best state
-                last_stt = stt[s] - best_x
-                #
-                # local best stage policy: f, state, decision
-                lcl_best_policy = (t, stt[s], best_f, best_x, best_xd, best_lcl_lulc, last_stt, best_cfv, best_cpv,
-                                   best_q90, best_cn, best_rzdf, best_risk)
-                stg_best_policy.append(lcl_best_policy)
-                #
-                # printing section:
-                df = pd.DataFrame({'Decision X': xps, 'Decision set Xd': xdps, 'f value': fps, 'LULC': lulcps})
-                log_str = df.to_string()
-                log_lst.append('')
-                log_lst.append(log_str)
-                log_lst.append('')
-                aux_tpl = ('State S(t)', 'Best f value', 'Best Decision X', 'Best Decision Set Xd', 'Best LULC',
-                           'Coming from S(t-1)', 'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-                df = pd.DataFrame({'Best Policy': lcl_best_policy[1:]}, index=aux_tpl)
-                log_str = df.to_string()
-                log_lst.append(log_str)
-                #
-                # clear loop lists:
-                fps.clear()
-                xps.clear()
-                xdps.clear()
-                lulcps.clear()
-                last_sttps.clear()
-                cfvs.clear()
-                cpvs.clear()
-                q90s.clear()
-                cns.clear()
-                rzdfs.clear()
-                risks.clear()
-                lps.clear()
-        # append
-        glb_policy[t] = tuple(stg_best_policy[:])
-        # clear
-        stg_best_policy.clear()
-    #
-    #
-    # policies printing section:
-    for t in range(0, len(glb_policy)):
-        log_str = '\nStage #' + str(t) + ' (' + str(stg[t]) + '):'
-        aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
-                   'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-        df = pd.DataFrame(glb_policy[t], columns=aux_tpl)
-        policy_lst.append(log_str)
-        policy_lst.append(df.to_string())
-    #
-    #
-    # Retrieve from global policies the best path:
-    log_str = '\n\n****** DP Backward Look ******\n'
-    policy_lst.append(log_str)
-    #
-    # output lists:
-    f_out = list()
-    stt_out = list()
-    x_out = list()
-    xd_out = list()
-    lulc_out = list()
-    cfv_out = list()
-    cpv_out = list()
-    q90_out = list()
-    cn_out = list()
-    rzdf_out = list()
-    risk_out = list()
-    #
-    #
-    # backward loop:
-    for t in range(len(stg) - 1, -1, -1):
-        # printing section:
-        log_str = '\nStage #' + str(t) + '\t(' + str(stg[t]) + ')'
-        policy_lst.append(log_str)
-        # get data from stage policy
-        aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
-                   'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-        df = pd.DataFrame(glb_policy[t], columns=aux_tpl)
-        df_t = df.T
-        # get ss, xs, and fs , etc values:
-        stg_ss = tuple(df_t.values[1])
-        stg_fs = tuple(df_t.values[2])
-        stg_xs = tuple(df_t.values[3])
-        stg_xds = tuple(df_t.values[4])
-        stg_lulcs = tuple(df_t.values[5])
-        stg_cfvs = tuple(df_t.values[7])
-        stg_cpvs = tuple(df_t.values[8])
-        stg_q90s = tuple(df_t.values[9])
-        stg_cns = tuple(df_t.values[10])
-        stg_rzdfs = tuple(df_t.values[11])
-        stg_risks = tuple(df_t.values[12])
-        # start in the last stage:
-        if t == len(stg) - 1:
-            # use best f to find the starting place
-            # find best f:
-            best_f = min(stg_fs)
-            #
-            # find best f id:
-            best_f_id = stg_fs.index(best_f)
-            #
-            # find corresponding S and X:
-            best_stt = stg_ss[best_f_id]
-            best_x = stg_xs[best_f_id]
-            best_xd = stg_xds[best_f_id]
-            best_lulc = stg_lulcs[best_f_id]
-            best_cfv = stg_cfvs[best_f_id]
-            best_cpv = stg_cpvs[best_f_id]
-            best_q90 = stg_q90s[best_f_id]
-            best_cn = stg_cns[best_f_id]
-            best_rzdf = stg_rzdfs[best_f_id]
-            best_risk = stg_risks[best_f_id]
-            #
-            # printing section,
-            log_str = 'Best f=' + str(best_f) + '\tf id=' + str(best_f_id) + '\tS=' + str(best_stt) + \
-                      '\tX=' + str(best_x) + '\tXd=' + str(best_xd) + '\tLULC=' + str(best_lulc) +\
-                      '\tC* FV=' + str(best_cfv) + '\tC* PV=' + str(best_cpv) + '\tq90* =' + str(best_q90) + \
-                      '\tCN*=' + str(best_cn) + '\tRzdf*=' + str(best_rzdf) + '\tRisk*=' + str(best_risk)
-            policy_lst.append(log_str)
-        else:
-            # use state to find path
-            best_stt = best_last_stt
-            best_stt_id = stg_ss.index(best_stt)
-            best_f = stg_fs[best_stt_id]
-            best_x = stg_xs[best_stt_id]
-            best_xd = stg_xds[best_stt_id]
-            best_lulc = stg_lulcs[best_stt_id]
-            best_cfv = stg_cfvs[best_stt_id]
-            best_cpv = stg_cpvs[best_stt_id]
-            best_q90 = stg_q90s[best_stt_id]
-            best_cn = stg_cns[best_stt_id]
-            best_rzdf = stg_rzdfs[best_stt_id]
-            best_risk = stg_risks[best_stt_id]
-            #
-            # printing section
-            log_str = 'S=' + str(best_stt) + '\tS id=' + str(best_stt_id) + \
-                      '\tf=' + str(best_f) + '\tX=' + str(best_x) + '\tXd=' + str(best_xd) + \
-                      '\tLULC=' + str(best_lulc) + '\tC* FV=' + str(best_cfv) + '\tC* PV=' + str(best_cpv) + \
-                      '\tq90* =' + str(best_q90) + '\tCN*=' + str(best_cn) + \
-                      '\tRzdf*=' + str(best_rzdf) + '\tRisk*=' + str(best_risk)
-            policy_lst.append(log_str)
-        # store f and S in output lists
-        f_out.insert(0, best_f)
-        stt_out.insert(0, best_stt)
-        x_out.insert(0, best_x)
-        xd_out.insert(0, best_xd)
-        lulc_out.insert(0, best_lulc)
-        cfv_out.insert(0, best_cfv)
-        cpv_out.insert(0, best_cpv)
-        q90_out.insert(0, best_q90)
-        cn_out.insert(0, best_cn)
-        rzdf_out.insert(0, best_rzdf)
-        risk_out.insert(0, best_risk)
-        # find last S(t-1)
-        best_last_stt = best_stt - best_x
-    #
-    #
-    #
-    # output settings
+    aux_str1 = 'Timestamp:' + run_ts
+    aux_str2 = '\n\nStages: ' + str(dpp['Stg']) + '\nStates: ' + str(dpp['Stt']) + \
+               '\nReturn rate (%): ' + str(dpp['RR']) +  \
+               '\n\nDP size: ' + str(dpp['Size']) + ' batches\n'
+    aux_str3 = '\nWatershed area in km2: {}\nLULC in Stage 0:'.format(dpp['Area'])
+    aux_tpl = ('urban', 'water', 'forest', 'pasture', 'crops', 'nbs_forest', 'nbs_pasture', 'nbs_crops')
+    df = pd.DataFrame({'Area in km2': dpp['Lulc0A']}, index=aux_tpl)
+    aux_str4 = df.to_string()
+    aux_str5 = 'Available area (pasture + crops): ' + str(dpp['Availarea']) + ' km2\n'
+    df = pd.DataFrame({'% of Watershed Area': dpp['Lulc0']}, index=aux_tpl)
+    aux_str4a = df.to_string()
+    aux_str5b = 'Available area (pasture + crops): ' + str(dpp['Availareaf']) + '%\n'
+    aux_str6 = '\n\nHydrology hard parameters:' \
+               '\nIaf: {}\nSwmax: {}\nGWmax: {}\nK-Nash: {}' \
+               '\nN-Nash: {}\nRouting: {}\nWarm start: {}\n'.format(hy_param[0], hy_param[1], hy_param[2],
+                                                                    hy_param[3], hy_param[4], hy_param[5],
+                                                                    hy_param[6])
+    aux_str6b = '\nScarcity cost demand model: {}\n'.format(dpp['SC_type'])
+    aux_str7 = '\nTreatment cost model parameters:' \
+               '\nTC model parameter A: {}\nTC model parameter B: {}\n'.format(dpp['TC_p'][0], dpp['TC_p'][1])
+    aux_str8 = '\nInstallation cost model parameters:\n' \
+               'NBS forest:\n\tParameter A: {}\n\tParameter B: {}\n' \
+               'NBS pasture:\n\tParameter A: {}\n\tParameter B: {}\n' \
+               'NBS crops:\n\tParameter A: {}\n\tParameter B: {}\n'.format(*inst_data)
+    aux_str9 = '\nOperation cost model parameters:\n' \
+               'NBS forest:\n\tParameter A: {}\n\tParameter B: {}\n' \
+               'NBS pasture:\n\tParameter A: {}\n\tParameter B: {}\n' \
+               'NBS crops:\n\tParameter A: {}\n\tParameter B: {}\n'.format(*inst_data)
+    param_lst.append(aux_str1)
+    param_lst.append(aux_str2)
+    param_lst.append(aux_str3)
+    param_lst.append(aux_str4)
+    param_lst.append(aux_str5)
+    param_lst.append(aux_str4a)
+    param_lst.append(aux_str5b)
+    param_lst.append(aux_str6)
+    param_lst.append(aux_str6b)
+    param_lst.append(aux_str7)
+    param_lst.append(aux_str8)
+    param_lst.append(aux_str9)
+    return param_lst
+
+
+def get_policy_table(nstg, nstt, dec_type=int):
+    """
+    get an empty DP policy table: a structured array of the best policy by (stage, state).
+    Field Last_id is the predecessor state index, so a path is traced by pointers
+    :param nstg: number of stages
+    :param nstt: number of states
+    :param dec_type: type of states and decisions (float for the approximate DP, see run_adp)
+    :return: numpy structured array (nstg, nstt)
+    """
+    dtype = [('Set', bool),  # state is reachable in the stage
+             ('S', dec_type),
+             ('f', float),
+             ('X', dec_type),
+             ('Xd', dec_type, (3,)),
+             ('LULC', float, (8,)),
+             ('Last_S', dec_type),
+             ('Last_id', int),
+             ('CFV', float, (4,)),  # (total, sc, tc, xc)
+             ('CPV', float, (4,)),  # (total, sc, tc, xc)
+             ('q90', float),
+             ('CN', float),
+             ('Rzdf', float),
+             ('Risk', float)]
+    return np.zeros((nstg, nstt), dtype=dtype)
+
+
+def get_policy_tuple(tbl, t, s):
+    """
+    get the policy tuple of a (stage, state) of the policy table
+    :param tbl: policy table (see get_policy_table)
+    :param t: stage index
+    :param s: state index
+    :return: policy tuple (t, S, f, X, Xd, LULC, last S, costs in FV, costs in PV, q90, CN, Rzdf, Risk)
+    """
+    row = tbl[t, s]
+    cfv = row['CFV'].tolist()
+    cpv = row['CPV'].tolist()
+    lcl_policy = (t, row['S'].item(), float(row['f']), row['X'].item(), tuple(row['Xd'].tolist()),
+                  tuple(row['LULC'].tolist()), row['Last_S'].item(), (cfv[0], tuple(cfv[1:])), (cpv[0], tuple(cpv[1:])),
+                  float(row['q90']), float(row['CN']), float(row['Rzdf']), float(row['Risk']))
+    return lcl_policy
+
+
+def get_stage_candidates(stt, all_xds, last_tbl, s_mask=None):
+    """
+    get all (last state, decision set) candidates of a DP stage, in the DP loop order
+    :param stt: tuple of states
+    :param all_xds: tuple with all possible Xds by X
+    :param last_tbl: last stage row of the policy table (see get_policy_table)
+    :param s_mask: boolean array of the allowed states (all states if None)
+    :return: dict of candidate arrays
+    """
+    s_ids = list()
+    xs = list()
+    xds = list()
+    last_ids = list()
+    for s in range(0, len(stt)):
+        if s_mask is not None and not s_mask[s]:
+            continue
+        for xp in range(0, s + 1):
+            last_id = s - xp  # states are evenly spaced, so S(t-1) = S(t) - X is the state s - xp
+            if not last_tbl['Set'][last_id]:
+                continue
+            for e in all_xds[xp]:
+                s_ids.append(s)
+                xs.append(stt[xp])
+                xds.append(e)
+                last_ids.append(last_id)
+    last_ids = np.array(last_ids, dtype=int)
+    cand = {'S_id': np.array(s_ids, dtype=int),
+            'X': np.array(xs, dtype=int),
+            'Xd': np.array(xds, dtype=int).reshape(-1, 3),
+            'Last_id': last_ids,
+            'Last_S': last_tbl['S'][last_ids],
+            'Last_LULC': last_tbl['LULC'][last_ids],
+            'Last_f': last_tbl['f'][last_ids]}
+    return cand
+
+
+def eval_stage(t, cand, dpp, basis=None, drift=None, chunk=1024, cache=None):
+    """
+    evaluate all candidates of a DP stage with array operations
+    :param t: stage index
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param basis: stage HRU response basis dict (see get_stage_basis)
+    :param drift: array of cost multipliers by candidate (policy simulation)
+    :param chunk: max number of candidates holding streamflow arrays at once
+    :param cache: hydrology memo cache dict (see get_q_cache)
+    :return: dict of candidate arrays
+    """
+    stg = dpp['Stg']
+    last_basis = None
+    if dpp['Hy_param'][6]:
+        # warm start: the stage land phase is always taken from the horizon simulation (see get_warm_basis)
+        basis = dpp['Hy_warm'][t]
+        last_basis = dpp['Hy_warm'][t - 1]
+    sc_p = dpp['SC_param']
+    tc_p = dpp['TC_p']
+    lulc = find_lulc_batch(cand['Last_LULC'], cand['Xd'], dpp['Availareaf'])
+    #
+    # hydrology and water dependent costs, by chunks of candidates:
+    cn = list()
+    rzdf = list()
+    q90 = list()
+    sc = list()
+    risk = list()
+    tc = list()
+    for i in range(0, len(lulc), chunk):
+        lcl_lulc = lulc[i: i + chunk]
+        hy = find_q_batch(dpp['Area'], dpp['P_stg'][t], dpp['PET_stg'][t], lcl_lulc, dpp['Soils'],
+                          dpp['Hy_param'], basis, cache, t, cand['Last_LULC'][i: i + chunk], last_basis)
+        sc_dct = find_sc_batch(hy['Q'], dpp['Wconsr'][t - 1], dpp['Tariff'][t - 1], sc_p[0][t - 1],
+                               sc_p[1][t - 1], sc_p[2][t - 1], sc_p[3][t - 1], type=dpp['SC_type'])
+        tc.append(find_tc_batch(hy['Q'], hy['Qb'], dpp['Wconsr'][t - 1], lcl_lulc, tc_p[0], tc_p[1]))
+        sc.append(sc_dct['SC'])
+        risk.append(sc_dct['Risk'])
+        cn.append(hy['CN'])
+        rzdf.append(hy['Rzd'])
+        q90.append(hy['q90'])
+    sc = np.concatenate(sc)
+    tc = np.concatenate(tc)
+    xc = find_xc_batch(lulc, dpp['Area'], dpp['Cycle'], dpp['Oprt'], cand['Xd'], dpp['Availarea'], dpp['Inst'])
+    #
+    # costs in fv and pv:
+    fv = np.round(sc + tc + xc, 2)
+    xcpv = find_pv(xc, stg[t] - stg[0], dpp['RR'])
+    scpv = find_pv(sc, stg[t] - stg[0], dpp['RR'])
+    tcpv = find_pv(tc, stg[t] - stg[0], dpp['RR'])
+    cpv = np.round(xcpv + scpv + tcpv, 2)
+    c = cpv
+    if drift is not None:
+        c = cpv * drift
+    # recursion happens here:
+    if t == 1:
+        f = c
+    else:
+        f = np.round(c + cand['Last_f'], 2)
+    ev = {'LULC': lulc, 'F': f, 'C': c, 'Cpv': cpv, 'FV': fv, 'SC': sc, 'TC': tc, 'XC': xc,
+          'SCpv': scpv, 'TCpv': tcpv, 'XCpv': xcpv, 'q90': np.concatenate(q90), 'CN': np.concatenate(cn),
+          'Rzdf': np.concatenate(rzdf), 'Risk': np.concatenate(risk)}
+    return ev
+
+
+def get_cand_policy(t, stt, i, cand, ev):
+    """
+    get the policy tuple of a DP stage candidate
+    :param t: stage index
+    :param stt: tuple of states
+    :param i: candidate index
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param ev: dict of evaluated candidate arrays (see eval_stage)
+    :return: policy tuple
+    """
+    cfv = (float(ev['FV'][i]), (float(ev['SC'][i]), float(ev['TC'][i]), float(ev['XC'][i])))
+    cpv = (float(ev['C'][i]), (float(ev['SCpv'][i]), float(ev['TCpv'][i]), float(ev['XCpv'][i])))
+    lcl_policy = (t, stt[cand['S_id'][i]], float(ev['F'][i]), cand['X'][i].item(), tuple(cand['Xd'][i].tolist()),
+                  tuple(ev['LULC'][i].tolist()), cand['Last_S'][i].item(), cfv, cpv, float(ev['q90'][i]),
+                  float(ev['CN'][i]), float(ev['Rzdf'][i]), float(ev['Risk'][i]))
+    return lcl_policy
+
+
+def get_stage_best(nstt, cand, ev):
+    """
+    get the best candidate of each state of a DP stage
+    :param nstt: number of states
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param ev: dict of evaluated candidate arrays (see eval_stage)
+    :return: tuple of (first, last + 1, best) candidate index by state. Best is -1 for states without candidates
+    """
+    stg_ids = list()
+    bounds = np.searchsorted(cand['S_id'], np.arange(0, nstt + 1))
+    for s in range(0, nstt):
+        i0 = int(bounds[s])
+        i1 = int(bounds[s + 1])
+        f_id = -1
+        if i1 > i0:
+            # get best f index (first of ties, as min and index):
+            f_id = i0 + int(np.argmin(ev['F'][i0:i1]))
+        stg_ids.append((i0, i1, f_id))
+    return tuple(stg_ids)
+
+
+def set_stage_table(tbl, t, stt, cand, ev, stg_ids):
+    """
+    store the best candidate of each state of a DP stage in the policy table
+    :param tbl: policy table (see get_policy_table)
+    :param t: stage index
+    :param stt: tuple of states
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param ev: dict of evaluated candidate arrays (see eval_stage)
+    :param stg_ids: tuple of (first, last + 1, best) candidate index by state (see get_stage_best)
+    :return: none
+    """
+    ids = np.array([lcl_ids[2] for lcl_ids in stg_ids], dtype=int)
+    # states without candidates are not reachable:
+    s_ok = ids >= 0
+    ids = ids[s_ok]
+    row = tbl[t]
+    row['Set'] = s_ok
+    row['S'] = np.array(stt)
+    lcl_row = row[s_ok]
+    lcl_row['f'] = ev['F'][ids]
+    lcl_row['X'] = cand['X'][ids]
+    lcl_row['Xd'] = cand['Xd'][ids]
+    lcl_row['LULC'] = ev['LULC'][ids]
+    lcl_row['Last_S'] = cand['Last_S'][ids]
+    lcl_row['Last_id'] = cand['Last_id'][ids]
+    lcl_row['CFV'] = np.column_stack((ev['FV'][ids], ev['SC'][ids], ev['TC'][ids], ev['XC'][ids]))
+    lcl_row['CPV'] = np.column_stack((ev['C'][ids], ev['SCpv'][ids], ev['TCpv'][ids], ev['XCpv'][ids]))
+    lcl_row['q90'] = ev['q90'][ids]
+    lcl_row['CN'] = ev['CN'][ids]
+    lcl_row['Rzdf'] = ev['Rzdf'][ids]
+    lcl_row['Risk'] = ev['Risk'][ids]
+    row[s_ok] = lcl_row
+
+
+def get_dp_path(tbl, stg):
+    """
+    trace the best DP path backwards by the predecessor pointers of the policy table
+    :param tbl: policy table (see get_policy_table)
+    :param stg: tuple of stages
+    :return: list of state indexes by stage
+    """
+    path_ids = [0] * len(stg)
+    # start in the last stage at the best f of the reachable states (first of ties):
+    s = int(np.argmin(np.where(tbl['Set'][len(stg) - 1], tbl['f'][len(stg) - 1], np.inf)))
+    for t in range(len(stg) - 1, 0, -1):
+        path_ids[t] = s
+        s = int(tbl['Last_id'][t, s])
+    return path_ids
+
+
+def slice_cand(cand, i0, i1):
+    """
+    slice all candidate arrays
+    :param cand: dict of candidate arrays
+    :param i0: first index
+    :param i1: last index + 1
+    :return: dict of candidate arrays
+    """
+    out = dict()
+    for k in cand:
+        out[k] = cand[k][i0:i1]
+    return out
+
+
+# process pool worker storage (see init_dp_worker):
+dp_worker = dict()
+
+
+def init_dp_worker(dpp, basis, cache_size=2048, keep=False):
+    """
+    process pool initializer. DP parameters and time series are shared once per worker
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param basis: boolean to control the stage HRU response basis mode
+    :param cache_size: size of the worker hydrology memo cache (see get_q_cache)
+    :param keep: boolean to send the new hydrology results back (see get_q_cache)
+    :return: none
+    """
+    dp_worker.clear()
+    dp_worker['DPP'] = dpp
+    dp_worker['Basis'] = basis
+    dp_worker['Stg_basis'] = dict()
+    dp_worker['Cache'] = get_q_cache(cache_size, keep)
+
+
+def eval_stage_worker(t, cand, drift=None):
+    """
+    evaluate a chunk of DP stage candidates in a process pool worker
+    :param t: stage index
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param drift: array of cost multipliers by candidate
+    :return: dict of candidate arrays (see eval_stage), tuple of cache hits and misses in the chunk
+    and dict of the new hydrology results (None if the worker does not keep them)
+    """
+    dpp = dp_worker['DPP']
+    stg_basis = None
+    if dp_worker['Basis']:
+        # the stage basis is computed once per worker by stage:
+        if t not in dp_worker['Stg_basis']:
+            dp_worker['Stg_basis'].clear()
+            dp_worker['Stg_basis'][t] = find_stage_basis(dpp, t)
+        stg_basis = dp_worker['Stg_basis'][t]
+    cache = dp_worker['Cache']
+    hits = cache['Hits']
+    misses = cache['Misses']
+    ev = eval_stage(t, cand, dpp, basis=stg_basis, drift=drift, cache=cache)
+    kept = cache['Keep']
+    if kept is not None:
+        cache['Keep'] = dict()
+    return ev, (cache['Hits'] - hits, cache['Misses'] - misses), kept
+
+
+def eval_stage_pool(pool, t, cand, drift=None, nchunks=4, cache=None):
+    """
+    evaluate all candidates of a DP stage in a process pool, by chunks of candidates.
+    Candidates are evaluated independently, so results are the same as eval_stage
+    :param pool: concurrent.futures.ProcessPoolExecutor (initialized with init_dp_worker)
+    :param t: stage index
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param drift: array of cost multipliers by candidate
+    :param nchunks: number of chunks
+    :param cache: cache dict to gather the workers cache statistics and new hydrology results (see get_q_cache)
+    :return: dict of candidate arrays (see eval_stage)
+    """
+    size = len(cand['S_id'])
+    bounds = np.linspace(0, size, min(nchunks, size) + 1).astype(int)
+    futures = list()
+    for i in range(0, len(bounds) - 1):
+        lcl_drift = None
+        if drift is not None:
+            lcl_drift = drift[bounds[i]:bounds[i + 1]]
+        lcl_cand = slice_cand(cand, bounds[i], bounds[i + 1])
+        futures.append(pool.submit(eval_stage_worker, t, lcl_cand, lcl_drift))
+    evs = list()
+    for future in futures:
+        lcl_ev, lcl_stats, lcl_kept = future.result()
+        evs.append(lcl_ev)
+        if cache is not None:
+            cache['Hits'] = cache['Hits'] + lcl_stats[0]
+            cache['Misses'] = cache['Misses'] + lcl_stats[1]
+            if cache['Keep'] is not None and lcl_kept is not None:
+                cache['Keep'].update(lcl_kept)
+    ev = dict()
+    for k in evs[0]:
+        ev[k] = np.concatenate([lcl_ev[k] for lcl_ev in evs])
+    return ev
+
+
+def get_dp_outdct(stg, path, c0):
+    """
+    get the DP output dict from a path of stage policies
+    :param stg: tuple of stages
+    :param path: list of policy tuples by stage (stage 0 to last stage)
+    :param c0: list of baseline tuples by stage
+    :return: output dict
+    """
     # 'Baseline' is: (F, FV, PV, STXfv, STXpv)
     out_dct = {'Stage t': stg,
-               'State S(t)': stt_out,
-               'Cost f(t) $PV': f_out,
-               'Decision X(t)': x_out,
-               'Decision Set Xd(t)': xd_out,
-               'LULC %':lulc_out,
-               'Costs STX $FV': cfv_out,
-               'Costs STX $PV': cpv_out,
-               'q90': q90_out,
-               'CN': cn_out,
-               'Rzdf': rzdf_out,
-               'Risk': risk_out,
+               'State S(t)': [lcl_policy[1] for lcl_policy in path],
+               'Cost f(t) $PV': [lcl_policy[2] for lcl_policy in path],
+               'Decision X(t)': [lcl_policy[3] for lcl_policy in path],
+               'Decision Set Xd(t)': [lcl_policy[4] for lcl_policy in path],
+               'LULC %': [lcl_policy[5] for lcl_policy in path],
+               'Costs STX $FV': [lcl_policy[7] for lcl_policy in path],
+               'Costs STX $PV': [lcl_policy[8] for lcl_policy in path],
+               'q90': [lcl_policy[9] for lcl_policy in path],
+               'CN': [lcl_policy[10] for lcl_policy in path],
+               'Rzdf': [lcl_policy[11] for lcl_policy in path],
+               'Risk': [lcl_policy[12] for lcl_policy in path],
                'Baseline': c0}
-    # dp_output = (stg, stt_out, f_out, x_out, xd_out, lulc_out, cfv_out, cpv_out, c0)
+    return out_dct
+
+
+def get_dp_output_lst(out_dct):
+    """
+    get the output outlook report strings
+    :param out_dct: DP output dict
+    :return: list of report strings
+    """
+    output_lst = list()
     df = pd.DataFrame(out_dct)
     output_lst.append('\nGeneral outlook:')
     output_str = df[['Stage t', 'State S(t)', 'Cost f(t) $PV']].to_string()
@@ -1114,31 +1269,382 @@ def run_sim(setts, data, pol, sim=False, prt_sts=False):
     output_lst.append('\nBaseline outlook (f, fv, pv, (stx_fv), (stx_pv), (q90, CN, Rzdf), Risk):')
     output_str = df[['Stage t', 'Baseline']].to_string()
     output_lst.append(output_str)
+    return output_lst
+
+
+def append_dp_log(dp_log, events):
+    """
+    append events to the DP structured log
+    :param dp_log: log file name (newline-delimited json records) or list of events (in memory log)
+    :param events: list of event dicts
+    :return: none
+    """
+    if isinstance(dp_log, str):
+        with open(dp_log, 'a') as fle:
+            for event in events:
+                fle.write(json.dumps(event) + '\n')
+    else:
+        dp_log.extend(events)
+
+
+def load_dp_log(dp_log):
+    """
+    iterate over the events of the DP structured log
+    :param dp_log: log file name or list of events
+    :return: generator of event dicts
+    """
+    if isinstance(dp_log, str):
+        with open(dp_log, 'r') as fle:
+            for line in fle:
+                if line.strip() != '':
+                    yield json.loads(line)
+    else:
+        for event in dp_log:
+            yield event
+
+
+def trim_dp_log(dp_log, t):
+    """
+    drop the events of the stages after t from a DP log file (used when resuming a run)
+    :param dp_log: log file name
+    :param t: last stage to keep
+    :return: none
+    """
+    events = [event for event in load_dp_log(dp_log) if event['t'] <= t]
+    open(dp_log, 'w').close()
+    append_dp_log(dp_log, events)
+
+
+def get_tuples(obj):
+    """
+    convert nested lists (as loaded from json) back to tuples
+    :param obj: object
+    :return: object with lists converted to tuples
+    """
+    if isinstance(obj, list):
+        return tuple(get_tuples(elem) for elem in obj)
+    return obj
+
+
+def render_dp_log(dp_log):
+    """
+    render the human-readable DP LOG report section from the DP structured log
+    :param dp_log: log file name or list of events
+    :return: generator of report strings
+    """
+    yield '\n\n\nDP LOG Report\n\n'
+    aux_tpl = ('State S(t)', 'Best f value', 'Best Decision X', 'Best Decision Set Xd', 'Best LULC',
+               'Coming from S(t-1)', 'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
+    for event in load_dp_log(dp_log):
+        if event['Event'] == 'stage':
+            yield '\n\n\nStage #' + str(event['t']) + ' (' + str(event['Stage']) + ')'
+            # the elapsed time is taken once by stage, when all its candidates are evaluated:
+            if 'Time' in event:
+                yield get_dp_status(event['Batch'], event['Size'], event['Time'])
+        elif event['Event'] == 'state':
+            yield '\n\nStage #' + str(event['t']) + '\tState #' + str(event['s']) + ':\t S= ' \
+                  + str(event['S']) + '\t\tXps= ' + str(get_tuples(event['Xps']))
+            yield get_dp_status(event['Batch'], event['Size'], event.get('Time'))
+            df = pd.DataFrame({'Decision X': event['X'],
+                               'Decision set Xd': list(get_tuples(event['Xd'])),
+                               'f value': event['f'],
+                               'LULC': list(get_tuples(event['LULC']))})
+            yield ''
+            yield df.to_string()
+            yield ''
+            df = pd.DataFrame({'Best Policy': get_tuples(event['Best'])}, index=aux_tpl)
+            yield df.to_string()
+        elif event['Event'] == 'policy':
+            yield '\nStage #' + str(event['t']) + ' (' + str(event['Stage']) + ')\tS=' + str(event['S']) + \
+                  '\tf=' + str(event['f']) + '\tX=' + str(event['X']) + '\tXd=' + str(get_tuples(event['Xd'])) + \
+                  '\tLULC=' + str(get_tuples(event['LULC']))
+        elif event['Event'] == 'search':
+            yield '\n\nStage #' + str(event['t']) + ' (' + str(event['Stage']) + ')\tCandidate evaluations: ' \
+                  + str(event['Evals'])
+            df = pd.DataFrame({'State S(t)': event['S'],
+                               'f value': event['f'],
+                               'Decision set Xd': list(get_tuples(event['Xd']))})
+            yield df.to_string()
+        elif event['Event'] == 'end':
+            yield '\n\n****** END OF ' + event['Procedure'] + ' PROCEDURE ******\n\n'
+
+
+def save_dp_checkpoint(rundir, chk):
+    """
+    save a DP stage checkpoint file to the run directory
+    :param rundir: run directory (see plans2.create_dp_rundir)
+    :param chk: dict of the completed stage records
+    :return: checkpoint file name
+    """
+    chk_flnm = rundir + '/DP-checkpoint_stage' + str(chk['Stage']) + '.pkl'
+    # write to a temporary file first so an interrupted write does not leave a broken checkpoint:
+    tmp_flnm = chk_flnm + '.tmp'
+    with open(tmp_flnm, 'wb') as fle:
+        pickle.dump(chk, fle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_flnm, chk_flnm)
+    return chk_flnm
+
+
+def load_dp_checkpoint(rundir):
+    """
+    load the DP stage checkpoints of a run directory
+    :param rundir: run directory
+    :return: list of stage checkpoint dicts, from stage 1 to the last completed stage
+    """
+    chk_lst = list()
+    t = 1
+    while True:
+        chk_flnm = rundir + '/DP-checkpoint_stage' + str(t) + '.pkl'
+        if not os.path.exists(chk_flnm):
+            break
+        with open(chk_flnm, 'rb') as fle:
+            chk_lst.append(pickle.load(fle))
+        t = t + 1
+    return chk_lst
+
+
+def resume_dp(setts, data, rundir, prt_sts=False, **kwargs):
+    """
+    resume a DP run from the last completed stage saved in its run directory
+    :param setts: tuple with dp parameters (settings), the same of the interrupted run
+    :param data: dp data, the same of the interrupted run
+    :param rundir: run directory of the interrupted run
+    :param prt_sts: boolean to control status screen printouts
+    :param kwargs: other run_dp keyword arguments (pol, drifter, workers, etc), the same of the interrupted run
+    :return: same as run_dp
+    """
+    chk_lst = load_dp_checkpoint(rundir)
+    if len(chk_lst) == 0:
+        print('No DP checkpoint found at: {}. Starting a new run.'.format(rundir))
+        return run_dp(setts, data, prt_sts=prt_sts, rundir=rundir, **kwargs)
+    return run_dp(setts, data, prt_sts=prt_sts, rundir=rundir, run_ts=chk_lst[0]['Run_ts'], resume=chk_lst,
+                  **kwargs)
+
+
+def get_hydro_key(dpp):
+    """
+    get the fingerprint of the DP hydrology inputs (stages, watershed area, soils and climate time series).
+    A hydrology store is only reused by runs with the same fingerprint
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :return: string
+    """
+    sha = hashlib.sha1()
+    sha.update(repr((tuple(dpp['Stg']), float(dpp['Area']))).encode())
+    for soil in dpp['Soils']:
+        sha.update(np.ascontiguousarray(soil, dtype=float).tobytes())
+    for t in range(1, len(dpp['Stg'])):
+        sha.update(np.ascontiguousarray(dpp['P_stg'][t], dtype=float).tobytes())
+        sha.update(np.ascontiguousarray(dpp['PET_stg'][t], dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+def save_hydro_store(rundir, t, hy_key, memo):
+    """
+    save the hydrology store of a DP stage to the run directory: the stage hydrology results
+    (Q, CN, Rzd, q90, Qb) by hydrology memo key (see find_q_batch)
+    :param rundir: run directory (see plans2.create_dp_rundir)
+    :param t: stage index
+    :param hy_key: hydrology inputs fingerprint (see get_hydro_key)
+    :param memo: dict of hydrology results by key
+    :return: store file name
+    """
+    store_flnm = rundir + '/DP-hydro_stage' + str(t) + '.pkl'
+    store = {'Stage': t, 'Hy_key': hy_key, 'Memo': memo}
+    # write to a temporary file first so an interrupted write does not leave a broken store:
+    tmp_flnm = store_flnm + '.tmp'
+    with open(tmp_flnm, 'wb') as fle:
+        pickle.dump(store, fle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_flnm, store_flnm)
+    return store_flnm
+
+
+def load_hydro_store(rundir, t, hy_key):
+    """
+    load the hydrology store of a DP stage
+    :param rundir: run directory of the stored run
+    :param t: stage index
+    :param hy_key: hydrology inputs fingerprint of the current run (see get_hydro_key)
+    :return: dict of hydrology results by key
+    """
+    store_flnm = rundir + '/DP-hydro_stage' + str(t) + '.pkl'
+    if not os.path.exists(store_flnm):
+        raise ValueError('DP hydrology store not found: {}'.format(store_flnm))
+    with open(store_flnm, 'rb') as fle:
+        store = pickle.load(fle)
+    if store['Hy_key'] != hy_key:
+        raise ValueError('DP hydrology store does not match the run hydrology inputs: {}'.format(store_flnm))
+    return store['Memo']
+
+
+def recost_dp(setts, data, store_dir, prt_sts=False, **kwargs):
+    """
+    re-solve the DP with new economic data (return rate, tariff, scarcity, treatment and expansion cost
+    parameters) from the hydrology store of a former run (see run_dp store argument). The stage hydrology
+    is not simulated again, only the LULCs missing in the store (changed hydrology parameters)
+    :param setts: tuple with dp parameters (settings)
+    :param data: dp data, with the same climate, soils and watershed area of the stored run
+    :param store_dir: run directory of the stored run
+    :param prt_sts: boolean to control status screen printouts
+    :param kwargs: other run_dp keyword arguments (pol, drifter, rundir, etc)
+    :return: same as run_dp
+    """
+    return run_dp(setts, data, prt_sts=prt_sts, store_dir=store_dir, **kwargs)
+
+
+def eval_policy(dpp, pol, stt, basis=True, cache=None):
+    """
+    evaluate a single NBS expansion policy stage by stage, along with the baseline (do-nothing) scenario.
+    Only the decision sets of the policy are evaluated (one stage hydrology by stage)
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param pol: policy of decision sets by stage (index 0 is the stage 0 and is not used)
+    :param stt: tuple of states the policy must stay on
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param cache: hydrology memo cache dict (see get_q_cache)
+    :return: list of policy tuples by stage and list of baseline tuples by stage (stage 0 to last stage)
+    """
+    stg = dpp['Stg']
+    hydro_p = dpp['Hydro_p']
+    q90_0 = hydro_p['q90']
+    c0 = [(0, 0, 0, (0, 0, 0), (0, 0, 0), (q90_0, hydro_p['CN'], hydro_p['Rzdf']), 0)]
+    policy0 = (0, 0, 0, 0, (0, 0, 0), dpp['Lulc0'], 0, (0, (0, 0, 0)), (0, (0, 0, 0)), q90_0, hydro_p['CN'],
+               hydro_p['Rzdf'], 0)
+    path = [policy0]
+    base_policy = policy0
+    for t in range(1, len(stg)):
+        last_policy = path[t - 1]
+        xd = tuple(pol[t])
+        x = sum(xd)
+        s_ids = np.flatnonzero(np.isclose(np.array(stt, dtype=float), last_policy[1] + x))
+        if len(s_ids) == 0:
+            raise ValueError('policy decision set {} at stage {} is off the DP states'.format(xd, t))
+        # the baseline (state 0) and the policy candidates:
+        cand = {'S_id': np.array([0, s_ids[0]], dtype=int),
+                'X': np.array([0, x]),
+                'Xd': np.array([(0, 0, 0), xd]),
+                'Last_id': np.array([0, 0], dtype=int),
+                'Last_S': np.array([base_policy[1], last_policy[1]]),
+                'Last_LULC': np.array([base_policy[5], last_policy[5]], dtype=float),
+                'Last_f': np.array([base_policy[2], last_policy[2]], dtype=float)}
+        stg_basis = None
+        if basis:
+            stg_basis = find_stage_basis(dpp, t)
+        ev = eval_stage(t, cand, dpp, basis=stg_basis, cache=cache)
+        #
+        base_policy = get_cand_policy(t, stt, 0, cand, ev)
+        c0.append((base_policy[2], base_policy[7][0], base_policy[8][0], base_policy[7][1], base_policy[8][1],
+                   (base_policy[9], base_policy[10], base_policy[11]), base_policy[12]))
+        path.append(get_cand_policy(t, stt, 1, cand, ev))
+    return path, c0
+
+
+def sim_policy(setts, data, pol, prt_sts=False, basis=True, run_ts=None):
+    """
+    simulate a single NBS expansion policy. Only the decision sets of the policy are evaluated
+    (one stage hydrology by stage), instead of the full DP grid of run_sim
+    :param setts: tuple with dp parameters (settings)
+    :param data: dp data
+    :param pol: policy of decision sets by stage (index 0 is the stage 0 and is not used)
+    :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param run_ts: run timestamp string (a new one is taken if None)
+    :return: same as run_sim
+    """
+    import time
+
+    # get run timestamp
+    if run_ts is None:
+        run_ts = stringsf.nowsep()
     #
-    # footnote prints:
-    log_str = '\n\n****** END OF DP PROCEDURE ******\n\n'
-    log_lst.append(log_str)
-    # find DP elapsed time:
-    dp_t2 = time.time()
-    dp_procedure_et = dp_t2 - dp_t1
-    header_str = 'Elapsed time: ' + str(dp_procedure_et) + ' seconds'
-    header_lst.append(header_str)
+    # get parameters:
+    dpp = get_dp_param(setts, data)
+    stg = dpp['Stg']  # get stages tuple
+    stt = dpp['Stt']  # get states tuple
     #
-    # DP logs:
-    out_logs = (header_lst, param_lst, output_lst, policy_lst, log_lst)
+    # create lists to store repost sections:
+    header_lst = ['\n\n****** PLANS - POLICY SIMULATION PROCEDURE ******\n\n']
+    param_lst = get_dp_header(run_ts, dpp)
+    output_lst = ['\n\n\nDP OUTPUT\n\n']
+    policy_lst = ['\n\n\nDP GLOBAL POLICY OUTLOOK\n\n']
+    dp_log = list()  # structured log (see render_dp_log)
     #
-    # Outer data:
-    out_cloud = {'CN':cn_lst[:], 'Rzdf':rzdf_lst[:], 'q90':q90_lst[:]}
+    dp_t1 = time.time()
+    # the baseline and the policy share the same hydrology when the policy does nothing:
+    path, c0 = eval_policy(dpp, pol, stt, basis=basis, cache=get_q_cache(4))
+    #
+    # log section:
+    for t in range(1, len(stg)):
+        lcl_policy = path[t]
+        event = {'Event': 'policy', 't': t, 'Stage': stg[t], 'S': lcl_policy[1], 'f': lcl_policy[2],
+                 'X': lcl_policy[3], 'Xd': lcl_policy[4], 'LULC': lcl_policy[5]}
+        append_dp_log(dp_log, [event])
+        if prt_sts:
+            print(list(render_dp_log([event]))[1])
     #
+    # policies printing section:
+    aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
+               'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
+    df = pd.DataFrame(path, columns=aux_tpl)
+    policy_lst.append(df.to_string())
+    #
+    out_dct = get_dp_outdct(stg, path, c0)
+    output_lst = output_lst + get_dp_output_lst(out_dct)
+    #
+    append_dp_log(dp_log, [{'Event': 'end', 't': len(stg), 'Procedure': 'POLICY SIMULATION'}])
+    header_lst.append('Elapsed time: ' + str(time.time() - dp_t1) + ' seconds')
+    out_logs = (header_lst, param_lst, output_lst, policy_lst, dp_log)
+    out_cloud = {'CN': [lcl_policy[10] for lcl_policy in path[1:]],
+                 'Rzdf': [lcl_policy[11] for lcl_policy in path[1:]],
+                 'q90': [lcl_policy[9] for lcl_policy in path[1:]]}
     return out_dct, out_logs, run_ts, out_cloud
 
 
-def run_dp(setts, data, prt_sts=False):
+def run_sim(setts, data, pol, sim=False, prt_sts=False, basis=True, workers=None, cache_size=2048, rundir=None,
+            run_ts=None):
+    """
+    run DP for NBS expansion optimization
+    :param setts: tuple with dp parameters (settings)
+    :param data: dp data
+    :param pol: policy of decision sets by stage
+    :param sim: boolean to force the policy (decision sets off the policy are drifted away)
+    :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param workers: number of worker processes (see run_dp)
+    :param cache_size: size of the hydrology memo cache (see run_dp)
+    :param rundir: run directory to save stage checkpoints (see run_dp)
+    :param run_ts: run timestamp string
+    :return:
+    """
+    drifter = 1
+    if sim:
+        drifter = 1000 * 1000 * 1000
+    return run_dp(setts, data, prt_sts=prt_sts, basis=basis, pol=pol, drifter=drifter, workers=workers,
+                  cache_size=cache_size, rundir=rundir, run_ts=run_ts)
+
+
+def run_dp(setts, data, prt_sts=False, basis=True, pol=None, drifter=1, workers=None, cache_size=2048, rundir=None,
+           run_ts=None, resume=None, stt_mask=None, store=False, store_dir=None):
     """
     simulate NBS expansion
     :param setts: tuple with dp parameters (settings)
     :param data: dp data
     :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param pol: policy of decision sets by stage to be simulated (see run_sim)
+    :param drifter: cost multiplier of decision sets off the policy
+    :param workers: number of worker processes to evaluate the stage candidates (None or 1 runs serially).
+    Results are the same as the serial run. Scripts must protect the entry point with if __name__ == '__main__'
+    :param cache_size: max number of hydrology results in the LRU memo cache (by worker). 0 disables it
+    :param rundir: run directory (see plans2.create_dp_rundir) to save a checkpoint after each stage
+    and to stream the DP structured log file (DP-log_<run_ts>.ndjson). The log is kept in memory if None
+    :param run_ts: run timestamp string (a new one is taken if None)
+    :param resume: list of stage checkpoint dicts to restart from (see resume_dp)
+    :param stt_mask: list of boolean arrays of the allowed states by stage (see run_mrdp). The state 0 must
+    be allowed for the baseline scenario. All states are allowed if None
+    :param store: boolean to save the stage hydrology store to the run directory (DP-hydro_stage<t>.pkl),
+    so the DP can be re-solved with new economic data (see recost_dp). It needs a run directory. The store
+    holds the Q and Qb series of every LULC of each stage (in memory until the stage ends), so it is opt-in
+    :param store_dir: run directory of a stored run to take the stage hydrology from (re-cost mode, see recost_dp).
+    Re-cost runs are serial, since only the costs are evaluated
     :return:
     """
     import time
@@ -1146,638 +1652,949 @@ def run_dp(setts, data, prt_sts=False):
     # get current time:
     dp_t0 = time.time()
     # get run timestamp
-    run_ts = stringsf.nowsep()
+    if run_ts is None:
+        run_ts = stringsf.nowsep()
     #
     # get parameters:
-    stg = setts[0]  # get stages tuple
-    stt = setts[1]  # get states tuple
-    y = setts[2]  # get Y from settings
-    size = setts[3]  # get size of dp
-    all_xds = setts[4]  # get all decisions sets
-    cycle = stg[1] - stg[0]  # get cycle in years
-    #
-    # get data:
-    lulc0A = data['Lulc0']  # in km2
-    area = sum(lulc0A)  # in km2
-    availarea = lulc0A[3] + lulc0A[4]  # in km2
-    lulc0 = get_lulc(lulc0A)  # in %
-    availareaf = lulc0[3] + lulc0[4]  # in %
-    soils = data['Soils']
-    dp_rr = data['RR']  # in %
-    # get time series:
-    p_ts = data['P']
-    pet_ts = data['PET']
-    #
-    # get Scarcity model parameters:
-    sc_a_p = data['SC_param'][0] # array by stg
-    sc_b_p = data['SC_param'][1]
-    sc_k_p = data['SC_param'][2]
-    sc_e_p = data['SC_param'][3]
-    trf = data['Tariff']
-    wconsr = data['Wconsr']
-    #
-    # slice time series to suit dp stages
-    p_stg = slice_ts(p_ts, stg)
-    pet_stg = slice_ts(pet_ts, stg)
-    #
-    # hydrology hard parameters
-    hydro_p = data['Hydro_p']
-    hy_iaf = hydro_p['iaf']
-    hy_swmax = hydro_p['swmax']
-    hy_gwmax = hydro_p['gwmax']
-    hy_knash = hydro_p['knash']
-    hy_nnash = int(hydro_p['nnash'])
-    hy_param = (hy_iaf, hy_swmax, hy_gwmax, hy_knash, hy_nnash)
+    dpp = get_dp_param(setts, data)
+    stg = dpp['Stg']  # get stages tuple
+    stt = dpp['Stt']  # get states tuple
+    size = dpp['Size']  # get size of dp
+    all_xds = dpp['All_xds']  # get all decisions sets
+    lulc0 = dpp['Lulc0']
+    hydro_p = dpp['Hydro_p']
     cn0 = hydro_p['CN']
     rzdf0 = hydro_p['Rzdf']
     q90_0 = hydro_p['q90']
     #
-    # treatment cost model parameters
-    tc_p = data['TC_p']
-    tc_p_a = tc_p['A']
-    tc_p_b = tc_p['B']
-    #
-    # operation cost parameters
-    oprt_p_nbsf = data['Oprt_p'][0]
-    oprt_p_nbsp = data['Oprt_p'][1]
-    oprt_p_nbsc = data['Oprt_p'][2]
-    oprt_nbsf_a = oprt_p_nbsf['A']
-    oprt_nbsf_b = oprt_p_nbsf['B']
-    oprt_nbsp_a = oprt_p_nbsp['A']
-    oprt_nbsp_b = oprt_p_nbsp['B']
-    oprt_nbsc_a = oprt_p_nbsc['A']
-    oprt_nbsc_b = oprt_p_nbsc['B']
-    oprt_data = (oprt_nbsf_a, oprt_nbsf_b, oprt_nbsp_a, oprt_nbsp_b, oprt_nbsc_a, oprt_nbsc_b)
-    #
-    # installation cost parameters
-    inst_p_nbsf = data['Inst_p'][0]
-    inst_p_nbsp = data['Inst_p'][1]
-    inst_p_nbsc = data['Inst_p'][2]
-    inst_nbsf_a = inst_p_nbsf['A']
-    inst_nbsf_b = inst_p_nbsf['B']
-    inst_nbsp_a = inst_p_nbsp['A']
-    inst_nbsp_b = inst_p_nbsp['B']
-    inst_nbsc_a = inst_p_nbsc['A']
-    inst_nbsc_b = inst_p_nbsc['B']
-    inst_data = (inst_nbsf_a, inst_nbsf_b, inst_nbsp_a, inst_nbsp_b, inst_nbsc_a, inst_nbsc_b)
-    #
     # set counter:
     dp_counter = 0
     #
     # create lists to store repost sections:
     header_lst = ['\n\n****** PLANS - DYNAMIC PROGRAMMING PROCEDURE ******\n\n']
-    param_lst = ['\n\n\nDP MODELS PARAMETERS\n\n']
+    param_lst = get_dp_header(run_ts, dpp)
     output_lst = ['\n\n\nDP OUTPUT\n\n']
     policy_lst = ['\n\n\nDP GLOBAL POLICY OUTLOOK\n\n']
-    log_lst = ['\n\n\nDP LOG Report\n\n']
-    #
-    # report header prints:
-    while True:  # loop here is just to better organize
-        aux_str1 = 'Timestamp:' + run_ts
-        aux_str2 = '\n\nStages: ' + str(stg) + '\nStates: ' + str(stt) + \
-                   '\nReturn rate (%): ' + str(dp_rr) +  \
-                   '\n\nDP size: ' + str(size) + ' batches\n'
-        aux_str3 = '\nWatershed area in km2: {}\nLULC in Stage 0:'.format(area)
-        aux_tpl = ('urban', 'water', 'forest', 'pasture', 'crops', 'nbs_forest', 'nbs_pasture', 'nbs_crops')
-        df = pd.DataFrame({'Area in km2': lulc0A}, index=aux_tpl)
-        aux_str4 = df.to_string()
-        aux_str5 = 'Available area (pasture + crops): ' + str(availarea) + ' km2\n'
-        df = pd.DataFrame({'% of Watershed Area': lulc0}, index=aux_tpl)
-        aux_str4a = df.to_string()
-        aux_str5b = 'Available area (pasture + crops): ' + str(availareaf) + '%\n'
-        aux_str6 = '\n\nHydrology hard parameters:' \
-                   '\nIaf: {}\nSwmax: {}\nGWmax: {}\nK-Nash: {}' \
-                   '\nN-Nash: {}\n'.format(hy_iaf, hy_swmax, hy_gwmax, hy_knash, hy_nnash)
-        aux_str7 = '\nTreatment cost model parameters:' \
-                   '\nTC model parameter A: {}\nTC model parameter B: {}\n'.format(tc_p_a, tc_p_b)
-        aux_str8 = '\nInstallation cost model parameters:\n' \
-                   'NBS forest:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS pasture:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS crops:\n\tParameter A: {}\n\tParameter B: {}\n'.format(inst_nbsf_a, inst_nbsf_b, inst_nbsp_a,
-                                                                               inst_nbsp_b, inst_nbsc_a, inst_nbsc_b)
-        aux_str9 = '\nOperation cost model parameters:\n' \
-                   'NBS forest:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS pasture:\n\tParameter A: {}\n\tParameter B: {}\n' \
-                   'NBS crops:\n\tParameter A: {}\n\tParameter B: {}\n'.format(inst_nbsf_a, inst_nbsf_b, inst_nbsp_a,
-                                                                               inst_nbsp_b, inst_nbsc_a, inst_nbsc_b)
-        param_lst.append(aux_str1)
-        param_lst.append(aux_str2)
-        param_lst.append(aux_str3)
-        param_lst.append(aux_str4)
-        param_lst.append(aux_str5)
-        param_lst.append(aux_str4a)
-        param_lst.append(aux_str5b)
-        param_lst.append(aux_str6)
-        param_lst.append(aux_str7)
-        param_lst.append(aux_str8)
-        param_lst.append(aux_str9)
-        break
+    #
+    # structured log (the DP LOG report section is rendered from it, see render_dp_log):
+    dp_log = list()
+    if rundir is not None:
+        dp_log = rundir + '/DP-log_' + run_ts + '.ndjson'
+        if resume is None:
+            open(dp_log, 'w').close()
     #
     #
     # create baseline scenario (do-nothing) setup:
     c0 = [(0, 0, 0, (0, 0, 0), (0, 0, 0), (q90_0, cn0, rzdf0), 0)]
     #
     #
-    # create empty list of policies:
-    glb_policy = list()
-    for t in range(0, len(stg)):
-        glb_policy.append([(0, 0, 0, 0, (0, 0, 0), lulc0, 0, (0, (0, 0, 0)), (0, (0, 0, 0)), q90_0, cn0, rzdf0, 0)])
+    # create the policy table. Stage 0 has only the state 0:
+    policy0 = (0, 0, 0, 0, (0, 0, 0), lulc0, 0, (0, (0, 0, 0)), (0, (0, 0, 0)), q90_0, cn0, rzdf0, 0)
+    glb_tbl = get_policy_table(len(stg), len(stt))
+    glb_tbl['Set'][0, 0] = True
+    glb_tbl['LULC'][0, 0] = lulc0
     #
     #
     cn_lst = list()
     rzdf_lst = list()
     q90_lst = list()
     #
+    # hydrology memo cache (it keeps the new stage hydrology results for the store):
+    store = store and rundir is not None and store_dir is None
+    q_cache = get_q_cache(cache_size, keep=store)
+    hy_key = None
+    if store or store_dir is not None:
+        hy_key = get_hydro_key(dpp)
+    #
+    # restore completed stages from checkpoints:
+    t_start = 1
+    if resume is not None:
+        for chk in resume:
+            if chk['Stg'] != stg or chk['Stt'] != stt:
+                raise ValueError('DP checkpoint settings do not match the run settings')
+            glb_tbl[chk['Stage']] = chk['Policy']
+            c0.append(chk['Baseline'])
+            cn_lst = cn_lst + chk['CN']
+            rzdf_lst = rzdf_lst + chk['Rzdf']
+            q90_lst = q90_lst + chk['q90']
+            dp_counter = chk['Counter']
+            t_start = chk['Stage'] + 1
+        if isinstance(dp_log, str):
+            trim_dp_log(dp_log, t_start - 1)
+    #
+    # start the process pool (data is shared once per worker):
+    pool = None
+    if workers is not None and workers > 1 and store_dir is None:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_dp_worker,
+                                   initargs=(dpp, basis, cache_size, store))
+    #
     # get DP procedure starting time
     dp_t1 = time.time()
     #
     #
-    # forward movement loop (simulation happens here):
-    for t in range(1, len(stg)):
-        # printing section
-        log_str = '\n\n\nStage #' + str(t) + ' (' + str(stg[t]) + ')'
-        log_lst.append(log_str)
-        # get last stage list of best policies
-        last_stg_policy = glb_policy[t - 1]
-        # populate list of local best policies
-        stg_best_policy = list()
-        # Not recursive section. One-to-go stage, stg =1:
-        if t == 1:
-            # loop in all states
-            for s in range(0, len(stt)):
-                # last lulc:
-                last_lulc = lulc0
-                # populate all possible decisions
-                x = stt[s]  # is just one here
-                xds = all_xds[s]  # get decision sets - index s is the same as the state index
-                # printing section:
-                log_str = '\n\nStage #' + str(t) + '\tState #' + str(s) + ':\t S= ' \
-                           + str(stt[s]) + '\t\tXps= ' + str(x)
-                log_lst.append(log_str)
-                # load lists:
-                fps = list()  # possible fs
-                xps = list()  # possible xs
-                xdps = list()  # possible xdps
-                lulcps = list()  # possible lulcs
-                last_sttps = list()  # possible last states
-                cfvs = list()  # possible local costs in fv
-                cpvs = list()  # possible local costs in pv
-                q90s = list()
-                cns = list()
-                rzdfs = list()
-                risks = list()
-                # loop in all decision sets:
-                for e in xds:
-                    # not recursive section
-                    # find lulc
-                    lulc_lcl = find_lulc(last_lulc, e, availareaf)
-                    #
-                    # find q:
-                    q_tpl = find_q(area, p_stg[t], pet_stg[t], lulc_lcl, soils, hy_param)
-                    # get values:
-                    q_lcl = q_tpl[0]  # array
-                    cn_lcl = q_tpl[1]
-                    rzdf_lcl = q_tpl[2]
-                    q90_lcl = q_tpl[3]
-                    qb_lcl = q_tpl[4]
-                    #
-                    # find costs:
-                    # here the simulations batch happens:
-                    c_lcl_xcfv = find_xc(lulc_lcl, area, cycle, oprt_data, e, availarea, inst_data)  # expansion cost
-                    #
-                    # scarcity cost batch
-                    c_lcl_scfv_dct = find_sc(q_lcl, wconsr[t - 1], trf[t - 1], sc_a_p[t -1], sc_b_p[t -1],
-                                             sc_k_p[t -1], sc_e_p[t -1])
-                    c_lcl_scfv = c_lcl_scfv_dct['SC']  # scarcity cost
-                    sc_risk_lcl = c_lcl_scfv_dct['Risk']  # scarcity risk
-                    #
-                    # treatment cost batch:
-                    c_lcl_tcfv = find_tc(q_lcl, qb_lcl, wconsr[t - 1], lulc_lcl, tc_p_a, tc_p_b)  # treatment cost
-                    #
-                    # local costs in fv (scarcity, treatment, expansion):
-                    c_lcl_fv = (round(c_lcl_scfv + c_lcl_tcfv + c_lcl_xcfv, 2), (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv))
-                    #
-                    c_lcl_xcpv = find_pv(c_lcl_xcfv, stg[t] - stg[0], dp_rr)  # get present value
-                    c_lcl_scpv = find_pv(c_lcl_scfv, stg[t] - stg[0], dp_rr)  # get present value
-                    c_lcl_tcpv = find_pv(c_lcl_tcfv, stg[t] - stg[0], dp_rr)  # get present value
-                    #
-                    # total cost:
-                    c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2)
-                    #
-                    # local costs in pv (scarcity, treatment, expansion):
-                    c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                    #
-                    f_lcl = c_lcl  # no recursion
-                    #
-                    # get last state
-                    last_stt = stt[s] - x
-                    #
-                    # append to lists:
-                    fps.append(f_lcl)
-                    xps.append(x)
-                    xdps.append(e[:])
-                    lulcps.append(lulc_lcl[:])
-                    last_sttps.append(last_sttps)
-                    cfvs.append(c_lcl_fv[:])
-                    cpvs.append(c_lcl_pv[:])
-                    q90s.append(q90_lcl)
-                    cns.append(cn_lcl)
-                    rzdfs.append(rzdf_lcl)
-                    risks.append(sc_risk_lcl)
-                    #
-                    # baseline checker:
-                    if s == 0 and sum(e) == 0:
-                        c0.append((f_lcl, c_lcl_fv[0], c_lcl_pv[0],
-                                  (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv), (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv),
-                                   (q90_lcl, cn_lcl, rzdf_lcl), sc_risk_lcl))
-                    #
-                    #
-                    # append to outer lists:
-                    cn_lst.append(cn_lcl)
-                    rzdf_lst.append(rzdf_lcl)
-                    q90_lst.append(q90_lcl)
-                    #
-                    #
-                    # update counter:
-                    dp_counter = dp_counter + 1
-                    # printing section:
-                    aux_flt = time.time() - dp_t1
-                    log_str = get_dp_status(dp_counter, size, aux_flt)
-                    log_lst.append(log_str)
-                    if prt_sts:
-                        print(log_str)
-                #
-                # get the best f from list:
-                best_f = min(fps)
-                # get best f index:
-                f_id = fps.index(best_f)
-                #
-                # retrieve best variables using f_id:
-                best_x = xps[f_id]  # best x
-                best_xd = xdps[f_id]  # best xd decision set
-                best_lcl_lulc = lulcps[f_id]  # best lulc
-                best_cfv = cfvs[f_id]
-                best_cpv = cpvs[f_id]
-                best_q90 = q90s[f_id]
-                best_cn = cns[f_id]
-                best_rzdf = rzdfs[f_id]
-                best_risk = risks[f_id]
-                #
-                # append policy list:
-                lcl_best_policy = (t, stt[s], best_f, best_x, best_xd, best_lcl_lulc, last_stt, best_cfv, best_cpv,
-                                   best_q90, best_cn, best_rzdf, best_risk)
-                stg_best_policy.append(lcl_best_policy)  # local best stage policy: f, state, decision
-                #
-                # printing section:
-                df = pd.DataFrame({'Decision X':xps, 'Decision set Xd':xdps, 'f value':fps, 'LULC':lulcps})
-                log_str = df.to_string()
-                log_lst.append('')
-                log_lst.append(log_str)
-                log_lst.append('')
-                aux_tpl = ('State S(t)', 'Best f value', 'Best Decision X', 'Best Decision Set Xd', 'Best LULC',
-                           'Coming from S(t-1)', 'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-                df = pd.DataFrame({'Best Policy': lcl_best_policy[1:]}, index=aux_tpl)
-                log_str = df.to_string()
-                log_lst.append(log_str)
-                #
-                # clear loop lists:
-                fps.clear()
-                xps.clear()
-                xdps.clear()
-                lulcps.clear()
-                last_sttps.clear()
-                cfvs.clear()
-                cpvs.clear()
-                q90s.clear()
-                cns.clear()
-                rzdfs.clear()
-                risks.clear()
-        # Recursive section. stg > 1:
-        else:
-            # loop all states
+    # forward movement loop (simulation happens here), the pool is shut down even if a stage fails:
+    try:
+        for t in range(t_start, len(stg)):
+            # log section
+            stg_events = [{'Event': 'stage', 't': t, 'Stage': stg[t]}]
+            # get all candidates of the stage (last state, decision set):
+            s_mask = None
+            if stt_mask is not None:
+                s_mask = stt_mask[t]
+            cand = get_stage_candidates(stt, all_xds, glb_tbl[t - 1], s_mask)
+            # policy simulation drifter:
+            drift = None
+            if pol is not None:
+                drift = np.where(np.all(cand['Xd'] == np.array(pol[t]), axis=1), 1, drifter)
+            #
+            # here the simulations batch happens:
+            if store_dir is not None:
+                # re-cost mode: the stage hydrology comes from the store (missing LULCs are simulated):
+                memo = load_hydro_store(store_dir, t, hy_key)
+                stg_cache = get_q_cache(len(memo) + cache_size)
+                stg_cache['Memo'].update(memo)
+                ev = eval_stage(t, cand, dpp, drift=drift, cache=stg_cache)
+                q_cache['Hits'] = q_cache['Hits'] + stg_cache['Hits']
+                q_cache['Misses'] = q_cache['Misses'] + stg_cache['Misses']
+            elif pool is None:
+                # get the stage HRU response basis:
+                stg_basis = None
+                if basis:
+                    stg_basis = find_stage_basis(dpp, t)
+                ev = eval_stage(t, cand, dpp, basis=stg_basis, drift=drift, cache=q_cache)
+            else:
+                ev = eval_stage_pool(pool, t, cand, drift=drift, nchunks=4 * workers, cache=q_cache)
+            #
+            # baseline checker:
+            b_id = int(np.flatnonzero((cand['S_id'] == 0) & (np.sum(cand['Xd'], axis=1) == 0))[0])
+            c_lcl = float(ev['Cpv'][b_id])
+            f_lcl = c_lcl  # no recursion
+            if t > 1:
+                f_lcl = float(np.round(c_lcl + cand['Last_f'][b_id], 2))
+            c0.append((f_lcl, float(ev['FV'][b_id]), c_lcl,
+                       (float(ev['SC'][b_id]), float(ev['TC'][b_id]), float(ev['XC'][b_id])),
+                       (float(ev['SCpv'][b_id]), float(ev['TCpv'][b_id]), float(ev['XCpv'][b_id])),
+                       (float(ev['q90'][b_id]), float(ev['CN'][b_id]), float(ev['Rzdf'][b_id])),
+                       float(ev['Risk'][b_id])))
+            #
+            # append to outer lists:
+            cn_lst = cn_lst + ev['CN'].tolist()
+            rzdf_lst = rzdf_lst + ev['Rzdf'].tolist()
+            q90_lst = q90_lst + ev['q90'].tolist()
+            #
+            # get the best policy of each state:
+            stg_ids = get_stage_best(len(stt), cand, ev)
+            set_stage_table(glb_tbl, t, stt, cand, ev, stg_ids)
+            #
+            # log section (the stage candidates are evaluated at once, so the elapsed time is logged by stage):
+            aux_flt = time.time() - dp_t1
+            stg_events[0].update({'Batch': dp_counter + len(cand['S_id']), 'Size': size, 'Time': aux_flt})
+            if prt_sts:
+                print(get_dp_status(dp_counter + len(cand['S_id']), size, aux_flt))
             for s in range(0, len(stt)):
-                # populate all possible decisions
-                xs = stt[:s + 1]
-                # printing section:
-                log_str = '\n\nStage #' + str(t) + '\tState #' + str(s) + ':\t S= ' \
-                          + str(stt[s]) + '\t\tXps= ' + str(xs)
-                log_lst.append(log_str)
-                # loop in all possible decisions:
-                fps = list()  # possible fs
-                xps = list()  # possible xs
-                xdps = list()  # possible xdps
-                lulcps = list()  # possible lulcs
-                last_sttps = list()  # possible last states
-                cfvs = list()  # possible local costs in fv
-                cpvs = list()  # possible local costs in pv
-                lps = list()  # last local policies (for printing only)
-                q90s = list()
-                cns = list()
-                rzdfs = list()
-                risks = list()
-                for xp in range(0, len(xs)):
-                    # get local last policy
-                    last_stt = stt[s] - xs[xp]  # last state given current state and decision
-                    last_stt_id = stt.index(last_stt)
-                    last_lcl_policy = last_stg_policy[last_stt_id]  # retrieve last policy from stage policies list
-                    # last lulc:
-                    last_lulc = last_lcl_policy[5]  # retrieve from last lcl policy
-                    # populate all possible decision sets:
-                    xds = all_xds[xp]
-                    # loop in all decision sets:
-                    for e in xds:
-                        # recursive section
-                        # find lulc:
-                        lulc_lcl = find_lulc(last_lulc, e, availareaf)
-                        #
-                        # find q:
-                        q_tpl = find_q(area, p_stg[t], pet_stg[t], lulc_lcl, soils, hy_param)
-                        # get values:
-                        q_lcl = q_tpl[0]  # array
-                        cn_lcl = q_tpl[1]
-                        rzdf_lcl = q_tpl[2]
-                        q90_lcl = q_tpl[3]
-                        qb_lcl = q_tpl[4]
-                        #
-                        # find costs:
-                        # here the simulations batch happens:
-                        c_lcl_xcfv = find_xc(lulc_lcl, area, cycle, oprt_data, e, availarea, inst_data)  # expansion cost
-                        #
-                        # scarcity cost batch
-                        c_lcl_scfv_dct = find_sc(q_lcl, wconsr[t - 1], trf[t - 1], sc_a_p[t - 1], sc_b_p[t - 1],
-                                                 sc_k_p[t -1], sc_e_p[t -1])
-                        c_lcl_scfv = c_lcl_scfv_dct['SC']  # scarcity cost
-                        sc_risk_lcl = c_lcl_scfv_dct['Risk']  # scarcity risk
-                        #
-                        # treatment cost batch:
-                        c_lcl_tcfv = find_tc(q_lcl, qb_lcl, wconsr[t - 1], lulc_lcl, tc_p_a, tc_p_b)  # treatment cost
-                        #
-                        # local costs in fv (scarcity, treatment, expansion):
-                        c_lcl_fv = (round(c_lcl_scfv + c_lcl_tcfv + c_lcl_xcfv, 2), (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv))
-                        c_lcl_xcpv = find_pv(c_lcl_xcfv, stg[t] - stg[0], dp_rr)  # get present value
-                        c_lcl_scpv = find_pv(c_lcl_scfv, stg[t] - stg[0], dp_rr)  # get present value
-                        c_lcl_tcpv = find_pv(c_lcl_tcfv, stg[t] - stg[0], dp_rr)  # get present value
-                        # total cost:
-                        c_lcl = round(c_lcl_xcpv + c_lcl_scpv + c_lcl_tcpv, 2)
-                        # local costs in pv (scarcity, treatment, expansion):
-                        c_lcl_pv = (c_lcl, (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv))
-                        # recursion happens here:
-                        f_lcl = round(c_lcl + last_lcl_policy[2], 2) # index 2 is the f value index
-                        # append to DP lists:
-                        fps.append(f_lcl)
-                        xps.append(xs[xp])
-                        xdps.append(e[:])
-                        lulcps.append(lulc_lcl[:])
-                        last_sttps.append(last_stt)
-                        cfvs.append(c_lcl_fv[:])
-                        cpvs.append(c_lcl_pv[:])
-                        lps.append(last_lcl_policy[:])
-                        q90s.append(q90_lcl)
-                        cns.append(cn_lcl)
-                        rzdfs.append(rzdf_lcl)
-                        risks.append(sc_risk_lcl)
-                        #
-                        # baseline checker:
-                        if s == 0 and sum(e) == 0:
-                            c0.append((f_lcl, c_lcl_fv[0], c_lcl_pv[0],
-                                       (c_lcl_scfv, c_lcl_tcfv, c_lcl_xcfv),
-                                       (c_lcl_scpv, c_lcl_tcpv, c_lcl_xcpv), (q90_lcl, cn_lcl, rzdf_lcl), sc_risk_lcl))
-                        #
-                        #
-                        # append to outer lists:
-                        cn_lst.append(cn_lcl)
-                        rzdf_lst.append(rzdf_lcl)
-                        q90_lst.append(q90_lcl)
-                        #
-                        # update counter:
-                        dp_counter = dp_counter + 1
-                        # printing section:
-                        aux_flt = time.time() - dp_t1
-                        log_str = get_dp_status(dp_counter, size, aux_flt)
-                        log_lst.append(log_str)
-                        if prt_sts:
-                            print(log_str)
-                # get the best f from list:
-                best_f = min(fps)
-                # get best f index:
-                f_id = fps.index(best_f)
-                #
-                # retrieve best variables using f_id:
-                best_x = xps[f_id]  # best x
-                best_xd = xdps[f_id]  # best xd decision set
-                best_lcl_lulc = lulcps[f_id]  # best lulc
-                best_cfv = cfvs[f_id]
-                best_cpv = cpvs[f_id]
-                best_q90 = q90s[f_id]
-                best_cn = cns[f_id]
-                best_rzdf = rzdfs[f_id]
-                best_risk = risks[f_id]
-                #
-                # get las best state
-                last_stt = stt[s] - best_x
-                #
-                # local best stage policy: f, state, decision
-                lcl_best_policy = (t, stt[s], best_f, best_x, best_xd, best_lcl_lulc, last_stt, best_cfv, best_cpv,
-                                   best_q90, best_cn, best_rzdf, best_risk)
-                stg_best_policy.append(lcl_best_policy)
-                #
-                # printing section:
-                df = pd.DataFrame({'Decision X': xps, 'Decision set Xd': xdps, 'f value': fps, 'LULC': lulcps})
-                log_str = df.to_string()
-                log_lst.append('')
-                log_lst.append(log_str)
-                log_lst.append('')
-                aux_tpl = ('State S(t)', 'Best f value', 'Best Decision X', 'Best Decision Set Xd', 'Best LULC',
-                           'Coming from S(t-1)', 'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-                df = pd.DataFrame({'Best Policy': lcl_best_policy[1:]}, index=aux_tpl)
-                log_str = df.to_string()
-                log_lst.append(log_str)
-                #
-                # clear loop lists:
-                fps.clear()
-                xps.clear()
-                xdps.clear()
-                lulcps.clear()
-                last_sttps.clear()
-                cfvs.clear()
-                cpvs.clear()
-                q90s.clear()
-                cns.clear()
-                rzdfs.clear()
-                risks.clear()
-                lps.clear()
-        # append
-        glb_policy[t] = tuple(stg_best_policy[:])
-        # clear
-        stg_best_policy.clear()
+                i0, i1, f_id = stg_ids[s]
+                if f_id < 0:
+                    continue
+                xs = list(stt[:s + 1])
+                if t == 1:
+                    xs = stt[s]
+                # update counter:
+                dp_counter = dp_counter + (i1 - i0)
+                stg_events.append({'Event': 'state', 't': t, 's': s, 'S': stt[s], 'Xps': xs, 'Batch': dp_counter,
+                                   'Size': size, 'X': cand['X'][i0:i1].tolist(),
+                                   'Xd': cand['Xd'][i0:i1].tolist(), 'f': ev['F'][i0:i1].tolist(),
+                                   'LULC': ev['LULC'][i0:i1].tolist(), 'Best': get_policy_tuple(glb_tbl, t, s)[1:]})
+            append_dp_log(dp_log, stg_events)
+            #
+            # save stage checkpoint:
+            if rundir is not None:
+                chk = {'Stage': t, 'Run_ts': run_ts, 'Stg': stg, 'Stt': stt, 'Policy': glb_tbl[t].copy(),
+                       'Baseline': c0[-1], 'CN': ev['CN'].tolist(), 'Rzdf': ev['Rzdf'].tolist(),
+                       'q90': ev['q90'].tolist(), 'Counter': dp_counter}
+                save_dp_checkpoint(rundir, chk)
+            # save the stage hydrology store:
+            if store:
+                save_hydro_store(rundir, t, hy_key, q_cache['Keep'])
+                q_cache['Keep'] = dict()
+    finally:
+        if pool is not None:
+            pool.shutdown()
     #
     #
     # policies printing section:
-    for t in range(0, len(glb_policy)):
+    aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
+               'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
+    for t in range(0, len(stg)):
         log_str = '\nStage #' + str(t) + ' (' + str(stg[t]) + '):'
-        aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
-                   'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-        df = pd.DataFrame(glb_policy[t], columns=aux_tpl)
+        if t == 0:
+            stg_policy = [policy0]
+        else:
+            stg_policy = [get_policy_tuple(glb_tbl, t, s) for s in range(0, len(stt)) if glb_tbl['Set'][t, s]]
+        df = pd.DataFrame(stg_policy, columns=aux_tpl)
         policy_lst.append(log_str)
         policy_lst.append(df.to_string())
     #
     #
-    # Retrieve from global policies the best path:
+    # Retrieve from global policies the best path (backward pointer walk):
     log_str = '\n\n****** DP Backward Look ******\n'
     policy_lst.append(log_str)
+    path_ids = get_dp_path(glb_tbl, stg)
+    path = [policy0]
+    for t in range(1, len(stg)):
+        path.append(get_policy_tuple(glb_tbl, t, path_ids[t]))
     #
-    # output lists:
-    f_out = list()
-    stt_out = list()
-    x_out = list()
-    xd_out = list()
-    lulc_out = list()
-    cfv_out = list()
-    cpv_out = list()
-    q90_out = list()
-    cn_out = list()
-    rzdf_out = list()
-    risk_out = list()
-    #
-    #
-    # backward loop:
+    # printing section:
     for t in range(len(stg) - 1, -1, -1):
-        # printing section:
         log_str = '\nStage #' + str(t) + '\t(' + str(stg[t]) + ')'
         policy_lst.append(log_str)
-        # get data from stage policy
-        aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
-                   'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
-        df = pd.DataFrame(glb_policy[t], columns=aux_tpl)
-        df_t = df.T
-        # get ss, xs, and fs , etc values:
-        stg_ss = tuple(df_t.values[1])
-        stg_fs = tuple(df_t.values[2])
-        stg_xs = tuple(df_t.values[3])
-        stg_xds = tuple(df_t.values[4])
-        stg_lulcs = tuple(df_t.values[5])
-        stg_cfvs = tuple(df_t.values[7])
-        stg_cpvs = tuple(df_t.values[8])
-        stg_q90s = tuple(df_t.values[9])
-        stg_cns = tuple(df_t.values[10])
-        stg_rzdfs = tuple(df_t.values[11])
-        stg_risks = tuple(df_t.values[12])
-        # start in the last stage:
+        p = path[t]
         if t == len(stg) - 1:
-            # use best f to find the starting place
-            # find best f:
-            best_f = min(stg_fs)
-            #
-            # find best f id:
-            best_f_id = stg_fs.index(best_f)
-            #
-            # find corresponding S and X:
-            best_stt = stg_ss[best_f_id]
-            best_x = stg_xs[best_f_id]
-            best_xd = stg_xds[best_f_id]
-            best_lulc = stg_lulcs[best_f_id]
-            best_cfv = stg_cfvs[best_f_id]
-            best_cpv = stg_cpvs[best_f_id]
-            best_q90 = stg_q90s[best_f_id]
-            best_cn = stg_cns[best_f_id]
-            best_rzdf = stg_rzdfs[best_f_id]
-            best_risk = stg_risks[best_f_id]
-            #
-            # printing section,
-            log_str = 'Best f=' + str(best_f) + '\tf id=' + str(best_f_id) + '\tS=' + str(best_stt) + \
-                      '\tX=' + str(best_x) + '\tXd=' + str(best_xd) + '\tLULC=' + str(best_lulc) +\
-                      '\tC* FV=' + str(best_cfv) + '\tC* PV=' + str(best_cpv) + '\tq90* =' + str(best_q90) + \
-                      '\tCN*=' + str(best_cn) + '\tRzdf*=' + str(best_rzdf) + '\tRisk*=' + str(best_risk)
-            policy_lst.append(log_str)
+            log_str = 'Best f=' + str(p[2]) + '\tf id=' + str(path_ids[t]) + '\tS=' + str(p[1])
         else:
-            # use state to find path
-            best_stt = best_last_stt
-            best_stt_id = stg_ss.index(best_stt)
-            best_f = stg_fs[best_stt_id]
-            best_x = stg_xs[best_stt_id]
-            best_xd = stg_xds[best_stt_id]
-            best_lulc = stg_lulcs[best_stt_id]
-            best_cfv = stg_cfvs[best_stt_id]
-            best_cpv = stg_cpvs[best_stt_id]
-            best_q90 = stg_q90s[best_stt_id]
-            best_cn = stg_cns[best_stt_id]
-            best_rzdf = stg_rzdfs[best_stt_id]
-            best_risk = stg_risks[best_stt_id]
-            #
-            # printing section
-            log_str = 'S=' + str(best_stt) + '\tS id=' + str(best_stt_id) + \
-                      '\tf=' + str(best_f) + '\tX=' + str(best_x) + '\tXd=' + str(best_xd) + \
-                      '\tLULC=' + str(best_lulc) + '\tC* FV=' + str(best_cfv) + '\tC* PV=' + str(best_cpv) + \
-                      '\tq90* =' + str(best_q90) + '\tCN*=' + str(best_cn) + \
-                      '\tRzdf*=' + str(best_rzdf) + '\tRisk*=' + str(best_risk)
-            policy_lst.append(log_str)
-        # store f and S in output lists
-        f_out.insert(0, best_f)
-        stt_out.insert(0, best_stt)
-        x_out.insert(0, best_x)
-        xd_out.insert(0, best_xd)
-        lulc_out.insert(0, best_lulc)
-        cfv_out.insert(0, best_cfv)
-        cpv_out.insert(0, best_cpv)
-        q90_out.insert(0, best_q90)
-        cn_out.insert(0, best_cn)
-        rzdf_out.insert(0, best_rzdf)
-        risk_out.insert(0, best_risk)
-        # find last S(t-1)
-        best_last_stt = best_stt - best_x
-    #
-    #
+            log_str = 'S=' + str(p[1]) + '\tS id=' + str(path_ids[t]) + '\tf=' + str(p[2])
+        log_str = log_str + '\tX=' + str(p[3]) + '\tXd=' + str(p[4]) + '\tLULC=' + str(p[5]) + \
+                  '\tC* FV=' + str(p[7]) + '\tC* PV=' + str(p[8]) + '\tq90* =' + str(p[9]) + \
+                  '\tCN*=' + str(p[10]) + '\tRzdf*=' + str(p[11]) + '\tRisk*=' + str(p[12])
+        policy_lst.append(log_str)
     #
     # output settings
-    # 'Baseline' is: (F, FV, PV, STXfv, STXpv)
-    out_dct = {'Stage t': stg,
-               'State S(t)': stt_out,
-               'Cost f(t) $PV': f_out,
-               'Decision X(t)': x_out,
-               'Decision Set Xd(t)': xd_out,
-               'LULC %':lulc_out,
-               'Costs STX $FV': cfv_out,
-               'Costs STX $PV': cpv_out,
-               'q90': q90_out,
-               'CN': cn_out,
-               'Rzdf': rzdf_out,
-               'Risk': risk_out,
-               'Baseline': c0}
+    out_dct = get_dp_outdct(stg, path, c0)
     # dp_output = (stg, stt_out, f_out, x_out, xd_out, lulc_out, cfv_out, cpv_out, c0)
-    df = pd.DataFrame(out_dct)
-    output_lst.append('\nGeneral outlook:')
-    output_str = df[['Stage t', 'State S(t)', 'Cost f(t) $PV']].to_string()
-    output_lst.append(output_str)
-    output_lst.append('\nDecisions outlook:')
-    output_str = df[['Stage t', 'State S(t)', 'Decision X(t)', 'Decision Set Xd(t)']].to_string()
-    output_lst.append(output_str)
-    output_lst.append('\nLULC change outlook:')
-    output_str = df[['Stage t', 'State S(t)', 'LULC %']].to_string()
-    output_lst.append(output_str)
-    output_lst.append('\nCosts outlook:')
-    output_str = df[['Stage t', 'State S(t)', 'Costs STX $FV', 'Costs STX $PV']].to_string()
-    output_lst.append(output_str)
-    output_lst.append('\nHydrological outlook:')
-    output_str = df[['Stage t', 'q90', 'CN', 'Rzdf', 'Risk']].to_string()
-    output_lst.append(output_str)
-    output_lst.append('\nBaseline outlook (f, fv, pv, (stx_fv), (stx_pv), (q90, CN, Rzdf), Risk):')
-    output_str = df[['Stage t', 'Baseline']].to_string()
-    output_lst.append(output_str)
+    output_lst = output_lst + get_dp_output_lst(out_dct)
     #
-    # footnote prints:
-    log_str = '\n\n****** END OF DP PROCEDURE ******\n\n'
-    log_lst.append(log_str)
+    # footnote log:
+    append_dp_log(dp_log, [{'Event': 'end', 't': len(stg), 'Procedure': 'DP'}])
     # find DP elapsed time:
     dp_t2 = time.time()
     dp_procedure_et = dp_t2 - dp_t1
     header_str = 'Elapsed time: ' + str(dp_procedure_et) + ' seconds'
     header_lst.append(header_str)
+    header_lst.append(get_q_cache_report(q_cache))
+    if store_dir is not None:
+        header_lst.append('\nRe-cost from the hydrology store of: {}'.format(store_dir))
     #
     # DP logs:
-    out_logs = (header_lst, param_lst, output_lst, policy_lst, log_lst)
+    out_logs = (header_lst, param_lst, output_lst, policy_lst, dp_log)
     #
     # Outer data:
     out_cloud = {'CN':cn_lst[:], 'Rzdf':rzdf_lst[:], 'q90':q90_lst[:]}
     #
     return out_dct, out_logs, run_ts, out_cloud
 
+
+
+def snap_adp(v, res):
+    """
+    snap approximate DP decision vectors to the resolution lattice
+    :param v: array of decision vectors (S(t-1), nbsf, nbsp, nbsc)
+    :param res: state resolution in %
+    :return: array of decision vectors
+    """
+    return np.round(np.round(v / res) * res, 6)
+
+
+def get_adp_directions(t, fix_s):
+    """
+    get the pattern search directions of the approximate DP decision vector (S(t-1), nbsf, nbsp, nbsc)
+    :param t: stage index (the stage 1 comes from S(0) = 0 only)
+    :param fix_s: boolean to keep S(t) = S(t-1) + X fixed
+    :return: 2d array of directions
+    """
+    dirs = list()
+    # exchange expansion between NBS types (same X):
+    for i in range(1, 4):
+        for j in range(1, 4):
+            if i != j:
+                aux_lst = [0, 0, 0, 0]
+                aux_lst[i] = 1
+                aux_lst[j] = -1
+                dirs.append(aux_lst)
+    # change the expansion of one NBS type:
+    if t > 1 or not fix_s:
+        for i in range(1, 4):
+            aux_lst = [0, 0, 0, 0]
+            aux_lst[i] = 1
+            if t > 1 and fix_s:
+                aux_lst[0] = -1  # same S(t): expand more coming from a lower S(t-1)
+            dirs.append(aux_lst)
+            dirs.append([-e for e in aux_lst])
+    # change the last state only:
+    if t > 1 and not fix_s:
+        dirs.append([1, 0, 0, 0])
+        dirs.append([-1, 0, 0, 0])
+    return np.array(dirs, dtype=float)
+
+
+def get_adp_candidates(v, vf, s_ids=None):
+    """
+    get approximate DP stage candidates. The last stage value function f(S) and LULC are
+    linearly interpolated between the knot states
+    :param v: 2d array of decision vectors (S(t-1), nbsf, nbsp, nbsc)
+    :param vf: last stage value function dict of knot arrays ('S', 'f', 'LULC')
+    :param s_ids: array of knot state indexes (zeros if None)
+    :return: dict of candidate arrays (see get_stage_candidates)
+    """
+    if s_ids is None:
+        s_ids = np.zeros(len(v), dtype=int)
+    last_lulc = np.column_stack([np.interp(v[:, 0], vf['S'], vf['LULC'][:, j]) for j in range(0, 8)])
+    cand = {'S_id': s_ids,
+            'X': np.round(np.sum(v[:, 1:], axis=1), 6),
+            'Xd': v[:, 1:],
+            'Last_id': np.full(len(v), -1, dtype=int),  # S(t-1) is not a knot state
+            'Last_S': v[:, 0],
+            'Last_LULC': last_lulc,
+            'Last_f': np.interp(v[:, 0], vf['S'], vf['f'])}
+    return cand
+
+
+def eval_adp(t, v, dpp, vf, adp, basis=None, cache=None, s_ids=None):
+    """
+    evaluate approximate DP stage candidates (see eval_stage) and account them in the run records
+    :param t: stage index
+    :param v: 2d array of decision vectors (S(t-1), nbsf, nbsp, nbsc)
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param vf: last stage value function dict (see get_adp_candidates)
+    :param adp: dict of run records ('Evals', 'CN', 'Rzdf', 'q90')
+    :param basis: stage HRU response basis dict (see get_stage_basis)
+    :param cache: hydrology memo cache dict (see get_q_cache)
+    :param s_ids: array of knot state indexes
+    :return: dict of candidate arrays and dict of evaluated candidate arrays (see eval_stage)
+    """
+    cand = get_adp_candidates(v, vf, s_ids)
+    ev = eval_stage(t, cand, dpp, basis=basis, cache=cache)
+    adp['Evals'] = adp['Evals'] + len(v)
+    adp['CN'] = adp['CN'] + ev['CN'].tolist()
+    adp['Rzdf'] = adp['Rzdf'] + ev['Rzdf'].tolist()
+    adp['q90'] = adp['q90'] + ev['q90'].tolist()
+    return cand, ev
+
+
+def search_adp(t, v, f, dpp, vf, adp, res, step, fix_s=True, basis=None, cache=None, maxiter=200):
+    """
+    refine approximate DP decision vectors by a pattern (compass) search on the resolution lattice.
+    All vectors move at once, one stage candidates batch by iteration. The step of a vector
+    is halved down to the resolution when no direction improves its f value
+    :param t: stage index
+    :param v: 2d array of starting decision vectors (S(t-1), nbsf, nbsp, nbsc)
+    :param f: array of f values of the starting vectors
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param vf: last stage value function dict (see get_adp_candidates)
+    :param adp: dict of run records (see eval_adp)
+    :param res: state resolution in %
+    :param step: starting step in %
+    :param fix_s: boolean to keep S(t) fixed (the state is free otherwise)
+    :param basis: stage HRU response basis dict (see get_stage_basis)
+    :param cache: hydrology memo cache dict (see get_q_cache)
+    :param maxiter: max number of iterations
+    :return: array of refined decision vectors and array of their f values
+    """
+    v = v.copy()
+    f = f.copy()
+    dirs = get_adp_directions(t, fix_s)
+    steps = np.full(len(v), float(step))
+    for i in range(0, maxiter):
+        active = np.flatnonzero(steps > 0)
+        if len(active) == 0:
+            break
+        trials = v[active][:, np.newaxis, :] + steps[active][:, np.newaxis, np.newaxis] * dirs[np.newaxis, :, :]
+        trials = snap_adp(trials, res).reshape(-1, 4)
+        rows = np.repeat(active, len(dirs))
+        # feasible vectors: no negative values, S(t) up to 100% and S(t-1) = 0 in the stage 1
+        ok = np.all(trials >= 0, axis=1) & (np.sum(trials, axis=1) <= 100 + 1e-6)
+        if t == 1:
+            ok = ok & (trials[:, 0] == 0)
+        trials = trials[ok]
+        rows = rows[ok]
+        lcl_f = np.zeros(0)
+        if len(trials) > 0:
+            lcl_f = eval_adp(t, trials, dpp, vf, adp, basis=basis, cache=cache)[1]['F']
+        for r in active:
+            ids = np.flatnonzero(rows == r)
+            if len(ids) > 0:
+                best_id = ids[np.argmin(lcl_f[ids])]
+                if lcl_f[best_id] < f[r]:
+                    v[r] = trials[best_id]
+                    f[r] = lcl_f[best_id]
+                    continue
+            # no improvement: refine the step
+            if steps[r] <= res:
+                steps[r] = 0
+            else:
+                steps[r] = max(res, np.round(steps[r] / 2 / res) * res)
+    return v, f
+
+
+def get_adp_seeds(t, s, tbl, knots, res):
+    """
+    get starting decision vectors of an approximate DP state off the knots. The expansion
+    fractions of the best policy of the bracketing knot states are used, plus the do-nothing decision
+    :param t: stage index
+    :param s: state S(t) in %
+    :param tbl: approximate DP policy table (see get_policy_table)
+    :param knots: array of knot states
+    :param res: state resolution in %
+    :return: 2d array of decision vectors (S(t-1), nbsf, nbsp, nbsc)
+    """
+    k = int(np.clip(np.searchsorted(knots, s), 1, len(knots) - 1))
+    seeds = list()
+    if t > 1:
+        seeds.append((s, 0, 0, 0))
+    for k_id in (k - 1, k):
+        xd = tbl['Xd'][t, k_id].astype(float)
+        x = float(np.sum(xd))
+        if x <= 0:
+            xd = np.ones(3)
+            x = 3.0
+        lcl_x = min(x, s)
+        if t == 1:
+            lcl_x = s
+        lcl_xd = snap_adp(xd * lcl_x / x, res)
+        # keep S(t) on the lattice:
+        lcl_xd[np.argmax(lcl_xd)] = lcl_xd[np.argmax(lcl_xd)] + (lcl_x - np.sum(lcl_xd))
+        seeds.append((s - lcl_x, lcl_xd[0], lcl_xd[1], lcl_xd[2]))
+    return snap_adp(np.array(seeds, dtype=float), res)
+
+
+def run_adp(setts, data, res=0.5, prt_sts=False, basis=True, cache_size=2048, run_ts=None):
+    """
+    approximate DP for NBS expansion optimization at a sub-percent state resolution.
+    Only the states of the settings (knots) are solved in each stage. The last stage value function
+    f(S) and LULC are linearly interpolated between the knots, so S(t-1) and the expansion
+    fractions are optimized on the resolution lattice by a pattern search (see search_adp),
+    starting from the best decision of the knots grid. The best path is traced backwards
+    by the same search on the interpolated value functions and then simulated exactly (see eval_policy)
+    :param setts: tuple with dp parameters (settings). The states are the knots
+    :param data: dp data
+    :param res: state resolution in % (100 and the knots step must be multiples of it)
+    :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param cache_size: max number of hydrology results in the LRU memo cache. 0 disables it
+    :param run_ts: run timestamp string (a new one is taken if None)
+    :return: same as run_dp
+    """
+    import time
+
+    # get run timestamp
+    if run_ts is None:
+        run_ts = stringsf.nowsep()
+    #
+    # get parameters:
+    dpp = get_dp_param(setts, data)
+    stg = dpp['Stg']  # get stages tuple
+    stt = dpp['Stt']  # get states tuple (knots)
+    knots = np.array(stt, dtype=float)
+    if not (np.isclose(100 / res, np.round(100 / res)) and np.isclose(dpp['Y'] / res, np.round(dpp['Y'] / res))):
+        raise ValueError('ADP resolution {} must divide 100 and the states step {}'.format(res, dpp['Y']))
+    grid_size = size_dp_grid(int(np.round(100 / res)) + 1, len(stg))
+    #
+    # create lists to store repost sections:
+    header_lst = ['\n\n****** PLANS - APPROXIMATE DYNAMIC PROGRAMMING PROCEDURE ******\n\n']
+    param_lst = get_dp_header(run_ts, dpp)
+    param_lst.append('\nApproximate DP:\nState resolution (%): {}\nKnot states: {}\n'
+                     'Full DP grid size at the resolution: {} batches\n'.format(res, len(stt), grid_size))
+    output_lst = ['\n\n\nDP OUTPUT\n\n']
+    policy_lst = ['\n\n\nDP GLOBAL POLICY OUTLOOK\n\n']
+    dp_log = list()  # structured log (see render_dp_log)
+    #
+    # knots policy table. Stage 0 has only the state 0:
+    glb_tbl = get_policy_table(len(stg), len(stt), dec_type=float)
+    glb_tbl['Set'][0, 0] = True
+    glb_tbl['LULC'][0, 0] = dpp['Lulc0']
+    vfs = [{'S': np.zeros(1), 'f': np.zeros(1), 'LULC': np.array([dpp['Lulc0']], dtype=float)}]
+    #
+    adp = {'Evals': 0, 'CN': list(), 'Rzdf': list(), 'q90': list()}
+    q_cache = get_q_cache(cache_size)
+    stg_bases = [None] * len(stg)
+    #
+    dp_t1 = time.time()
+    #
+    # forward movement loop on the knots:
+    for t in range(1, len(stg)):
+        evals0 = adp['Evals']
+        if basis:
+            stg_bases[t] = find_stage_basis(dpp, t)
+        # starting decisions: the best of the knots grid (exact on the knots)
+        cand = get_stage_candidates(stt, dpp['All_xds'], glb_tbl[t - 1])
+        v = np.column_stack((cand['Last_S'], cand['Xd'])).astype(float)
+        ev = eval_adp(t, v, dpp, vfs[t - 1], adp, basis=stg_bases[t], cache=q_cache)[1]
+        ids = np.array([lcl_ids[2] for lcl_ids in get_stage_best(len(stt), cand, ev)], dtype=int)
+        # refine S(t-1) and expansion fractions on the resolution lattice:
+        v, f = search_adp(t, v[ids], ev['F'][ids], dpp, vfs[t - 1], adp, res, dpp['Y'], fix_s=True,
+                          basis=stg_bases[t], cache=q_cache)
+        cand, ev = eval_adp(t, v, dpp, vfs[t - 1], adp, basis=stg_bases[t], cache=q_cache,
+                            s_ids=np.arange(0, len(stt)))
+        set_stage_table(glb_tbl, t, stt, cand, ev, tuple((k, k + 1, k) for k in range(0, len(stt))))
+        vfs.append({'S': knots, 'f': glb_tbl['f'][t].copy(), 'LULC': glb_tbl['LULC'][t].copy()})
+        #
+        # log section:
+        event = {'Event': 'search', 't': t, 'Stage': stg[t], 'Evals': adp['Evals'] - evals0,
+                 'S': knots.tolist(), 'f': glb_tbl['f'][t].tolist(), 'Xd': glb_tbl['Xd'][t].tolist()}
+        append_dp_log(dp_log, [event])
+        if prt_sts:
+            print('Stage #{} ({})\tCandidate evaluations: {}\tElapsed time: {:.1f} secs'.format(
+                t, stg[t], event['Evals'], time.time() - dp_t1))
+    #
+    # backward movement loop: trace the best path off the knots
+    last_t = len(stg) - 1
+    vs = [None] * len(stg)
+    k = int(np.argmin(glb_tbl['f'][last_t]))
+    v = np.array([[glb_tbl['Last_S'][last_t, k]] + glb_tbl['Xd'][last_t, k].tolist()])
+    v, f = search_adp(last_t, v, glb_tbl['f'][last_t, k:k + 1], dpp, vfs[last_t - 1], adp, res, dpp['Y'],
+                      fix_s=False, basis=stg_bases[last_t], cache=q_cache)
+    vs[last_t] = v[0]
+    for t in range(last_t - 1, 0, -1):
+        v = get_adp_seeds(t, vs[t + 1][0], glb_tbl, knots, res)
+        f = eval_adp(t, v, dpp, vfs[t - 1], adp, basis=stg_bases[t], cache=q_cache)[1]['F']
+        best_id = int(np.argmin(f))
+        v, f = search_adp(t, v[best_id:best_id + 1], f[best_id:best_id + 1], dpp, vfs[t - 1], adp, res,
+                          dpp['Y'], fix_s=True, basis=stg_bases[t], cache=q_cache)
+        vs[t] = v[0]
+    #
+    # simulate the path exactly:
+    pol = [(0, 0, 0)]
+    path_stt = [0.0]
+    for t in range(1, len(stg)):
+        pol.append(tuple(vs[t][1:].tolist()))
+        path_stt.append(round(path_stt[-1] + sum(pol[t]), 6))
+    path, c0 = eval_policy(dpp, pol, tuple(path_stt), basis=basis, cache=q_cache)
+    #
+    # policies printing section:
+    aux_tpl = ('Stage t', 'State S(t)', 'f value', 'Decision X*', 'Decision set Xd* ', 'LULC*', 'Last State S(t-1)',
+               'Costs* in FV', 'Costs* in PV', 'q90 (m3/s)', 'CN', 'Rzdf', 'Risk')
+    for t in range(1, len(stg)):
+        stg_policy = [get_policy_tuple(glb_tbl, t, s) for s in range(0, len(stt))]
+        policy_lst.append('\nStage #' + str(t) + ' (' + str(stg[t]) + ') knots:')
+        policy_lst.append(pd.DataFrame(stg_policy, columns=aux_tpl).to_string())
+    policy_lst.append('\n\n****** ADP Backward Look ******\n')
+    policy_lst.append(pd.DataFrame(path, columns=aux_tpl).to_string())
+    #
+    out_dct = get_dp_outdct(stg, path, c0)
+    output_lst = output_lst + get_dp_output_lst(out_dct)
+    #
+    append_dp_log(dp_log, [{'Event': 'end', 't': len(stg), 'Procedure': 'APPROXIMATE DP'}])
+    header_lst.append('Elapsed time: ' + str(time.time() - dp_t1) + ' seconds')
+    header_lst.append('\nCandidate evaluations: {} ({:.4f}% of the full DP grid at the resolution)'.format(
+        adp['Evals'], 100 * adp['Evals'] / grid_size))
+    header_lst.append(get_q_cache_report(q_cache))
+    out_logs = (header_lst, param_lst, output_lst, policy_lst, dp_log)
+    out_cloud = {'CN': adp['CN'], 'Rzdf': adp['Rzdf'], 'q90': adp['q90']}
+    return out_dct, out_logs, run_ts, out_cloud
+
+
+def get_band_mask(stt, path_s, band):
+    """
+    get the allowed states by stage within a band around a path of states
+    :param stt: tuple of states
+    :param path_s: list of path states by stage (stage 0 to last stage)
+    :param band: band half width, in % (same units of states)
+    :return: list of boolean arrays of the allowed states by stage
+    """
+    aux_arr = np.array(stt)
+    stt_mask = list()
+    for t in range(0, len(path_s)):
+        s_mask = np.abs(aux_arr - path_s[t]) <= band
+        s_mask[0] = True  # baseline scenario
+        stt_mask.append(s_mask)
+    return stt_mask
+
+
+def get_band_edge(stt, stt_mask, path_s):
+    """
+    check if a path touches the edge of its band of allowed states (a better path may lie out of the band)
+    :param stt: tuple of states
+    :param stt_mask: list of boolean arrays of the allowed states by stage (see get_band_mask)
+    :param path_s: list of path states by stage
+    :return: boolean
+    """
+    for t in range(1, len(path_s)):
+        s = stt.index(path_s[t])
+        for lcl_s in (s - 1, s + 1):
+            if 0 <= lcl_s < len(stt) and not stt_mask[t][lcl_s]:
+                return True
+    return False
+
+
+def run_mrdp(setts, data, fine=1, band=10, niter=1, prt_sts=False, basis=True, workers=None, cache_size=2048,
+             run_ts=None):
+    """
+    coarse-to-fine multi-resolution DP. The DP is solved on the settings states (coarse) and then
+    re-solved with finer state steps only within a band of states around the best path of the last level
+    :param setts: tuple with dp parameters (settings) of the coarse level
+    :param data: dp data
+    :param fine: index of Y (state step) of the fine level (see set_dp) or tuple of indexes by level
+    :param band: band half width around the last level path, in % (same units of states)
+    :param niter: max number of runs of the finest level. It is re-solved around its own path while the path
+    touches the edge of the band
+    :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param workers: number of worker processes (see run_dp)
+    :param cache_size: size of the hydrology memo cache (see run_dp)
+    :param run_ts: run timestamp string (a new one is taken if None)
+    :return: same as run_dp, from the finest level run
+    """
+    import time
+
+    mr_t1 = time.time()
+    # get run timestamp
+    if run_ts is None:
+        run_ts = stringsf.nowsep()
+    stg = setts[0]
+    if isinstance(fine, int):
+        fine = (fine,)
+    levels = [None] + [fine_id for fine_id in fine[:-1]] + [fine[-1]] * niter
+    lvl_lst = list()
+    evals = 0
+    path_s = None
+    for i in range(0, len(levels)):
+        lvl = levels[i]
+        lcl_setts = setts
+        stt_mask = None
+        if lvl is not None:
+            lcl_setts = set_dp(stg[0], stg[1] - stg[0], len(stg), lvl)
+            stt_mask = get_band_mask(lcl_setts[1], path_s, band)
+        out = run_dp(lcl_setts, data, prt_sts=prt_sts, basis=basis, workers=workers, cache_size=cache_size,
+                     run_ts=run_ts, stt_mask=stt_mask)
+        # number of candidate evaluations of the level:
+        lcl_evals = len(out[3]['q90'])
+        evals = evals + lcl_evals
+        lvl_lst.append('Y = {}%:\t{} candidate evaluations\tf = {}\tStates: {}'.format(
+            lcl_setts[2], lcl_evals, out[0]['Cost f(t) $PV'][-1], out[0]['State S(t)']))
+        path_s = out[0]['State S(t)']
+        if i >= len(fine) and not get_band_edge(lcl_setts[1], stt_mask, path_s):
+            break  # the finest level path is inside its band
+    out_dct, out_logs, run_ts, out_cloud = out
+    #
+    header_lst = out_logs[0]
+    header_lst[0] = '\n\n****** PLANS - MULTI-RESOLUTION DYNAMIC PROGRAMMING PROCEDURE ******\n\n'
+    header_lst[1] = 'Elapsed time: ' + str(time.time() - mr_t1) + ' seconds'
+    header_lst.append('\nMulti-resolution levels (band of +/- {}% around the last level path):'.format(band))
+    header_lst = header_lst + lvl_lst
+    grid_size = lcl_setts[3]
+    # a wide band or extra iterations may evaluate more candidates than the full fine grid:
+    skipped = max(grid_size - evals, 0)
+    header_lst.append('Candidate evaluations: {} ({:.1f}% of the full fine grid)\tFull fine grid: {}\t'
+                      'Skipped: {} ({:.1f}%)'.format(evals, 100 * evals / grid_size, grid_size, skipped,
+                                                     100 * skipped / grid_size))
+    out_logs = (header_lst,) + out_logs[1:]
+    return out_dct, out_logs, run_ts, out_cloud
+
+
+def find_sc_param(w0, p0, e):
+    """
+    calibrate the scarcity cost models parameters by stage (same as plans2.calibrate_sc)
+    :param w0: array of full water demand in m3/d
+    :param p0: array of tariffs in $/m3
+    :param e: array of price elasticities of demand
+    :return: tuple of arrays (A, B, K, e)
+    """
+    w0 = np.asarray(w0, dtype=float)
+    p0 = np.asarray(p0, dtype=float)
+    e = np.asarray(e, dtype=float)
+    a = e * w0 / p0
+    b = w0 - (a * p0)
+    k = w0 / (p0 ** e)
+    return a, b, k, e
+
+
+def get_sweep_param(dpp, rr, trf_x=1, elast_x=1):
+    """
+    get the DP parameters of a sweep combination. The scarcity cost models are calibrated again
+    for the new tariffs and elasticities
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param rr: return rate in %
+    :param trf_x: tariff multiplier
+    :param elast_x: price elasticity multiplier
+    :return: dict of DP parameters
+    """
+    lcl_dpp = dict(dpp)
+    lcl_dpp['RR'] = rr
+    if trf_x != 1 or elast_x != 1:
+        lcl_dpp['Tariff'] = np.asarray(dpp['Tariff'], dtype=float) * trf_x
+        lcl_dpp['SC_param'] = find_sc_param(dpp['Wconsr'], lcl_dpp['Tariff'],
+                                            np.asarray(dpp['SC_param'][3], dtype=float) * elast_x)
+    return lcl_dpp
+
+
+def sweep_dp(setts, data, rrs, trf_xs=(1,), elast_xs=(1,), prt_sts=False, basis=True, store_dir=None):
+    """
+    solve the DP for every combination of return rate, tariff multiplier and elasticity multiplier.
+    The stages are solved in turn for all combinations, so the stage hydrology is simulated once
+    (unbounded stage hydrology memo shared by the combinations, dropped at the end of the stage) and only
+    the costs and the DP recursion are evaluated by combination
+    :param setts: tuple with dp parameters (settings)
+    :param data: dp data
+    :param rrs: iterable of return rates in %
+    :param trf_xs: iterable of tariff multipliers
+    :param elast_xs: iterable of price elasticity multipliers
+    :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param store_dir: run directory of a stored run to take the stage hydrology from (see recost_dp)
+    :return: sweep table (pandas DataFrame of the best path by combination) and list of DP output dicts
+    by combination (see get_dp_outdct)
+    """
+    import time
+    import itertools
+
+    dp_t1 = time.time()
+    dpp = get_dp_param(setts, data)
+    stg = dpp['Stg']
+    stt = dpp['Stt']
+    all_xds = dpp['All_xds']
+    hydro_p = dpp['Hydro_p']
+    q90_0 = hydro_p['q90']
+    policy0 = (0, 0, 0, 0, (0, 0, 0), dpp['Lulc0'], 0, (0, (0, 0, 0)), (0, (0, 0, 0)), q90_0, hydro_p['CN'],
+               hydro_p['Rzdf'], 0)
+    hy_key = None
+    if store_dir is not None:
+        hy_key = get_hydro_key(dpp)
+    #
+    # one set of DP parameters, policy table and baseline list by combination:
+    combos = list(itertools.product(rrs, trf_xs, elast_xs))
+    dpps = list()
+    tbls = list()
+    c0s = list()
+    for combo in combos:
+        dpps.append(get_sweep_param(dpp, *combo))
+        tbl = get_policy_table(len(stg), len(stt))
+        tbl['Set'][0, 0] = True
+        tbl['LULC'][0, 0] = dpp['Lulc0']
+        tbls.append(tbl)
+        c0s.append([(0, 0, 0, (0, 0, 0), (0, 0, 0), (q90_0, hydro_p['CN'], hydro_p['Rzdf']), 0)])
+    #
+    hits = 0
+    misses = 0
+    for t in range(1, len(stg)):
+        # stage hydrology shared by all combinations:
+        stg_basis = None
+        stg_cache = get_q_cache(None)
+        if store_dir is not None:
+            stg_cache['Memo'].update(load_hydro_store(store_dir, t, hy_key))
+        elif basis:
+            stg_basis = find_stage_basis(dpp, t)
+        for j in range(0, len(combos)):
+            cand = get_stage_candidates(stt, all_xds, tbls[j][t - 1])
+            ev = eval_stage(t, cand, dpps[j], basis=stg_basis, cache=stg_cache)
+            # baseline (do-nothing) scenario:
+            b_id = int(np.flatnonzero((cand['S_id'] == 0) & (np.sum(cand['Xd'], axis=1) == 0))[0])
+            base = get_cand_policy(t, stt, b_id, cand, ev)
+            c0s[j].append((base[2], base[7][0], base[8][0], base[7][1], base[8][1], (base[9], base[10], base[11]),
+                           base[12]))
+            set_stage_table(tbls[j], t, stt, cand, ev, get_stage_best(len(stt), cand, ev))
+        hits = hits + stg_cache['Hits']
+        misses = misses + stg_cache['Misses']
+        if prt_sts:
+            print(get_dp_status(t, len(stg) - 1, time.time() - dp_t1))
+    #
+    # best path by combination:
+    rows = list()
+    out_dcts = list()
+    for j in range(0, len(combos)):
+        path_ids = get_dp_path(tbls[j], stg)
+        path = [policy0] + [get_policy_tuple(tbls[j], t, path_ids[t]) for t in range(1, len(stg))]
+        out_dcts.append(get_dp_outdct(stg, path, c0s[j]))
+        row = {'RR (%)': combos[j][0], 'Tariff x': combos[j][1], 'Elast x': combos[j][2], 'f $PV': path[-1][2]}
+        for t in range(1, len(stg)):
+            row['S({})'.format(stg[t])] = path[t][1]
+        for t in range(1, len(stg)):
+            row['Xd({})'.format(stg[t])] = path[t][4]
+        rows.append(row)
+    sweep_df = pd.DataFrame(rows)
+    if prt_sts:
+        print('\nSweep of {} combinations. Elapsed time: {} seconds'.format(len(combos), time.time() - dp_t1))
+        print('Hydrology cache: {} hits, {} misses'.format(hits, misses))
+    return sweep_df, out_dcts
+
+
+def find_risk(f, measure='mean', alpha=0.9):
+    """
+    risk measure of costs across the ensemble members
+    :param f: array of costs (..., members)
+    :param measure: 'mean' (expected cost), 'cvar' (mean of the worst 1 - alpha members) or 'max' (worst member)
+    :param alpha: CVaR confidence level (0 to 1)
+    :return: array of risk measures (...)
+    """
+    if measure == 'mean':
+        return np.round(np.mean(f, axis=-1), 2)
+    elif measure == 'cvar':
+        size = np.shape(f)[-1]
+        tail = max(1, int(np.ceil((1 - alpha) * size)))
+        return np.round(np.mean(np.sort(f, axis=-1)[..., size - tail:], axis=-1), 2)
+    elif measure == 'max':
+        return np.max(f, axis=-1)
+    raise ValueError('unknown risk measure: {}'.format(measure))
+
+
+def get_member_param(dpp, p, pet):
+    """
+    get the DP parameters of a climate ensemble member
+    :param dpp: dict of DP parameters (see get_dp_param)
+    :param p: member precipitation time series
+    :param pet: member PET time series
+    :return: dict of DP parameters
+    """
+    lcl_dpp = dict(dpp)
+    lcl_dpp['P_stg'] = slice_ts(p, dpp['Stg'])
+    lcl_dpp['PET_stg'] = slice_ts(pet, dpp['Stg'])
+    if dpp['Hy_param'][6]:
+        lcl_dpp['Hy_warm'] = get_warm_basis(p, pet, dpp['Stg'], dpp['Soils'], dpp['Hy_param'])
+    return lcl_dpp
+
+
+def eval_members(t, cand, dpps, last_fm, basis=True):
+    """
+    evaluate all candidates of a DP stage for climate ensemble members
+    :param t: stage index
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param dpps: list of the members dict of DP parameters (see get_member_param)
+    :param last_fm: array of the members accumulated cost of the candidates predecessor (candidates, members)
+    :param basis: boolean to control the stage HRU response basis mode
+    :return: list of dicts of candidate arrays by member (see eval_stage)
+    """
+    evs = list()
+    for m in range(0, len(dpps)):
+        stg_basis = None
+        if basis:
+            stg_basis = find_stage_basis(dpps[m], t)
+        lcl_cand = dict(cand)
+        lcl_cand['Last_f'] = last_fm[:, m]
+        evs.append(eval_stage(t, lcl_cand, dpps[m], basis=stg_basis))
+    return evs
+
+
+def init_ens_worker(dpps, basis):
+    """
+    process pool initializer of the climate ensemble DP. Members data is shared once per worker
+    :param dpps: list of the members dict of DP parameters (see get_member_param)
+    :param basis: boolean to control the stage HRU response basis mode
+    :return: none
+    """
+    dp_worker.clear()
+    dp_worker['DPPs'] = dpps
+    dp_worker['Basis'] = basis
+
+
+def eval_members_worker(t, cand, m_ids, last_fm):
+    """
+    evaluate all candidates of a DP stage for a group of ensemble members in a process pool worker
+    :param t: stage index
+    :param cand: dict of candidate arrays (see get_stage_candidates)
+    :param m_ids: list of member indexes
+    :param last_fm: array of the group members accumulated cost of the candidates predecessor
+    :return: list of dicts of candidate arrays by member (see eval_stage)
+    """
+    dpps = [dp_worker['DPPs'][m] for m in m_ids]
+    return eval_members(t, cand, dpps, last_fm, basis=dp_worker['Basis'])
+
+
+def run_ens_dp(setts, data, p_ens, pet_ens, measure='mean', alpha=0.9, prt_sts=False, basis=True, workers=None,
+               seeds=None):
+    """
+    climate ensemble DP (robust NBS expansion). Every candidate is evaluated for all the climate members and
+    the DP picks, by state, the candidate of least risk measure of the members accumulated costs. The policy is
+    the same for all members
+    :param setts: tuple with dp parameters (settings)
+    :param data: dp data (the P and PET series are replaced by the ensemble members)
+    :param p_ens: array of precipitation time series (members, days) (see scenarios.climate_ensemble)
+    :param pet_ens: array of PET time series (members, days)
+    :param measure: risk measure of the members accumulated costs (see find_risk)
+    :param alpha: CVaR confidence level
+    :param prt_sts: boolean to control status screen printouts
+    :param basis: boolean to control the stage HRU response basis mode (one land phase run by stage)
+    :param workers: number of worker processes to evaluate the members (None or 1 runs serially).
+    Results are the same as the serial run. Scripts must protect the entry point with if __name__ == '__main__'
+    :param seeds: member seeds, for the members table
+    :return: DP output dict of the best path (see get_dp_outdct; costs are means of the members and f is the risk
+    measure) and members table (pandas DataFrame of the members costs along the best path and baseline)
+    """
+    import time
+
+    dp_t1 = time.time()
+    dpp = get_dp_param(setts, data)
+    stg = dpp['Stg']
+    stt = dpp['Stt']
+    all_xds = dpp['All_xds']
+    hydro_p = dpp['Hydro_p']
+    q90_0 = hydro_p['q90']
+    nmbr = len(p_ens)
+    dpps = [get_member_param(dpp, p_ens[m], pet_ens[m]) for m in range(0, nmbr)]
+    #
+    c0 = [(0, 0, 0, (0, 0, 0), (0, 0, 0), (q90_0, hydro_p['CN'], hydro_p['Rzdf']), 0)]
+    policy0 = (0, 0, 0, 0, (0, 0, 0), dpp['Lulc0'], 0, (0, (0, 0, 0)), (0, (0, 0, 0)), q90_0, hydro_p['CN'],
+               hydro_p['Rzdf'], 0)
+    glb_tbl = get_policy_table(len(stg), len(stt))
+    glb_tbl['Set'][0, 0] = True
+    glb_tbl['LULC'][0, 0] = dpp['Lulc0']
+    # members accumulated cost and scarcity cost (in PV) of the best policy by (stage, state):
+    fm_tbl = np.zeros((len(stg), len(stt), nmbr))
+    scm_tbl = np.zeros((len(stg), len(stt), nmbr))
+    base_fm = np.zeros(nmbr)
+    base_scm = np.zeros(nmbr)
+    #
+    # start the process pool (members data is shared once per worker):
+    pool = None
+    if workers is not None and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_ens_worker, initargs=(dpps, basis))
+    groups = np.array_split(np.arange(0, nmbr), min(nmbr, 4 * (workers or 1)))
+    #
+    ev_keys = ('FV', 'SC', 'TC', 'XC', 'C', 'Cpv', 'SCpv', 'TCpv', 'XCpv', 'q90', 'CN', 'Rzdf', 'Risk')
+    # the pool is shut down even if a stage fails:
+    try:
+        for t in range(1, len(stg)):
+            cand = get_stage_candidates(stt, all_xds, glb_tbl[t - 1])
+            last_fm = fm_tbl[t - 1][cand['Last_id']]
+            if pool is None:
+                evs = eval_members(t, cand, dpps, last_fm, basis=basis)
+            else:
+                futures = [pool.submit(eval_members_worker, t, cand, m_ids.tolist(), last_fm[:, m_ids])
+                           for m_ids in groups]
+                evs = list()
+                for future in futures:
+                    evs = evs + future.result()
+            #
+            # members arrays (candidates, members):
+            fm = np.column_stack([ev['F'] for ev in evs])
+            scm = np.column_stack([ev['SCpv'] for ev in evs])
+            # the stage policy is taken on the risk measure and the members means:
+            ev = {'LULC': evs[0]['LULC'], 'F': find_risk(fm, measure, alpha)}
+            for k in ev_keys:
+                ev[k] = np.mean(np.column_stack([lcl_ev[k] for lcl_ev in evs]), axis=-1)
+            #
+            # baseline checker:
+            b_id = int(np.flatnonzero((cand['S_id'] == 0) & (np.sum(cand['Xd'], axis=1) == 0))[0])
+            base = get_cand_policy(t, stt, b_id, cand, ev)
+            c0.append((base[2], base[7][0], base[8][0], base[7][1], base[8][1], (base[9], base[10], base[11]),
+                       base[12]))
+            base_fm = fm[b_id]
+            base_scm = base_scm + scm[b_id]
+            #
+            stg_ids = get_stage_best(len(stt), cand, ev)
+            set_stage_table(glb_tbl, t, stt, cand, ev, stg_ids)
+            for s in range(0, len(stt)):
+                f_id = stg_ids[s][2]
+                if f_id >= 0:
+                    fm_tbl[t, s] = fm[f_id]
+                    scm_tbl[t, s] = scm_tbl[t - 1, cand['Last_id'][f_id]] + scm[f_id]
+            if prt_sts:
+                print(get_dp_status(t, len(stg) - 1, time.time() - dp_t1))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    #
+    # best path and members costs along it:
+    path_ids = get_dp_path(glb_tbl, stg)
+    path = [policy0] + [get_policy_tuple(glb_tbl, t, path_ids[t]) for t in range(1, len(stg))]
+    out_dct = get_dp_outdct(stg, path, c0)
+    if seeds is None:
+        seeds = list(range(0, nmbr))
+    s_last = path_ids[-1]
+    members_df = pd.DataFrame({'Member': np.arange(0, nmbr), 'Seed': list(seeds),
+                               'f $PV': fm_tbl[len(stg) - 1, s_last], 'SC $PV': scm_tbl[len(stg) - 1, s_last],
+                               'Baseline f $PV': base_fm, 'Baseline SC $PV': base_scm})
+    if prt_sts:
+        print('\nClimate ensemble of {} members. Elapsed time: {} seconds'.format(nmbr, time.time() - dp_t1))
+        print('Best path {} f = {}\tExpected f = {}\tCVaR({}) f = {}'.format(
+            measure, path[-1][2], find_risk(members_df['f $PV'].values, 'mean'), alpha,
+            find_risk(members_df['f $PV'].values, 'cvar', alpha)))
+    return out_dct, members_df
@@ -143,6 +143,149 @@ def find_cfc(a):
     return (exeed, cfc)
 
 
+def get_ptle_ids(n, ptles):
+    """
+    get the sorted array indexes and interpolation weights of percentiles, as np.percentile (linear method)
+    :param n: array length
+    :param ptles: array of percentiles
+    :return: tuple of arrays of lower indexes, upper indexes and weights
+    """
+    q = np.true_divide(ptles, 100)
+    vids = (n - 1) * q
+    lo = np.floor(vids)
+    gamma = vids - lo
+    lo = lo.astype(int)
+    hi = lo + 1
+    # out of bound indexes take the extreme values:
+    hi[vids >= n - 1] = n - 1
+    lo[vids >= n - 1] = n - 1
+    lo = np.clip(lo, 0, n - 1)
+    hi = np.clip(hi, 0, n - 1)
+    return lo, hi, gamma
+
+
+def get_ptle_values(a, lo, hi, gamma):
+    """
+    interpolate percentiles from arrays sorted (or partitioned) at the given indexes (see get_ptle_ids)
+    :param a: 2d array (members, days)
+    :param lo: array of lower indexes
+    :param hi: array of upper indexes
+    :param gamma: array of interpolation weights
+    :return: 2d array (members, percentiles)
+    """
+    below = a[:, lo]
+    diff = a[:, hi] - below
+    out = below + diff * gamma
+    up = gamma >= 0.5
+    out[:, up] = a[:, hi[up]] - diff[:, up] * (1 - gamma[up])
+    # members by row (reductions along the percentiles sum in the same order of a single curve):
+    return np.ascontiguousarray(out)
+
+
+def find_cfc_batch(a, ptles=None, presorted=False):
+    """
+    batch version of find_cfc. Each member is sorted once and all percentiles are taken from the sorted
+    array by linear interpolation (same values of np.percentile)
+    :param a: array (days) or 2d array (members, days)
+    :param ptles: array of percentiles (default 0 to 100)
+    :param presorted: boolean, True if the members are already sorted
+    :return: tuple with exeedance probability (%) and CFC values array (members, percentiles)
+    """
+    if ptles is None:
+        ptles = np.arange(0, 101, 1)
+    a = np.atleast_2d(np.asarray(a, dtype=float))
+    if not presorted:
+        a = np.sort(a, axis=-1)
+    ptles = np.asarray(ptles)
+    lo, hi, gamma = get_ptle_ids(a.shape[-1], ptles)
+    exeed = 100 - ptles
+    return (exeed, get_ptle_values(a, lo, hi, gamma))
+
+
+def find_exeed_flow(a, exeed=90):
+    """
+    flows of given exceedance probabilities (%) of the CFC (q90, q95, etc) by partial selection
+    (only the needed order statistics are placed, no full sort). Same values of find_cfc
+    :param a: array (days) or 2d array (members, days)
+    :param exeed: exceedance probability (%) or list of them
+    :return: float (1d array and one exceedance), array (members,) or (exceedances,), or 2d array (members, exceedances)
+    """
+    a = np.asarray(a, dtype=float)
+    ptles = 100 - np.atleast_1d(np.asarray(exeed, dtype=float))
+    lcl_a = np.atleast_2d(a)
+    lo, hi, gamma = get_ptle_ids(lcl_a.shape[-1], ptles)
+    lcl_a = np.partition(lcl_a, np.unique(np.concatenate((lo, hi))), axis=-1)
+    out = get_ptle_values(lcl_a, lo, hi, gamma)
+    return out.reshape(a.shape[:-1] + np.shape(exeed))[()]
+
+
+def find_gof(qobs, qsim, metrics=('RMSELOG_CFC',), cfc_obs=None):
+    """
+    goodness of fit metrics of a batch of simulated series against one observed series.
+    Only the requested metrics are computed, and the CFC of each member is taken from one sort.
+    Metrics: 'R', 'RMSE', 'RMSELOG', 'NSE', 'NSELOG', 'PBias' (series), 'RMSE_CFC', 'RMSELOG_CFC', 'R_CFC' (CFC,
+    as calib4_hru, without the 0 and 100 percentiles) and 'Q90' (simulated flow of 90% exceedance)
+    :param qobs: observed array (days). May be None if only CFC metrics are requested with cfc_obs
+    :param qsim: simulated array (days) or 2d array (members, days)
+    :param metrics: tuple of metric names
+    :param cfc_obs: observed CFC (see find_cfc) to skip its computation
+    :return: dict of metric arrays (members,)
+    """
+    if qobs is not None:
+        qobs = np.asarray(qobs, dtype=float)
+    qsim = np.atleast_2d(np.asarray(qsim, dtype=float))
+    out = dict()
+    #
+    def get_r(x, y):
+        # Pearson correlation of each member
+        xm = x - np.mean(x)
+        ym = y - np.mean(y, axis=-1)[:, np.newaxis]
+        r = np.sum(xm * ym, axis=-1) / np.sqrt(np.sum(xm * xm) * np.sum(ym * ym, axis=-1))
+        return np.clip(r, -1, 1)
+    #
+    # series metrics:
+    for k in metrics:
+        if k == 'R':
+            out[k] = get_r(qobs, qsim)
+        elif k == 'RMSE':
+            out[k] = np.sqrt(np.mean(np.power(qobs - qsim, 2), axis=-1))
+        elif k == 'RMSELOG':
+            out[k] = np.sqrt(np.mean(np.power(np.log10(qobs) - np.log10(qsim), 2), axis=-1))
+        elif k in ('NSE', 'NSELOG'):
+            # as find_nse:
+            qavg = qobs * 0.0 + np.mean(qsim, axis=-1)[:, np.newaxis]
+            lcl_obs = qobs
+            lcl_sim = qsim
+            if k == 'NSELOG':
+                lcl_obs = np.log10(qobs)
+                lcl_sim = np.log10(qsim)
+                qavg = np.log10(qavg)
+            out[k] = 1 - (np.sum(np.power(lcl_obs - lcl_sim, 2), axis=-1) / np.sum((lcl_obs - qavg), axis=-1))
+        elif k == 'PBias':
+            out[k] = 100 * np.sum(qobs - qsim, axis=-1) / np.sum(qobs)
+    #
+    # CFC metrics (one sort by member):
+    cfc_keys = [k for k in metrics if k in ('RMSE_CFC', 'RMSELOG_CFC', 'R_CFC')]
+    if 'Q90' in metrics and len(cfc_keys) == 0:
+        # partial selection is enough:
+        out['Q90'] = find_exeed_flow(qsim, (90,))[:, 0]
+    if len(cfc_keys) > 0:
+        cfc_sim = find_cfc_batch(qsim)[1]
+        if 'Q90' in metrics:
+            out['Q90'] = cfc_sim[:, 10]
+        if cfc_obs is None:
+            cfc_obs = find_cfc(qobs)
+        for k in cfc_keys:
+            if k == 'RMSE_CFC':
+                out[k] = np.sqrt(np.mean(np.power(cfc_obs[1][1:-1] - cfc_sim[:, 1:-1], 2), axis=-1))
+            elif k == 'RMSELOG_CFC':
+                out[k] = np.sqrt(np.mean(np.power(np.log10(cfc_obs[1][1:-1]) - np.log10(cfc_sim[:, 1:-1]), 2),
+                                         axis=-1))
+            elif k == 'R_CFC':
+                out[k] = get_r(cfc_obs[1][1:-1], cfc_sim[:, 1:-1])
+    return out
+
+
 def calib4(area, qobs, p, pet, cn, rzdf, nnash, ranges, segf=100, size=10, tui=True):
     import time
     from tools import stringsf
@@ -314,7 +457,7 @@ def calib4(area, qobs, p, pet, cn, rzdf, nnash, ranges, segf=100, size=10, tui=T
     return calibp, metrics, cloud, series, curves
 
 
-def run_hydro(area, p, pet, cn, rzdf, iaf, swmax, gwmax, knash, nnash, export='full'):
+def run_hydro(area, p, pet, cn, rzdf, iaf, swmax, gwmax, knash, nnash, export='full', routing='filter'):
     """
     run the simulation model
     :param area: area in km2
@@ -327,6 +470,7 @@ def run_hydro(area, p, pet, cn, rzdf, iaf, swmax, gwmax, knash, nnash, export='f
     :param gwmax: float
     :param knash: float
     :param nnash: int
+    :param routing: routing engine (see route_nash)
     :return: dict of all simulation results
     """
     from scipy.ndimage import gaussian_filter
@@ -398,7 +542,6 @@ def run_hydro(area, p, pet, cn, rzdf, iaf, swmax, gwmax, knash, nnash, export='f
     sfw = stp * 0.0
     sw = stp * 0.0
     et = stp * 0.0
-    vnash = np.zeros((len(stp), int(nnash)))  # nash cascade array
     # aux arrays:
     sfw1 = stp * 0.0
     sfw2 = stp * 0.0
@@ -452,23 +595,7 @@ def run_hydro(area, p, pet, cn, rzdf, iaf, swmax, gwmax, knash, nnash, export='f
     #
     # Channel transport phase:
     vroff = roff * area * 1000
-    for t in range(1, len(stp)):
-        t0 = t - 1
-        vin = vroff[t0]
-        # loop across Nash Cascade:
-        for v in range(0, len(vnash[t0])):
-            # validate volumes to prevent numeric overflow:
-            minvalue = 0.00001
-            if vnash[t0][v] <= minvalue:
-                vnash[t0][v] = minvalue
-            if vnash[t0][v - 1] <= minvalue:
-                vnash[t0][v - 1] = minvalue
-            if v == 0:
-                vnash[t][v] = vnash[t0][v] + vin - (vnash[t0][v] / knash)
-            else:
-                vnash[t][v] = vnash[t0][v] + (vnash[t0][v - 1] / knash) - (vnash[t0][v] / knash)
-        vout = vnash[t0][nnash - 1] / knash  # extract outflow from last bucket
-        qs[t0] = vout / 86400
+    qs = route_nash(vroff, knash, nnash, engine=routing)
     #
     # Sum stream flow:
     q = qb + qs
@@ -538,234 +665,809 @@ def load_hydro_data(qobsf, lulcf, soilsf, paramf, full=False, extent=600):
     return out
 
 
-def calib4_hru(area, qobs, p, pet, lulc, cns, nnash, ranges, segf=100, size=10, tui=True):
+def get_climb4_lst():
+    """
+    get the list of the 81 hill climbing steps in the 4-parameter lattice (-1, 0 or +1 delta by parameter)
+    :return: list of numpy arrays
+    """
+    climb_lst = list()
+    for i in range(-1, 2):
+        for j  in range(-1, 2):
+            for k in range(-1, 2):
+                for l in range(-1, 2):
+                    lcl = np.array((i, j, k, l))
+                    climb_lst.append(lcl)
+    return climb_lst
+
+
+def get_calib_cache():
+    """
+    get a new cache of the calibration objective values, keyed on the parameter lattice point
+    (see calib4_hru_walk). Lattice points are exact integer tuples, so hits need no float matching
+    :return: cache dict
+    """
+    cache = {'Memo': dict(), 'Hits': 0, 'Misses': 0}
+    return cache
+
+
+def get_calib_cache_report(cache):
+    """
+    get the calibration cache statistics report string
+    :param cache: cache dict (see get_calib_cache)
+    :return: string
+    """
+    total = cache['Hits'] + cache['Misses']
+    rate = 0.0
+    if total > 0:
+        rate = 100 * cache['Hits'] / total
+    def_str = '\nCalibration cache: {} hits, {} model runs ({:.1f}% hit rate)'.format(cache['Hits'],
+                                                                                  cache['Misses'], rate)
+    return def_str
+
+
+# process pool worker storage (see init_calib_worker and init_de_worker):
+calib_worker = dict()
+
+
+def init_calib_worker():
+    """
+    process pool initializer. Each worker keeps one calibration cache shared by all walks it runs
+    :return: none
+    """
+    calib_worker.clear()
+    calib_worker['Cache'] = get_calib_cache()
+
+
+def calib4_hru_walk_worker(*args):
+    """
+    run a walk of calib4_hru in a process pool worker (see init_calib_worker) with the worker cache
+    :param args: calib4_hru_walk positional arguments (up to t0)
+    :return: same as calib4_hru_walk
+    """
+    return calib4_hru_walk(*args, cache=calib_worker['Cache'])
+
+
+def calib4_hru_walk(area, qobs, p, pet, lulc, cns, nnash, ranges, segf, seed, walk=0, size=1, tui=False, t0=None,
+                    cache=None):
+    """
+    one random walk (hill climb in the parameter lattice) of calib4_hru.
+    Walks are independent of each other, so they may run in any order or in parallel.
+    :param area: total area in sq km
+    :param qobs: daily time series of observed flow
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :param ranges: tuple of (min, max) tuples of iaf, swmax, gwmax and knash
+    :param segf: number of segments of each parameter range
+    :param seed: random stream seed of the walk (int or numpy SeedSequence)
+    :param walk: walk index (for printing)
+    :param size: number of walks (for printing)
+    :param tui: boolean to print the walk
+    :param t0: starting time of the calibration (for printing)
+    :param cache: calibration cache dict shared by the walks (see get_calib_cache). None uses a walk cache
+    :return: dict of the walk final 'State' and 'Metric', the lists of the improving states 'x', 'y', 'z', 'w', 'm'
+    and the walk cache 'Hits' and 'Misses'
+    """
     import time
-    from tools import stringsf
-    #
-    def get_climb4_lst():
-        climb_lst = list()
-        for i in range(-1, 2):
-            for j  in range(-1, 2):
-                for k in range(-1, 2):
-                    for l in range(-1, 2):
-                        lcl = np.array((i, j, k, l))
-                        # print(lcl)
-                        climb_lst.append(lcl)
-        return climb_lst
-    #
-    # get current time:
-    dp_t0 = time.time()
     #
+    if t0 is None:
+        t0 = time.time()
+    if cache is None:
+        cache = get_calib_cache()
+    hits = cache['Hits']
+    misses = cache['Misses']
     # get step list
     step_lst = get_climb4_lst()
-    # print(len(step_lst))
-    #
-    # get deltas
-    iaf_delta = (ranges[0][1] - ranges[0][0]) / segf
-    swmax_delta = (ranges[1][1] - ranges[1][0]) / segf
-    gwmax_delta = (ranges[2][1] - ranges[2][0]) / segf
-    knash_delta = (ranges[3][1] - ranges[3][0]) / segf
     #
     # get delta array
-    deltas = np.array((iaf_delta, swmax_delta, gwmax_delta, knash_delta))
+    deltas = np.array([(r[1] - r[0]) / segf for r in ranges])
     #
     # get lower bound array
-    lower_bound = np.array((ranges[0][0], ranges[1][0], ranges[2][0], ranges[3][0]))
-    # get upper bound array
-    upper_bound = np.array((ranges[0][1], ranges[1][1], ranges[2][1], ranges[3][1]))
-    #
-    # create lists to store plotting data
-    x_iaf_lst = list()
-    y_swmax_lst = list()
-    z_gwmax_lst = list()
-    w_knash_lst = list()
-    m_lst = list()
+    lower_bound = np.array([r[0] for r in ranges])
     #
-    # create list to store states and metrics
-    chosen_states = list()
-    chosen_metrics = list()
+    # create dict to store the walk (plotting data lists)
+    out = {'x': list(), 'y': list(), 'z': list(), 'w': list(), 'm': list()}
     #
     # Get CFC obs:
     cfc_obs = find_cfc(qobs)
     #
-    # random walks loop:
-    for walk in range(0, size):
-        # reset random state using time
-        now = int(stringsf.now()[-6:])
-        np.random.seed(now)
-        # get a starting point
-        seed = np.random.randint(0, segf, 4)
-        current_state =  (seed * deltas) + lower_bound
-        #
+    def get_metric(ids):
+        # objective value of a lattice point (cached)
+        key = tuple(ids.tolist())
+        memo = cache['Memo']
+        if key in memo:
+            cache['Hits'] = cache['Hits'] + 1
+            return memo[key]
+        cache['Misses'] = cache['Misses'] + 1
+        state = (ids * deltas) + lower_bound
         # run model:
-        run = run_hydro_hru(area, p, pet, lulc, cns, current_state[0], current_state[1],
-                        current_state[2], current_state[3], nnash, export='none')
-        qsim = run['Q'] + 0.001
-        # compute CFC sim
-        cfc_sim = find_cfc(qsim)
-        # current_metric = np.sum(current_state)  # get metrics
-        current_metric = find_rmse(cfc_obs[1][1:-1], cfc_sim[1][1:-1], 'log')  # get metrics
-        if tui:
-            print('\nWalk # {}'.format(walk + 1))
-            print('Starting point in hyperspace: {:6.3f}  {:6.3f}  {:6.3f}  {:6.3f}'
-                  '\t\tMetric: {:6.3f}'.format(current_state[0], current_state[1], current_state[2], current_state[3],
-                                               current_metric))
-        counter = 0
-        while True:
-            # to get out the loop only if all possibilities were exausted
-            if counter == len(step_lst):
-                # append
-                chosen_states.append(current_state)
-                chosen_metrics.append(current_metric)
-                if tui:
-                    print('End of local walk')
-                break
-            # compute sample state
-            sample_state = current_state + (step_lst[counter] * deltas)
-            # check if state inside search hyperspace:
-            check = np.prod((sample_state  >= lower_bound) * (sample_state <= upper_bound))
-            if check == 1:
-                #
-                # run model:
-                run = run_hydro_hru(area, p, pet, lulc, cns, sample_state[0], sample_state[1],
-                                    sample_state[2], sample_state[3], nnash, export='none')
-                qsim = run['Q'] + 0.001
-                # compute CFC sim
-                cfc_sim = find_cfc(qsim)
-                # current_metric = np.sum(current_state)  # get metrics
-                sample_metric = find_rmse(cfc_obs[1][1:-1], cfc_sim[1][1:-1], 'log')  # get metrics
+        run = run_hydro_hru(area, p, pet, lulc, cns, state[0], state[1], state[2], state[3], nnash, export='none')
+        # get metrics:
+        memo[key] = find_gof(qobs, run['Q'] + 0.001, cfc_obs=cfc_obs)['RMSELOG_CFC'][0]
+        return memo[key]
+    #
+    # get a starting point from the walk own random stream:
+    rng = np.random.default_rng(seed)
+    current_ids = rng.integers(0, segf, 4)
+    current_state = (current_ids * deltas) + lower_bound
+    current_metric = get_metric(current_ids)
+    if tui:
+        print('\nWalk # {}'.format(walk + 1))
+        print('Starting point in hyperspace: {:6.3f}  {:6.3f}  {:6.3f}  {:6.3f}'
+              '\t\tMetric: {:6.3f}'.format(current_state[0], current_state[1], current_state[2], current_state[3],
+                                           current_metric))
+    counter = 0
+    while counter < len(step_lst):
+        # compute sample lattice point
+        sample_ids = current_ids + step_lst[counter]
+        # check if state inside search hyperspace:
+        check = np.prod((sample_ids >= 0) * (sample_ids <= segf))
+        if check == 1:
+            sample_metric = get_metric(sample_ids)
+            #
+            # if best, reset search
+            if sample_metric < current_metric:
+                sample_state = (sample_ids * deltas) + lower_bound
+                # store data:
+                for k, v in zip(('x', 'y', 'z', 'w'), sample_state):
+                    out[k].append(v)
+                out['m'].append(sample_metric)
                 #
-                # if best, reset search
-                if sample_metric < current_metric:
-                    # store data:
-                    x_iaf_lst.append(sample_state[0])
-                    y_swmax_lst.append(sample_state[1])
-                    z_gwmax_lst.append(sample_state[2])
-                    w_knash_lst.append(sample_state[3])
-                    m_lst.append(sample_metric)
-                    #
-                    current_metric = sample_metric  # update metric
-                    current_state = sample_state  # updade state
-                    # reset step list:
-                    step_lst = step_lst[counter:] + step_lst[:counter]
-                    aux_flt = time.time() - dp_t0
-                    if tui:
-                        print('Walk {} of {}'.format(walk + 1, size), end='\t\t')
-                        print('Sample state: {:8.3f}  '
-                              '{:8.3f}  {:8.3f}  {:8.3f}'.format(current_state[0], current_state[1], current_state[2],
-                                                           current_state[3]), end='\t')
-                        print('Metric: {:<10.4f}'.format(sample_metric), end='\t\t')
-                        print('Elapsed time: {:8.2f} s'.format(aux_flt))
-                    # reset counter:
-                    counter = 0
-                else:
-                    # keep searching in local list
-                    counter = counter + 1
-            else:
-                # keep searching in local list
-                counter = counter + 1
+                current_metric = sample_metric  # update metric
+                current_ids = sample_ids
+                current_state = sample_state  # updade state
+                # reset step list:
+                step_lst = step_lst[counter:] + step_lst[:counter]
+                if tui:
+                    print('Walk {} of {}'.format(walk + 1, size), end='\t\t')
+                    print('Sample state: {:8.3f}  '
+                          '{:8.3f}  {:8.3f}  {:8.3f}'.format(current_state[0], current_state[1], current_state[2],
+                                                             current_state[3]), end='\t')
+                    print('Metric: {:<10.4f}'.format(sample_metric), end='\t\t')
+                    print('Elapsed time: {:8.2f} s'.format(time.time() - t0))
+                # reset counter:
+                counter = 0
+                continue
+        # keep searching in local list
+        counter = counter + 1
+    # all possibilities were exausted
+    if tui:
+        print('End of local walk')
+    out['State'] = current_state
+    out['Metric'] = current_metric
+    out['Hits'] = cache['Hits'] - hits
+    out['Misses'] = cache['Misses'] - misses
+    return out
+
+
+def calib4_hru(area, qobs, p, pet, lulc, cns, nnash, ranges, segf=100, size=10, tui=True, seed=None, workers=None):
+    """
+    calibrate the HRU model (iaf, swmax, gwmax and knash) by random-restart hill climbing walks
+    in the parameter lattice (see calib4_hru_walk) minimizing the log RMSE of the CFC
+    :param area: total area in sq km
+    :param qobs: daily time series of observed flow
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :param ranges: tuple of (min, max) tuples of iaf, swmax, gwmax and knash
+    :param segf: number of segments of each parameter range
+    :param size: number of random walks
+    :param tui: boolean to print
+    :param seed: master seed (int). Each walk gets its own random stream spawned from it,
+    so the calibration is reproducible regardless of the number of workers. None takes it from the clock
+    :param workers: number of worker processes to run the walks (None or 1 runs serially).
+    Each worker shares its own calibration cache among the walks it runs
+    :return: tuple of dicts: calibp, metrics, cloud, series, curves
+    """
+    import time
+    from tools import stringsf
+    #
+    # get current time:
+    dp_t0 = time.time()
+    #
+    # get the master seed and the walks random streams:
+    if seed is None:
+        seed = int(stringsf.now()[-6:])
+    walk_seeds = np.random.SeedSequence(int(seed)).spawn(size)
+    #
+    # random walks loop:
+    if workers is not None and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_calib_worker) as pool:
+            futures = [pool.submit(calib4_hru_walk_worker, area, qobs, p, pet, lulc, cns, nnash, ranges, segf,
+                                   walk_seeds[walk], walk, size, False, dp_t0) for walk in range(0, size)]
+            walks = list()
+            # merge in walk order:
+            for walk in range(0, size):
+                walks.append(futures[walk].result())
+                if tui:
+                    print('Walk {} of {}\t\tState: {:8.3f}  {:8.3f}  {:8.3f}  {:8.3f}\t'
+                          'Metric: {:<10.4f}\t\tElapsed time: {:8.2f} s'.format(walk + 1, size,
+                                                                               *walks[walk]['State'],
+                                                                               walks[walk]['Metric'],
+                                                                               time.time() - dp_t0))
+    else:
+        # all walks share one calibration cache:
+        cache = get_calib_cache()
+        walks = [calib4_hru_walk(area, qobs, p, pet, lulc, cns, nnash, ranges, segf, walk_seeds[walk],
+                                 walk, size, tui, dp_t0, cache) for walk in range(0, size)]
+    #
+    # gather the cache statistics of the walks:
+    stats = {'Hits': sum([w['Hits'] for w in walks]), 'Misses': sum([w['Misses'] for w in walks])}
+    if tui:
+        print(get_calib_cache_report(stats))
+    #
+    # get lists of states and metrics
+    chosen_states = [w['State'] for w in walks]
+    chosen_metrics = [w['Metric'] for w in walks]
+    #
     # find best metric of all walks:
     best_metric = min(chosen_metrics)
     # retrieve from lists:
     best_metric_id = chosen_metrics.index(best_metric)
     best_state = chosen_states[best_metric_id]
     #
-    #
     # finally, run model, get all other metrics and stuff:
-    series = run_hydro_hru(area, p, pet, lulc, cns, sample_state[0], sample_state[1],
-                           sample_state[2], sample_state[3], nnash, export='full')
+    calibp, metrics, series, curves = get_calib_outputs(area, qobs, p, pet, lulc, cns, nnash, best_state, best_metric)
+    calibp['Seed'] = seed
+    calibp['Cache hits'] = stats['Hits']
+    calibp['Model runs'] = stats['Misses']
+    # merge the clouds of the walks (in walk order):
+    cloud = dict()
+    for k in ('x', 'y', 'z', 'w', 'm'):
+        cloud[k] = np.array([v for w in walks for v in w[k]])
+    return calibp, metrics, cloud, series, curves
+
+
+def get_calib_outputs(area, qobs, p, pet, lulc, cns, nnash, best_state, best_metric):
+    """
+    run the HRU model with the calibrated parameters and get the calibration outputs
+    :param area: total area in sq km
+    :param qobs: daily time series of observed flow
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :param best_state: array of iaf, swmax, gwmax and knash
+    :param best_metric: objective value of the best state
+    :return: tuple of dicts: calibp, metrics, series, curves
+    """
+    # Get CFC obs:
+    cfc_obs = find_cfc(qobs)
+    series = run_hydro_hru(area, p, pet, lulc, cns, best_state[0], best_state[1],
+                           best_state[2], best_state[3], nnash, export='full')
     qsim = series['Q'] + 0.001
     # compute CFC sim
     cfc_sim = find_cfc(qsim)
-    # nse:
-    nse = find_nse(qobs, qsim)
-    nselog = find_nse(qobs, qsim, 'log')
-    # pbias:
-    pbias = find_pbias(qobs, qsim)
-    # rmse:
-    rmse = find_rmse(qobs, qsim)
-    # rmselog:
-    rmselog = find_rmse(qobs, qsim, 'log')
-    # r:
-    r = np.corrcoef(qobs, qsim)[0, 1]
-    # rmse_cfc:
-    rmse_cfc = find_rmse(cfc_obs[1][1:-1], cfc_sim[1][1:-1])
-    # rmse_cfc_log:
-    rmselog_cfc = find_rmse(cfc_obs[1][1:-1], cfc_sim[1][1:-1], 'log')
-    # r cfc:
-    r_cfc = np.corrcoef(cfc_obs[1][1:-1], cfc_sim[1][1:-1])[0, 1]
-    #
+    # all metrics at once:
+    gof = find_gof(qobs, qsim, ('R', 'RMSE', 'RMSELOG', 'NSE', 'NSELOG', 'PBias', 'RMSE_CFC', 'RMSELOG_CFC', 'R_CFC'),
+                   cfc_obs=cfc_obs)
     #
     # output dict:
     calibp = {'Iaf':best_state[0], 'Swmax':best_state[1], 'Gwmax': best_state[2],
               'Knash':best_state[3], 'Metric': best_metric}
-    metrics = {'R':r, 'RMSE':rmse, 'RMSELOG':rmselog, 'NSE':nse, 'NSELOG':nselog, 'PBias':pbias, 'RMSE_CFC':rmse_cfc,
-               'RMSELOG_CFC':rmselog_cfc, 'R_CFC':r_cfc}
-    cloud = {'x': np.array(x_iaf_lst), 'y': np.array(y_swmax_lst), 'z': np.array(z_gwmax_lst),
-             'w': np.array(w_knash_lst), 'm': np.array(m_lst)}
+    metrics = dict()
+    for k in gof:
+        metrics[k] = gof[k][0]
     series['Qobs'] = qobs  # add to it the new series
 
     curves = {'CFCobs': cfc_obs[1][1:-1], 'CFCsim': cfc_sim[1][1:-1], 'Exeed':cfc_sim[0][1:-1]}
 
+    return calibp, metrics, series, curves
+
+
+def eval_calib_pop(area, cfc_obs, p, pet, lulc, cns, nnash, pop):
+    """
+    evaluate the calibration objective (log RMSE of the CFC) of a population of parameter vectors.
+    The whole population is simulated in one ensemble call (see run_hydro_ens)
+    :param area: total area in sq km
+    :param cfc_obs: observed CFC (see find_cfc)
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :param pop: 2d array of iaf, swmax, gwmax and knash by member (members, 4)
+    :return: array of objective values by member (inf if undefined)
+    """
+    run = run_hydro_ens(area, p, pet, lulc, cns, pop[:, 0], pop[:, 1], pop[:, 2], pop[:, 3], nnash)
+    metric = find_gof(None, run['Q'] + 0.001, cfc_obs=cfc_obs)['RMSELOG_CFC']
+    # undefined metrics (log of negative flows) are never selected, as in the hill climb:
+    metric[np.isnan(metric)] = np.inf
+    return metric
+
+
+def init_de_worker(area, cfc_obs, p, pet, lulc, cns, nnash):
+    """
+    process pool initializer of calib_de_hru. The series are shared once per worker
+    :param area: total area in sq km
+    :param cfc_obs: observed CFC (see find_cfc)
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :return: none
+    """
+    calib_worker.clear()
+    calib_worker['Args'] = (area, cfc_obs, p, pet, lulc, cns, nnash)
+
+
+def eval_calib_pop_worker(pop):
+    """
+    evaluate a chunk of a population in a process pool worker (see init_de_worker)
+    :param pop: 2d array of iaf, swmax, gwmax and knash by member (members, 4)
+    :return: same as eval_calib_pop
+    """
+    return eval_calib_pop(*calib_worker['Args'], pop)
+
+
+def eval_calib_gen(pool, args, pop, nchunks=1):
+    """
+    evaluate a generation of calib_de_hru, by chunks of members in a process pool or serially
+    :param pool: ProcessPoolExecutor initialized with init_de_worker, or None to run serially
+    :param args: tuple of eval_calib_pop arguments up to nnash (used when pool is None)
+    :param pop: 2d array of iaf, swmax, gwmax and knash by member (members, 4)
+    :param nchunks: number of chunks of members
+    :return: same as eval_calib_pop
+    """
+    if pool is None:
+        return eval_calib_pop(*args, pop)
+    futures = [pool.submit(eval_calib_pop_worker, lcl_pop) for lcl_pop in np.array_split(pop, nchunks)
+               if len(lcl_pop) > 0]
+    return np.concatenate([future.result() for future in futures])
+
+
+def calib_de_hru(area, qobs, p, pet, lulc, cns, nnash, ranges, pop_size=40, generations=50, mut=0.5, crossp=0.9,
+                 tol=1e-6, tui=True, seed=None, workers=None):
+    """
+    calibrate the HRU model (iaf, swmax, gwmax and knash) by differential evolution (rand/1/bin)
+    minimizing the log RMSE of the CFC. Each generation is evaluated at once (see eval_calib_pop)
+    :param area: total area in sq km
+    :param qobs: daily time series of observed flow
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :param ranges: tuple of (min, max) tuples of iaf, swmax, gwmax and knash
+    :param pop_size: population size (>= 4)
+    :param generations: max number of generations
+    :param mut: mutation (differential weight) factor
+    :param crossp: crossover probability
+    :param tol: stop when the objective spread of the population is below it
+    :param tui: boolean to print
+    :param seed: master seed (int). None takes it from the clock
+    :param workers: number of worker processes to evaluate the generations by chunks (None or 1 runs serially)
+    :return: tuple of dicts: calibp, metrics, cloud, series, curves (as calib4_hru)
+    """
+    import time
+    from contextlib import nullcontext
+    from tools import stringsf
+    #
+    # the mutation takes three distinct members other than the target:
+    if pop_size < 4:
+        raise ValueError('DE population size must be at least 4, got {}'.format(pop_size))
+    if generations < 1:
+        raise ValueError('DE generations must be at least 1, got {}'.format(generations))
+    #
+    # get current time:
+    dp_t0 = time.time()
+    if seed is None:
+        seed = int(stringsf.now()[-6:])
+    rng = np.random.default_rng(int(seed))
+    #
+    # get lower and upper bound arrays
+    lower_bound = np.array([r[0] for r in ranges], dtype=float)
+    upper_bound = np.array([r[1] for r in ranges], dtype=float)
+    #
+    # Get CFC obs:
+    cfc_obs = find_cfc(qobs)
+    ev_args = (area, cfc_obs, p, pet, lulc, cns, nnash)
+    #
+    # create dict to store plotting data (improving trial states)
+    cloud = {'x': list(), 'y': list(), 'z': list(), 'w': list(), 'm': list()}
+    #
+    # generations loop (the pool is None when running serially, the series are shared once per worker):
+    pool_cm = nullcontext()
+    nchunks = 1
+    if workers is not None and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool_cm = ProcessPoolExecutor(max_workers=workers, initializer=init_de_worker, initargs=ev_args)
+        nchunks = workers
+    with pool_cm as pool:
+        # initial population:
+        pop = lower_bound + rng.random((pop_size, 4)) * (upper_bound - lower_bound)
+        pop_metric = eval_calib_gen(pool, ev_args, pop, nchunks)
+        runs = pop_size
+        gen = 0
+        for gen in range(1, generations + 1):
+            # mutation: three distinct members other than the target
+            ids = np.array([rng.choice(np.delete(np.arange(pop_size), i), 3, replace=False) for i in range(pop_size)])
+            mutant = pop[ids[:, 0]] + mut * (pop[ids[:, 1]] - pop[ids[:, 2]])
+            mutant = np.clip(mutant, lower_bound, upper_bound)
+            # binomial crossover (at least one parameter from the mutant):
+            cross = rng.random((pop_size, 4)) < crossp
+            cross[np.arange(pop_size), rng.integers(0, 4, pop_size)] = True
+            trial = np.where(cross, mutant, pop)
+            trial_metric = eval_calib_gen(pool, ev_args, trial, nchunks)
+            runs = runs + pop_size
+            # selection:
+            better = trial_metric < pop_metric
+            for i in np.flatnonzero(better):
+                for k, v in zip(('x', 'y', 'z', 'w'), trial[i]):
+                    cloud[k].append(v)
+                cloud['m'].append(trial_metric[i])
+            pop[better] = trial[better]
+            pop_metric[better] = trial_metric[better]
+            if tui:
+                best_id = np.argmin(pop_metric)
+                print('Generation {} of {}'.format(gen, generations), end='\t\t')
+                print('Best state: {:8.3f}  {:8.3f}  {:8.3f}  {:8.3f}'.format(*pop[best_id]), end='\t')
+                print('Metric: {:<10.4f}'.format(pop_metric[best_id]), end='\t\t')
+                print('Elapsed time: {:8.2f} s'.format(time.time() - dp_t0))
+            if np.max(pop_metric) - np.min(pop_metric) < tol:
+                break
+    #
+    # find best metric of the population:
+    best_id = int(np.argmin(pop_metric))
+    calibp, metrics, series, curves = get_calib_outputs(area, qobs, p, pet, lulc, cns, nnash, pop[best_id],
+                                                        pop_metric[best_id])
+    calibp['Seed'] = seed
+    calibp['Generations'] = gen
+    calibp['Model runs'] = runs
+    for k in cloud:
+        cloud[k] = np.array(cloud[k])
     return calibp, metrics, cloud, series, curves
 
 
-def run_hydro_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, export='full'):
+def calib_mf_hru(area, qobs, p, pet, lulc, cns, nnash, ranges, window=365, promote=8, engine='walk', tui=True,
+                 workers=None, **kwargs):
     """
-    run the simulation model using land use and land cover classes as hydrologic response units
+    multi-fidelity calibration of the HRU model. The search engine (calib4_hru or calib_de_hru) is run
+    on a sub-window of the record (first window days) and only the most promising states of its cloud
+    are promoted to the full record simulation, where the best one is chosen
     :param area: total area in sq km
+    :param qobs: daily time series of observed flow
     :param p: daily time series of precipitation in mm
     :param pet: daily time series of PET in mm
-    :param lulc: list of lulc classes areas or ratios for weighting
-    :param cns: list of SCS CN values computed from LULC and Soil types for each LULC classes
-    :param iaf: float
-    :param swmax: float
-    :param gwmax: float
+    :param lulc: list of lulc classes areas
+    :param cns: list of CN values by HRU
+    :param nnash: int
+    :param ranges: tuple of (min, max) tuples of iaf, swmax, gwmax and knash
+    :param window: number of days of the screening sub-window
+    :param promote: number of states promoted to the full record
+    :param engine: 'walk' (calib4_hru) or 'de' (calib_de_hru)
+    :param tui: boolean to print
+    :param workers: number of worker processes of the engine
+    :param kwargs: other engine keyword arguments (size, segf, pop_size, generations, seed, etc)
+    :return: tuple of dicts: calibp, metrics, cloud, series, curves (as calib4_hru). The cloud has the
+    fidelity 'f' of each point metric: 0 for the sub-window and 1 for the full record
+    """
+    # screening on the sub-window:
+    if engine == 'de':
+        screen = calib_de_hru(area, qobs[:window], p[:window], pet[:window], lulc, cns, nnash, ranges, tui=tui,
+                              workers=workers, **kwargs)
+    else:
+        screen = calib4_hru(area, qobs[:window], p[:window], pet[:window], lulc, cns, nnash, ranges, tui=tui,
+                            workers=workers, **kwargs)
+    scr_calibp = screen[0]
+    scr_cloud = screen[2]
+    #
+    # promising states: the screening best and the best distinct states of the screening cloud
+    scr_best = np.array((scr_calibp['Iaf'], scr_calibp['Swmax'], scr_calibp['Gwmax'], scr_calibp['Knash']))
+    scr_states = np.array((scr_cloud['x'], scr_cloud['y'], scr_cloud['z'], scr_cloud['w'])).T.reshape(-1, 4)
+    order = np.argsort(scr_cloud['m'], kind='stable')
+    cand = [scr_best]
+    for i in order:
+        if len(cand) >= promote:
+            break
+        if not np.any(np.all(np.array(cand) == scr_states[i], axis=1)):
+            cand.append(scr_states[i])
+    cand = np.array(cand)
+    #
+    # confirm on the full record:
+    cand_metric = eval_calib_pop(area, find_cfc(qobs), p, pet, lulc, cns, nnash, cand)
+    if tui:
+        print('\nPromoted states to the full record: {}'.format(len(cand)))
+        for i in range(0, len(cand)):
+            print('State: {:8.3f}  {:8.3f}  {:8.3f}  {:8.3f}\tMetric: {:<10.4f}'.format(*cand[i], cand_metric[i]))
+    best_id = int(np.argmin(cand_metric))
+    calibp, metrics, series, curves = get_calib_outputs(area, qobs, p, pet, lulc, cns, nnash, cand[best_id],
+                                                        cand_metric[best_id])
+    calibp['Seed'] = scr_calibp['Seed']
+    calibp['Window'] = window
+    calibp['Screen metric'] = scr_calibp['Metric']
+    calibp['Screen runs'] = scr_calibp['Model runs']
+    # counts of the screening engine (cache hits of calib4_hru or generations of calib_de_hru):
+    for k in ('Cache hits', 'Generations'):
+        if k in scr_calibp:
+            calibp['Screen ' + k.lower()] = scr_calibp[k]
+    calibp['Model runs'] = len(cand)
+    # merge the screening and full record clouds:
+    cloud = dict()
+    for k, v in zip(('x', 'y', 'z', 'w', 'm'), (cand[:, 0], cand[:, 1], cand[:, 2], cand[:, 3], cand_metric)):
+        cloud[k] = np.concatenate((scr_cloud[k], v))
+    cloud['f'] = np.concatenate((np.zeros(len(scr_cloud['m']), dtype=int), np.ones(len(cand), dtype=int)))
+    return calibp, metrics, cloud, series, curves
+
+
+def route_nash(vroff, knash, nnash, engine='filter', state=None):
+    """
+    Channel transport phase by a Nash cascade of linear reservoirs
+    :param vroff: runoff volume time series array (m3). A 2d array (n, days) routes n series at once
     :param knash: float
     :param nnash: int
-    :return: dict of all simulation results
+    :param engine: 'filter' (linear filter, see route_nash_filter) or 'loop' (reservoir by reservoir time loop)
+    :param state: array of the reservoirs volumes (m3) at the start of the series, (nnash,) or (n, nnash).
+    If None, the cascade starts empty and the outflow of the last step is not computed
+    :return: surface discharge time series array (m3/s), same shape of vroff.
+    If state is given, tuple of the discharge array and the reservoirs volumes at the end of the series
     """
-    from scipy.ndimage import gaussian_filter
+    vroff = np.asarray(vroff, dtype=float)
+    if state is not None:
+        state = np.broadcast_to(np.asarray(state, dtype=float), vroff.shape[:-1] + (int(nnash),))
+    # an unstable cascade (knash < 1) relies on the volume validation of the time loop:
+    if engine == 'filter' and knash >= 1:
+        return route_nash_filter(vroff, knash, nnash, state)
+    if vroff.ndim > 1:
+        if state is None:
+            return np.array([route_nash(vroff[i], knash, nnash, engine='loop') for i in range(len(vroff))])
+        routed = [route_nash(vroff[i], knash, nnash, engine='loop', state=state[i]) for i in range(len(vroff))]
+        return np.array([r[0] for r in routed]), np.array([r[1] for r in routed])
+    qs = vroff * 0.0
+    # nash cascade array (a warm cascade also routes the last step, to carry on its storages):
+    nstep = len(vroff)
+    if state is not None:
+        nstep = len(vroff) + 1
+    vnash = np.zeros((nstep, int(nnash)))
+    if state is not None:
+        vnash[0] = state
+    for t in range(1, nstep):
+        t0 = t - 1
+        vin = vroff[t0]
+        # loop across Nash Cascade:
+        for v in range(0, len(vnash[t0])):
+            # validate volumes to prevent numeric overflow:
+            minvalue = 0.00001
+            if vnash[t0][v] <= minvalue:
+                vnash[t0][v] = minvalue
+            if vnash[t0][v - 1] <= minvalue:
+                vnash[t0][v - 1] = minvalue
+            if v == 0:
+                vnash[t][v] = vnash[t0][v] + vin - (vnash[t0][v] / knash)
+            else:
+                vnash[t][v] = vnash[t0][v] + (vnash[t0][v - 1] / knash) - (vnash[t0][v] / knash)
+        vout = vnash[t0][nnash - 1] / knash  # extract outflow from last bucket
+        qs[t0] = vout / 86400
+    if state is not None:
+        return qs, vnash[-1].copy()
+    return qs
 
-    def find_roff(pia, p):
-        r = 0.0
-        if p > pia:
-            r = p - pia
-        else:
-            r = 0.0
-        return r
 
-    def find_ev(pet1, sfw2):
-        if sfw2 < pet1:
-            ev = sfw2
-        else:
-            ev = pet1
-        return ev
+def route_nash_filter(vroff, knash, nnash, state=None):
+    """
+    Nash cascade routing as a linear filter. Each linear reservoir of the cascade is the
+    first order filter V(t) = (1 - 1/k) V(t-1) + Vin(t-1), so the cascade is run as nnash
+    filter passes along the time axis. Matches the time loop of route_nash within 1e-9 m3/s
+    (the loop validates empty reservoirs to a minimal volume of 1e-5 m3)
+    :param vroff: runoff volume time series array (m3), 1d (days) or 2d (n, days)
+    :param knash: float (>= 1)
+    :param nnash: int
+    :param state: array of the reservoirs volumes (m3) at the start of the series (see route_nash)
+    :return: surface discharge time series array (m3/s), same shape of vroff
+    (and the reservoirs volumes at the end of the series if state is given)
+    """
+    from scipy.signal import lfilter
 
-    def find_inf(pinf, sfw1):
-        if sfw1 < pinf:
-            inf = sfw1
+    a = 1 / knash
+    vout = vroff
+    ends = list()
+    for v in range(0, int(nnash)):
+        # outflow of the reservoir: a * V(t), with V(t) = (1 - a) V(t-1) + Vin(t-1)
+        if state is None:
+            vout = lfilter([0.0, a], [1.0, a - 1.0], vout, axis=-1)
         else:
-            inf = pinf
-        return inf
+            # the filter delay holds the next outflow, a * V:
+            vout, zf = lfilter([0.0, a], [1.0, a - 1.0], vout, axis=-1, zi=a * state[..., v][..., np.newaxis])
+            ends.append(zf[..., 0] / a)
+    qs = vout / 86400
+    if state is not None:
+        return qs, np.stack(ends, axis=-1)
+    qs[..., -1] = 0.0  # as the time loop, the outflow of the last step is not computed
+    return qs
 
-    def find_ptp(sw1, swmax, rzd):
-        if sw1 > swmax - rzd:
-            ptp = sw1 - (swmax - rzd)
-        else:
-            ptp = 0.0
-        return ptp
 
-    def find_tp(pet2, ptp):
-        if pet2 < ptp:
-            tp = pet2
-        else:
-            tp = ptp
-        return tp
+def round_array(a, p=4):
+    """
+    round an array as the built-in round function (correct decimal rounding) without a loop by element
+    :param a: numpy array
+    :param p: number of decimals
+    :return: numpy array
+    """
+    scale = 10.0 ** p
+    y = a * scale
+    out = np.rint(y) / scale
+    # near half values may be taken to the wrong side by the scaling error, so they are rounded one by one:
+    ids = np.flatnonzero(np.abs(y - np.floor(y) - 0.5) < 1e-6)
+    for i in ids:
+        out.flat[i] = round(float(a.flat[i]), p)
+    return out
 
-    def find_gw(gwmax, swmax, sw2):
-        gw = gwmax * sw2 / swmax
-        return round(gw, 4)
+
+def run_land_hru(p, pet, iamax, rzd, swmax, gwmax, areas_bol,
+                 outputs=('Roff', 'Inf', 'Ev', 'Tp', 'ET', 'Gw', 'Sfw', 'Sw'), state=None):
+    """
+    land phase of the HRU model. Each HRU is simulated independently of the others, so all HRUs
+    are advanced together as a state vector by time step
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param iamax: array of iamax by HRU
+    :param rzd: array of root zone depth by HRU
+    :param swmax: float or array by HRU
+    :param gwmax: float or array by HRU
+    :param areas_bol: boolean array of HRUs with area > 0 (HRUs with no area get no precipitation)
+    :param outputs: tuple of the flow and stock variables to export (only those are stored)
+    :param state: dict of the HRU stocks arrays 'Sfw' and 'Sw' at the start of the series (see get_hydro_state).
+    If None, the stocks start empty and the last step is not simulated
+    :return: dict of HRU flow and stock variables 2d arrays (HRU, days).
+    If state is given, it also has the 'State' dict of the HRU stocks at the end of the series
+    """
+    iamax = np.asarray(iamax, dtype=float)
+    nhru = len(iamax)
+    # available subsoil stock to transpiration starts at swmax - rzd:
+    swmax_rzd = swmax - np.asarray(rzd, dtype=float)
+    areas_f = np.asarray(areas_bol, dtype=float)
+    #
+    # HRU flow and stock variables arrays (days, HRU):
+    store = dict()
+    for k in outputs:
+        store[k] = np.zeros((len(p), nhru))
+    roff_a = store.get('Roff')
+    inf_a = store.get('Inf')
+    ev_a = store.get('Ev')
+    tp_a = store.get('Tp')
+    et_a = store.get('ET')
+    gw_a = store.get('Gw')
+    sfw_a = store.get('Sfw')
+    sw_a = store.get('Sw')
+    #
+    # HRU stock variables:
+    sfw = np.zeros(nhru)
+    sw = np.zeros(nhru)
+    nstep = len(p)
+    if state is not None:
+        # a warm start simulates all steps, to carry on its stocks:
+        sfw = sfw + state['Sfw']
+        sw = sw + state['Sw']
+        nstep = len(p) + 1
+        if sfw_a is not None:
+            sfw_a[0] = sfw
+        if sw_a is not None:
+            sw_a[0] = sw
+    #
+    # land phase loop for all HRUs:
+    for t in range(1, nstep):
+        t0 = t - 1
+        pu = p[t0] * areas_f
+        # surface water balance:
+        # first, discount runoff:
+        pia = iamax - sfw  # available stock in surface
+        roff = np.where(pu > pia, pu - pia, 0.0)
+        sfw1 = sfw + pu - roff
+        # second, discount infiltration:
+        inf = np.minimum(sfw1, swmax - sw)  # limited by the available stock in subsoil
+        sfw2 = sfw1 - inf
+        # last, discount evaporation:
+        ev = np.minimum(sfw2, pet[t0])  # limited by the available stock in atmosphere
+        pet2 = pet[t0] - ev  # remaining available stock in atmosphere
+        # update surface water stock
+        sfw = sfw2 - ev
+        #
+        # subsurface water balance
+        # first include infiltration
+        sw1 = sw + inf
+        # second, discount transpiration
+        ptp = np.where(sw1 > swmax_rzd, sw1 - swmax_rzd, 0.0)
+        tp = np.minimum(ptp, pet2)
+        sw2 = sw1 - tp
+        # last, discount growndwater flow
+        gw = round_array(gwmax * sw2 / swmax, 4)
+        # update sw:
+        sw = sw2 - gw
+        #
+        if roff_a is not None:
+            roff_a[t0] = roff
+        if inf_a is not None:
+            inf_a[t0] = inf
+        if ev_a is not None:
+            ev_a[t0] = ev
+        if tp_a is not None:
+            tp_a[t0] = tp
+        if et_a is not None:
+            et_a[t0] = ev + tp  # real ET
+        if gw_a is not None:
+            gw_a[t0] = gw
+        if t == len(p):
+            break
+        if sfw_a is not None:
+            sfw_a[t] = sfw
+        if sw_a is not None:
+            sw_a[t] = sw
+    out = dict()
+    for k in outputs:
+        out[k] = np.ascontiguousarray(store[k].T)
+    if state is not None:
+        out['State'] = {'Sfw': sfw, 'Sw': sw}
+    return out
+
+
+def get_hydro_state(nhru=8, nnash=3):
+    """
+    get an empty hydrology state: the model stocks to carry on a simulation (see run_hydro_hru).
+    A long record may be simulated by chunks, starting from the empty state and passing on the
+    'State' of each chunk to the next one
+    :param nhru: number of HRUs
+    :param nnash: number of Nash cascade reservoirs
+    :return: dict of the surface and subsoil water stocks by HRU ('Sfw' and 'Sw', mm) and
+    the Nash cascade reservoirs volumes ('Vnash', m3)
+    """
+    state = {'Sfw': np.zeros(nhru), 'Sw': np.zeros(nhru), 'Vnash': np.zeros(int(nnash))}
+    return state
+
+
+def get_hru_basis(p, pet, cns, iaf, swmax, gwmax, state=None):
+    """
+    get the HRU response basis: the land phase of every HRU simulated once.
+    The land phase of a HRU does not depend on the LULC fractions, so any LULC
+    can be evaluated by weighting the basis arrays (see run_hydro_hru)
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param cns: list of SCS CN values computed from LULC and Soil types for each LULC classes
+    :param iaf: float
+    :param swmax: float
+    :param gwmax: float
+    :param state: dict of the HRU stocks at the start of the series (see run_land_hru)
+    :return: dict of HRU flow and stock variables lists of arrays
+    """
+    # get iamax HRU array:
+    iamax = iaf * ((25400 / np.array(cns)) - 254)  # from the SCS method
+    # get rzd HRU array:
+    rzd = (iamax * (iamax <= swmax)) + (swmax * (iamax > swmax))  # rzd = iamax ->> the symmetry principle
+    # all HRUs get precipitation:
+    areas_bol = np.ones(len(cns), dtype=bool)
+    basis = run_land_hru(p, pet, iamax, rzd, swmax, gwmax, areas_bol, state=state)
+    return basis
+
+
+def run_hydro_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, export='full', basis=None,
+                  routing='filter', state=None):
+    """
+    run the simulation model using land use and land cover classes as hydrologic response units
+    :param area: total area in sq km
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas or ratios for weighting
+    :param cns: list of SCS CN values computed from LULC and Soil types for each LULC classes
+    :param iaf: float
+    :param swmax: float
+    :param gwmax: float
+    :param knash: float
+    :param nnash: int
+    :param basis: HRU response basis dict (from get_hru_basis) to skip the land phase
+    :param routing: routing engine (see route_nash)
+    :param state: hydrology state dict at the start of the series (see get_hydro_state) to carry on a
+    previous simulation. With a basis, only the Nash cascade volumes are used (the basis holds the land phase).
+    If None, the model starts empty (cold start)
+    :return: dict of all simulation results. If state is given, it also has the 'State' at the end of the series
+    (the baseflow smoothing does not carry over: Qb may differ from a continuous run within 4 days of the ends)
+    """
+    from scipy.ndimage import gaussian_filter
 
     # areas list:
     areas = lulc
@@ -788,116 +1490,32 @@ def run_hydro_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, expo
     q = stp * 0.0
     qs = stp * 0.0
     qb = stp * 0.0
-    roff_full = stp * 0.0
-    inf_full = stp * 0.0
-    gw_full = stp * 0.0
-    ev_full = stp * 0.0
-    tp_full = stp * 0.0
-    et_full = stp * 0.0
-    #
-    # HRU flow variables list of arrays:
-    inf = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    ev = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    tp = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    et = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    gw = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    roff = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    # generate HRU stock variables arrays
-    sfw = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    sw = [stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0, stp * 0.0]
-    sfw_avg = stp * 0.0
-    sw_avg = stp * 0.0
     rzd_avg = np.sum(rzd * areasf) + stp * 0.0
     iamax_avg = np.sum(iamax * areasf) + stp * 0.0
     swmax_avg = np.sum(swmax * areasf) + stp * 0.0
     cn_avg = np.sum(np.array(cns) * areasf) + stp * 0.0
     #
-    # nash cascade array
-    vnash = np.zeros((len(stp), int(nnash)))
-    #
-    #
-    # HRU loop:
-    hru_lbl = ['urban', 'water', 'forest', 'pasture', 'crops', 'nbsf', 'nbsp', 'nbsc']
-    for u in range(0, len(hru_lbl)):
-        # print('\nHRU:' + hru_lbl[u], end=' Index: ')
-        # print(u)
-        # reset aux arrays:
-        sfw1 = stp * 0.0
-        sfw2 = stp * 0.0
-        sw1 = stp * 0.0
-        sw2 = stp * 0.0
-        pet1 = stp * 0.0
-        pet2 = stp * 0.0
-        pet3 = stp * 0.0
-        pia = stp * 0.0
-        pinf = stp * 0.0
-        ptp = stp * 0.0
-        #
-        # land phase loop for each HRU:
-        for t in range(1, len(stp)):
-            t0 = t - 1
-            pu = p[t0] * areas_bol[u]
-            # print()
-            # print('P: {}'.format(pu))
-            # surface water balance:
-            #
-            # first, discount runoff:
-            pia[t0] = iamax[u] - sfw[u][t0]  # available stock in surface
-            roff[u][t0] = find_roff(pia[t0], pu)
-            sfw1[t0] = sfw[u][t0] + pu - roff[u][t0]
-            # print('IAmax: {:.2f}\tPIA: {:.2f}'.format(iamax[u], pia[t0]))
-            # print('Runoff: {:.2f}'.format(roff[u][t0]))
-            # print('Sfw1: {:.2f}'.format(sfw1[t0]))
-
-            # second, discount infiltration:
-            pinf[t0] = swmax - sw[u][t0]  # available stock in subsoil
-            inf[u][t0] = find_inf(pinf[t0], sfw1[t0])
-            sfw2[t0] = sfw1[t0] - inf[u][t0]
-            # print('SWmax: {:.2f}\tSW: {:.2f}\tPinf: {:.2f}'.format(swmax, sw[u][t0], pinf[t0]))
-            # print('Inf: {:.2f}'.format(inf[u][t0]))
-            # print('Sfw2: {:.2f}'.format(sfw2[t0]))
-
-            # last, discount evaporation:
-            pet1[t0] = pet[t0]  # available stock in atmosphere
-            ev[u][t0] = find_ev(pet1[t0], sfw2[t0])
-            pet2[t0] = pet1[t0] - ev[u][t0]  # remaining available stock in atmosphere
-            # print('PET1: {:.2f}'.format(pet1[t0]))
-            # print('EV: {:.2f}'.format(ev[u][t0]))
-            # print('PET2: {:.2f}'.format(pet2[t0]))
-            #
-            # update surface water stock
-            sfw[u][t] = sfw2[t0] - ev[u][t0]
-            # print('Sfw: {:.2f}'.format(sfw[u][t]))
-            #
-            # subsurface water balance
-            #
-            # first include infiltration
-            sw1[t0] = sw[u][t0] + inf[u][t0]
-            # second, discount transpiration
-            ptp[t0] = find_ptp(sw1[t0], swmax, rzd[u])
-            tp[u][t0] = find_tp(pet2[t0], ptp[t0])
-            sw2[t0] = sw1[t0] - tp[u][t0]
-            pet3[t0] = pet2[t0] - tp[u][t0]  # remaining available stock in atmosphere
-            et[u][t0] = ev[u][t0] + tp[u][t0]  # real ET
-            # last, discount growndwater flow
-            gw[u][t0] = find_gw(gwmax, swmax, sw2[t0])
-            #
-            # update sw:
-            sw[u][t] = sw2[t0] - gw[u][t0]
-            #print('{}\t\t{}\t\t{}'.format(p[t0], sfw[u][t0], sw[u][t0]))
-        #
-        # print(roff[u])
+    # land phase (only runoff and groundwater flow are needed for the stream flow):
+    outputs = ('Roff', 'Gw')
+    if export == 'full':
+        outputs = ('Roff', 'Inf', 'Ev', 'Tp', 'ET', 'Gw', 'Sfw', 'Sw')
+    if basis is None:
+        land = run_land_hru(p, pet, iamax, rzd, swmax, gwmax, areas_bol, outputs=outputs, state=state)
+    else:
+        # HRUs with no area get no precipitation, so their land phase is null:
+        land = dict()
+        for k in outputs:
+            land[k] = [basis[k][u] if areas_bol[u] else basis[k][u] * 0.0 for u in range(len(basis[k]))]
     #
     # Aggregate off-land flow variables:
-    for u in range(len(hru_lbl)):
-        roff_full = roff_full + roff[u] * areasf[u]
-        inf_full = inf_full + inf[u] * areasf[u]
-        ev_full = ev_full + ev[u] * areasf[u]
-        tp_full = tp_full + tp[u] * areasf[u]
-        et_full = et_full + et[u] * areasf[u]
-        gw_full = gw_full + gw[u] * areasf[u]
-        sfw_avg = sfw_avg + sfw[u] * areasf[u]
-        sw_avg = sw_avg + sw[u] * areasf[u]
+    hru_lbl = ['urban', 'water', 'forest', 'pasture', 'crops', 'nbsf', 'nbsp', 'nbsc']
+    full = dict()
+    for k in outputs:
+        full[k] = stp * 0.0
+        for u in range(len(hru_lbl)):
+            full[k] = full[k] + land[k][u] * areasf[u]
+    roff_full = full['Roff']
+    gw_full = full['Gw']
     #
     #
     # apply gaussian filter to smooth baseflow:
@@ -906,23 +1524,10 @@ def run_hydro_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, expo
     # Channel transport phase:
     # convert runoff to volume:
     vroff = roff_full * area * 1000  # convert to volume
-    for t in range(1, len(stp)):
-        t0 = t - 1
-        vin = vroff[t0]
-        # loop across Nash Cascade:
-        for v in range(0, len(vnash[t0])):
-            # validate volumes to prevent numeric overflow:
-            minvalue = 0.00001
-            if vnash[t0][v] <= minvalue:
-                vnash[t0][v] = minvalue
-            if vnash[t0][v - 1] <= minvalue:
-                vnash[t0][v - 1] = minvalue
-            if v == 0:
-                vnash[t][v] = vnash[t0][v] + vin - (vnash[t0][v] / knash)
-            else:
-                vnash[t][v] = vnash[t0][v] + (vnash[t0][v - 1] / knash) - (vnash[t0][v] / knash)
-        vout = vnash[t0][nnash - 1] / knash  # extract outflow from last bucket
-        qs[t0] = vout / 86400
+    if state is None:
+        qs = route_nash(vroff, knash, nnash, engine=routing)
+    else:
+        qs, vnash = route_nash(vroff, knash, nnash, engine=routing, state=state['Vnash'])
     #
     #
     # Sum stream flow:
@@ -930,8 +1535,17 @@ def run_hydro_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, expo
     #
     # export dictionay:
     if export == 'full':
-        out = {'Step': stp, 'P': p, 'PET': pet, 'Q': q, 'Qb': qb, 'Qs': qs, 'Sw': sw_avg, 'Sfw': sfw_avg,
-               'Ev': ev_full, 'Tp': tp_full, 'ET':et_full, 'Gw': gw_full, 'Roff': roff_full, 'Inf': inf_full,
+        roff = land['Roff']
+        inf = land['Inf']
+        ev = land['Ev']
+        tp = land['Tp']
+        et = land['ET']
+        gw = land['Gw']
+        sfw = land['Sfw']
+        sw = land['Sw']
+        out = {'Step': stp, 'P': p, 'PET': pet, 'Q': q, 'Qb': qb, 'Qs': qs, 'Sw': full['Sw'], 'Sfw': full['Sfw'],
+               'Ev': full['Ev'], 'Tp': full['Tp'], 'ET': full['ET'], 'Gw': gw_full, 'Roff': roff_full,
+               'Inf': full['Inf'],
                'Iamax': iamax_avg, 'Swmax': swmax_avg, 'Rzd': rzd_avg, 'CN': cn_avg,
                'Sfw_urban': sfw[0], 'Sfw_water':sfw[1], 'Sfw_forest':sfw[2], 'Sfw_pasture': sfw[3],
                'Sfw_crops': sfw[4], 'Sfw_nbsf': sfw[5], 'Sfw_nbsp': sfw[6], 'Sfw_nbsc': sfw[7],
@@ -952,6 +1566,125 @@ def run_hydro_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, expo
                }
     else:
         out = {'Step': stp, 'Q': q, 'Qb': qb, 'Rzd': rzd_avg, 'CN': cn_avg}
+    if state is not None:
+        out['State'] = {'Vnash': vnash}
+        if basis is None:
+            out['State'].update(land['State'])
+    return out
+
+
+def run_hydro_ens(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash, export='', basis=None,
+                  routing='filter', chunk=256, state=None):
+    """
+    run the HRU simulation model (see run_hydro_hru) for an ensemble of members in one call.
+    All HRUs of all members are advanced together along the time axis (see run_land_hru)
+    and the runoff of the members is routed as a 2d batch (see route_nash)
+    :param area: total area in sq km
+    :param p: daily time series of precipitation in mm
+    :param pet: daily time series of PET in mm
+    :param lulc: list of lulc classes areas or 2d array of lulc by member (members, HRUs)
+    :param cns: list of CN values by HRU or 2d array by member (members, HRUs)
+    :param iaf: float or array by member
+    :param swmax: float or array by member
+    :param gwmax: float or array by member
+    :param knash: float or array by member
+    :param nnash: int
+    :param export: 'full' to export also the averaged land phase variables
+    :param basis: HRU response basis dict (from get_hru_basis) to skip the land phase.
+    Members must share iaf, swmax, gwmax and CNs of the basis
+    :param routing: routing engine (see route_nash)
+    :param chunk: max number of members simulated at once (memory control)
+    :param state: hydrology state dict at the start of the series (see get_hydro_state), shared by the members
+    or with arrays by member: 'Sfw' and 'Sw' (members, HRUs) and 'Vnash' (members, nnash).
+    With a basis, only the Nash cascade volumes are used. If None, the members start empty
+    :return: dict of 2d arrays (members, days) of flows and arrays (members,) of CN and Rzd.
+    If state is given, it also has the 'State' dict of arrays by member at the end of the series
+    """
+    from scipy.ndimage import gaussian_filter1d
+
+    lulc = np.atleast_2d(np.asarray(lulc, dtype=float))
+    cns = np.atleast_2d(np.asarray(cns, dtype=float))
+    iaf = np.atleast_1d(np.asarray(iaf, dtype=float))
+    swmax = np.atleast_1d(np.asarray(swmax, dtype=float))
+    gwmax = np.atleast_1d(np.asarray(gwmax, dtype=float))
+    knash = np.atleast_1d(np.asarray(knash, dtype=float))
+    nmbr = max(len(lulc), len(cns), len(iaf), len(swmax), len(gwmax), len(knash))
+    nhru = lulc.shape[1]
+    # broadcast all members:
+    lulc = np.broadcast_to(lulc, (nmbr, nhru))
+    cns = np.broadcast_to(cns, (nmbr, nhru))
+    iaf = np.broadcast_to(iaf, (nmbr,))
+    swmax = np.broadcast_to(swmax, (nmbr,))
+    gwmax = np.broadcast_to(gwmax, (nmbr,))
+    knash = np.broadcast_to(knash, (nmbr,))
+    #
+    outputs = ('Roff', 'Gw')
+    if export == 'full':
+        outputs = ('Roff', 'Inf', 'Ev', 'Tp', 'ET', 'Gw', 'Sfw', 'Sw')
+    out = dict()
+    for k in ('Q', 'Qb', 'Qs') + outputs:
+        out[k] = np.zeros((nmbr, len(p)))
+    out['CN'] = np.zeros(nmbr)
+    out['Rzd'] = np.zeros(nmbr)
+    if state is not None:
+        # end states by member:
+        out['State'] = {'Vnash': np.zeros((nmbr, int(nnash)))}
+        vnash0 = np.broadcast_to(np.asarray(state['Vnash'], dtype=float), (nmbr, int(nnash)))
+        if basis is None:
+            out['State']['Sfw'] = np.zeros((nmbr, nhru))
+            out['State']['Sw'] = np.zeros((nmbr, nhru))
+            sfw0 = np.broadcast_to(np.asarray(state['Sfw'], dtype=float), (nmbr, nhru))
+            sw0 = np.broadcast_to(np.asarray(state['Sw'], dtype=float), (nmbr, nhru))
+    for i0 in range(0, nmbr, chunk):
+        i1 = min(i0 + chunk, nmbr)
+        areas_bol = lulc[i0:i1] > 0
+        # weighting factor array:
+        areasf = lulc[i0:i1] / np.sum(lulc[i0:i1], axis=1)[:, np.newaxis]
+        # get iamax and rzd HRU arrays (see run_hydro_hru):
+        lcl_swmax = swmax[i0:i1][:, np.newaxis]
+        iamax = iaf[i0:i1][:, np.newaxis] * ((25400 / cns[i0:i1]) - 254)
+        rzd = (iamax * (iamax <= lcl_swmax)) + (lcl_swmax * (iamax > lcl_swmax))
+        out['Rzd'][i0:i1] = np.sum(rzd * areasf, axis=1)
+        out['CN'][i0:i1] = np.sum(cns[i0:i1] * areasf, axis=1)
+        #
+        # land phase:
+        if basis is None:
+            lcl_state = None
+            if state is not None:
+                lcl_state = {'Sfw': sfw0[i0:i1].ravel(), 'Sw': sw0[i0:i1].ravel()}
+            land = run_land_hru(p, pet, iamax.ravel(), rzd.ravel(), np.repeat(swmax[i0:i1], nhru),
+                                np.repeat(gwmax[i0:i1], nhru), areas_bol.ravel(), outputs=outputs, state=lcl_state)
+            if state is not None:
+                out['State']['Sfw'][i0:i1] = land['State']['Sfw'].reshape(-1, nhru)
+                out['State']['Sw'][i0:i1] = land['State']['Sw'].reshape(-1, nhru)
+        else:
+            land = dict()
+            for k in outputs:
+                land[k] = np.array(basis[k])[np.newaxis, :, :]
+        #
+        # Aggregate off-land flow variables (HRUs with no area get no precipitation):
+        for k in outputs:
+            lcl_land = land[k].reshape(-1, nhru, len(p))
+            full = np.zeros((i1 - i0, len(p)))
+            for u in range(0, nhru):
+                lcl_u = np.where(areas_bol[:, u][:, np.newaxis], lcl_land[:, u], 0.0)
+                full = full + lcl_u * areasf[:, u][:, np.newaxis]
+            out[k][i0:i1] = full
+        #
+        # apply gaussian filter to smooth baseflow:
+        qb = out['Gw'][i0:i1] * area * 1000 / 86400  # convert to discharge
+        out['Qb'][i0:i1] = gaussian_filter1d(qb, 1, axis=-1)
+        # Channel transport phase, by groups of members of same knash:
+        vroff = out['Roff'][i0:i1] * area * 1000  # convert to volume
+        for lcl_knash in np.unique(knash[i0:i1]):
+            ids = np.flatnonzero(knash[i0:i1] == lcl_knash)
+            if state is None:
+                out['Qs'][i0 + ids] = route_nash(vroff[ids], lcl_knash, nnash, engine=routing)
+            else:
+                out['Qs'][i0 + ids], out['State']['Vnash'][i0 + ids] = route_nash(vroff[ids], lcl_knash, nnash,
+                                                                                  engine=routing,
+                                                                                  state=vnash0[i0 + ids])
+        out['Q'][i0:i1] = out['Qb'][i0:i1] + out['Qs'][i0:i1]
     return out
 
 
@@ -1020,9 +1753,13 @@ def sal_hru(area, p, pet, lulc, cns, iaf, swmax, gwmax, knash, nnash):
     series_dct = dict()
     cfc_dct = dict()
     #
+    # all scenarios are simulated at once as an ensemble:
+    ens = run_hydro_ens(area, p, pet, sal_lulcs, cns, iaf, swmax, gwmax, knash, nnash, export='full')
     for i in range(len(sal_lulcs)):
         # print(lulcf_tpl[i])
-        run = run_hydro_hru(area, p, pet, sal_lulcs[i], cns, iaf, swmax, gwmax, knash, nnash)
+        run = dict()
+        for k in ens:
+            run[k] = ens[k][i]
         lcl_cfc_q = find_cfc(run['Q'])
         lcl_cfc_qs = find_cfc(run['Qs'])
         lcl_cfc_qb = find_cfc(run['Qb'])
@@ -16,7 +16,7 @@
 import os
 import pandas as pd
 import numpy as np
-import scenarios, vizs, hydrology
+import scenarios, vizs, hydrology, dp
 from tools import save, stringsf, display
 
 
@@ -990,6 +990,7 @@ def calibrate_hydro(p0, p1, tui=False):
     curves_file = obs_dir + '/hydro_curves.txt'
     cloud_file = obs_dir + '/hydro_cloud.txt'
     metrics_file = obs_dir + '/hydro_metrics.txt'
+    log_file = obs_dir + '/hydro_calib_log.txt'
     pannel_file_name = 'hydro_pannel'
     cloud_file_name = 'hydro_cloud'
     #
@@ -1008,20 +1009,61 @@ def calibrate_hydro(p0, p1, tui=False):
     df = pd.read_csv(calib_file, sep=';')
     size = int(df.T.values[1][0])
     segf = int(df.T.values[1][1])
-    rng = ((df.T.values[1][2], df.T.values[1][3]),
-           (df.T.values[1][4], df.T.values[1][5]),
-           (df.T.values[1][6], df.T.values[1][7]),
-           (df.T.values[1][8], df.T.values[1][9]))
+    rng = ((float(df.T.values[1][2]), float(df.T.values[1][3])),
+           (float(df.T.values[1][4]), float(df.T.values[1][5])),
+           (float(df.T.values[1][6]), float(df.T.values[1][7])),
+           (float(df.T.values[1][8]), float(df.T.values[1][9])))
+    # master seed and number of worker processes (optional rows, old files have none):
+    seed = None
+    workers = None
+    if len(df) > 10:
+        seed = int(df.T.values[1][10])
+    if len(df) > 11:
+        workers = int(df.T.values[1][11])
+    # calibration engine: 'walk' (random walks hill climb) or 'de' (differential evolution),
+    # with the DE population size and number of generations (optional rows):
+    engine = 'walk'
+    pop_size = 40
+    generations = 50
+    if len(df) > 12:
+        engine = str(df.T.values[1][12]).strip().lower()
+    if len(df) > 13:
+        pop_size = int(df.T.values[1][13])
+    if len(df) > 14:
+        generations = int(df.T.values[1][14])
+    # multi-fidelity: screening sub-window in days (0 is off) and number of states promoted to the full record:
+    window = 0
+    promote = 8
+    if len(df) > 15:
+        window = int(df.T.values[1][15])
+    if len(df) > 16:
+        promote = int(df.T.values[1][16])
     #
     # get calib dict:
     '''calib, metrics, cloud, series, curves= hydrology.calib4(data['Area'], data['Qobs'], data['P'], data['PET'], data['CN'],
                                                             data['Rzdf'], data['Nnash'], size=size, ranges=rng,
                                                             segf=segf, tui=tui)'''
-
-    calib, metrics, cloud, series, curves = hydrology.calib4_hru(data['Area'], data['Qobs'], data['P'],
-                                                                 data['PET'], data['LULC'], data['CNs'],
-                                                                 data['Nnash'], size=size, ranges=rng,
-                                                                 segf=segf, tui=tui)
+    if 0 < window < len(data['Qobs']):
+        if engine == 'de':
+            engine_kw = {'pop_size': pop_size, 'generations': generations}
+        else:
+            engine_kw = {'size': size, 'segf': segf}
+        calib, metrics, cloud, series, curves = hydrology.calib_mf_hru(data['Area'], data['Qobs'], data['P'],
+                                                                       data['PET'], data['LULC'], data['CNs'],
+                                                                       data['Nnash'], ranges=rng, window=window,
+                                                                       promote=promote, engine=engine, tui=tui,
+                                                                       workers=workers, seed=seed, **engine_kw)
+    elif engine == 'de':
+        calib, metrics, cloud, series, curves = hydrology.calib_de_hru(data['Area'], data['Qobs'], data['P'],
+                                                                       data['PET'], data['LULC'], data['CNs'],
+                                                                       data['Nnash'], ranges=rng, pop_size=pop_size,
+                                                                       generations=generations, tui=tui, seed=seed,
+                                                                       workers=workers)
+    else:
+        calib, metrics, cloud, series, curves = hydrology.calib4_hru(data['Area'], data['Qobs'], data['P'],
+                                                                     data['PET'], data['LULC'], data['CNs'],
+                                                                     data['Nnash'], size=size, ranges=rng,
+                                                                     segf=segf, tui=tui, seed=seed, workers=workers)
     if tui:
         display.okinput()
         print('Storing paramters to file ...')
@@ -1052,6 +1094,18 @@ def calibrate_hydro(p0, p1, tui=False):
     # Store hydro_metrics:
     df = pd.DataFrame(metrics, index=[0])
     df.to_csv(metrics_file, sep=';')
+    if tui:
+        display.okinput()
+        print('Storing calibration log to file ...')
+    #
+    # Store hydro_calib_log (engine extras of the calib dict, as available). The seed is the effective
+    # master seed, taken from the clock when the calibration file has no seed row:
+    log_keys = ('Seed', 'Cache hits', 'Model runs', 'Generations', 'Window', 'Screen metric', 'Screen runs',
+                'Screen cache hits', 'Screen generations')
+    log_names = ['Engine'] + [k for k in log_keys if k in calib]
+    log_values = [engine] + [calib[k] for k in log_keys if k in calib]
+    df = pd.DataFrame({'Parameter':log_names, 'Value':log_values})
+    df.to_csv(log_file, sep=';', index=False)
     if tui:
         display.okinput()
         print('Storing calibration cloud to file ...')
@@ -1183,18 +1237,58 @@ def load_dp_data(p0, p1):
     return r_dct
 
 
+def load_dp_ensemble(p0, p1, size=10, seed=None):
+    """
+    generate the climate ensemble of a scenario (see scenarios.climate_ensemble and dp.run_ens_dp)
+    :param p0: observed datasets dir
+    :param p1: scenario dir
+    :param size: number of members
+    :param seed: ensemble random seed
+    :return: dictionary of the climate ensemble
+    """
+    scn_dct = get_scenario_dct(p1 + '/specs.txt')
+    obs_file = p0 + '/' + get_scn_import_files_dct()['PPet'] + '.txt'
+    ens_dct = scenarios.climate_ensemble(scn_dct['Years'], scn_dct['PPet'], obs_file, get_scenario_types_dct()['PPet'],
+                                         size=size, seed=seed)
+    return ens_dct
+
+
 def create_dp_rundir(run_bin, runlbl='', run_ts='000000'):
     aux_str = run_bin + '/' + 'DP_' + runlbl + '_' + run_ts
     dp_rundir = save.create_new_dir(aux_str, p2=False)
     return dp_rundir
 
 
+def list_dp_store_rundirs(run_bin):
+    """
+    DP run directories with a stage hydrology store (see dp.run_dp store argument)
+    :param run_bin: runbin dir
+    :return: list of run directory names
+    """
+    def_lst = list()
+    for def_e in sorted(os.listdir(run_bin)):
+        if def_e.startswith('DP_') and os.path.isfile(run_bin + '/' + def_e + '/DP-hydro_stage1.pkl'):
+            def_lst.append(def_e)
+    return def_lst
+
+
 def export_dp_report(dplogs, rundir, run_ts='000000'):
+    """
+    export the DP report file
+    :param dplogs: DP logs tuple (header, parameters, output, policy, structured log). The last
+    is the DP structured log (file name or list of events) and is rendered here (see dp.render_dp_log)
+    :param rundir: run directory
+    :param run_ts: run timestamp string
+    :return: report file name
+    """
     report_flnm = rundir + '/DP-report_'+ run_ts
     report_file = save.create_new_file(report_flnm)
-    for i in range(0, len(dplogs)):
-        for line in dplogs[i]:
-            save.appendtext(report_file, line)
+    with open(report_file, 'a+') as fle:
+        for i in range(0, len(dplogs) - 1):
+            for line in dplogs[i]:
+                fle.write(line + '\n')
+        for line in dp.render_dp_log(dplogs[-1]):
+            fle.write(line + '\n')
     return report_file
 
 
@@ -1212,6 +1306,32 @@ def export_dp_cloud(out_dct, rundir, run_ts='000000'):
     return report_flnm
 
 
+def export_dp_ensemble(members_df, rundir, run_ts='000000'):
+    """
+    export the climate ensemble DP members table file (see dp.run_ens_dp)
+    :param members_df: members table dataframe
+    :param rundir: run directory
+    :param run_ts: run timestamp string
+    :return: members file name
+    """
+    report_flnm = rundir + '/DP-ensemble_' + run_ts + '.txt'
+    members_df.to_csv(report_flnm, sep=';', index=False)
+    return report_flnm
+
+
+def export_dp_sweep(sweep_df, rundir, run_ts='000000'):
+    """
+    export the DP sweep table file (see dp.sweep_dp)
+    :param sweep_df: sweep table dataframe
+    :param rundir: run directory
+    :param run_ts: run timestamp string
+    :return: sweep file name
+    """
+    report_flnm = rundir + '/DP-sweep_' + run_ts + '.txt'
+    sweep_df.to_csv(report_flnm, sep=';', index=False)
+    return report_flnm
+
+
 def create_hydrosim_rundir(run_bin, runlbl='', run_ts='000000'):
     aux_str = run_bin + '/' + 'HYSIM_' + runlbl + '_' + run_ts
     hy_rundir = save.create_new_dir(aux_str, p2=False)
@@ -1251,8 +1371,8 @@ def run_hydro_sim(p0, p1='', p2=False):
                               data['Iaf'], data['Swmax'], data['Gwmax'], data['Knash'], data['Nnash'], export='full')
     #
     # find q90:
+    q90 = hydrology.find_exeed_flow(q['Q'], 90)
     cfc = hydrology.find_cfc(q['Q'])
-    q90 = cfc[1][10]
     curves = {'CFC': cfc[1][1:], 'Exeed': cfc[0][1:]}
     #
     hydro_p = {'Area': data['Area'], 'CN': data['CN'], 'Rzdf': q['Rzd'][0], 'iaf': data['Iaf'], 'swmax': data['Swmax'],
@@ -288,15 +288,20 @@ def get_r2_log(xobs, yobs):
     return r2
 
 
-def climate(p1, p2, p4, p5):
+def climate(p1, p2, p4, p5, seed=None):
     """
 
     :param p1: projection years tuple
     :param p2: scenario type key
     :param p4: observed data file path
     :param p5: tuple of scenarios options
+    :param seed: random seed of the realization (the global numpy random state is used if None)
     :return:
     """
+    # random generator of the realization:
+    rng = np.random
+    if seed is not None:
+        rng = np.random.RandomState(seed)
     # load observed data:
     def_import_file = p4
     # print('load observed data from {}'.format(def_import_file))
@@ -327,17 +332,17 @@ def climate(p1, p2, p4, p5):
     # find which type of projection is:
     if def_key == 'Stat':
         # create array of wet index:
-        wetid_prj_percnt = np.random.uniform(1, 99, size=p1[-1] - p1[0])
+        wetid_prj_percnt = rng.uniform(1, 99, size=p1[-1] - p1[0])
         # wetid_prj_percnt = np.random.normal(50, 20, size=p1[-1] - p1[0])
     elif def_key == 'Dry':
         # create array of wet index:
-        wetid_prj_percnt = np.random.uniform(20, 30, size=p1[-1] - p1[0])
+        wetid_prj_percnt = rng.uniform(20, 30, size=p1[-1] - p1[0])
     elif def_key == 'DryX':
         # create array of wet index:
-        wetid_prj_percnt = np.random.uniform(5, 15, size=p1[-1] - p1[0])
+        wetid_prj_percnt = rng.uniform(5, 15, size=p1[-1] - p1[0])
     elif def_key == 'DryXX':
         # create array of wet index:
-        wetid_prj_percnt = np.random.uniform(1, 5, size=p1[-1] - p1[0])
+        wetid_prj_percnt = rng.uniform(1, 5, size=p1[-1] - p1[0])
     elif def_key == 'ToDryX':
         # create array of wet index:
         wetid_prj_percnt = np.linspace(35, 5, p1[-1] - p1[0])
@@ -352,7 +357,7 @@ def climate(p1, p2, p4, p5):
         wetid_prj_percnt = np.linspace(65, 95, p1[-1] - p1[0])
     elif def_key == 'WetXX':
         # create array of wet index:
-        wetid_prj_percnt = np.random.uniform(94, 99, size=p1[-1] - p1[0])
+        wetid_prj_percnt = rng.uniform(94, 99, size=p1[-1] - p1[0])
     # print(wetid_prj_percnt)
     # print(len(wetid_prj_percnt))
     #
@@ -388,6 +393,29 @@ def climate(p1, p2, p4, p5):
     return return_dct
 
 
+def climate_ensemble(p1, p2, p4, p5, size=10, seed=None):
+    """
+    generate an ensemble of seeded climate realizations (see climate)
+    :param p1: projection years tuple
+    :param p2: scenario type key
+    :param p4: observed data file path
+    :param p5: tuple of scenarios options
+    :param size: number of members
+    :param seed: ensemble random seed. Member seeds are spawned from it, so the ensemble is reproducible
+    :return: dict of projection dates, P and PET arrays (members, days) and member seeds
+    """
+    seeds = [child.generate_state(1)[0] for child in np.random.SeedSequence(seed).spawn(size)]
+    p_ens = list()
+    pet_ens = list()
+    for member_seed in seeds:
+        lcl_dct = climate(p1, p2, p4, p5, seed=member_seed)
+        p_ens.append(lcl_dct['P_prj'])
+        pet_ens.append(lcl_dct['PET_prj'])
+    return_dct = {'Dts_prj': lcl_dct['Dts_prj'], 'P_prj': np.array(p_ens), 'PET_prj': np.array(pet_ens),
+                  'Seeds': tuple(int(member_seed) for member_seed in seeds)}
+    return return_dct
+
+
 def yearly_variable(p1, p2, p4, p5):
     """
 
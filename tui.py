@@ -17,7 +17,7 @@ import pandas as pd
 import plans2
 from vizs import viz_dp_pannel, viz_hydro_sim, viz_hydro_hru_sim, viz_hydro_sal_cfcs
 from tools import display, validate, stringsf, load, mytools, save
-from dp import run_dp, run_sim, set_dp
+from dp import run_dp, run_sim, sim_policy, set_dp, recost_dp
 
 
 def header_warp():
@@ -330,19 +330,21 @@ def tui_dp_res_picker():
     return dp_res
 
 
-def tui_dp_run(p0, p1, p2, p3):
+def tui_dp_run(p0, p1, p2, p3, p4=None):
     """
     Void function. Run DP protocol.
     :param p0: scenario dir
     :param p1: obs datasets dir
     :param p2: runbin dir
     :param p3: dp res
+    :param p4: run dir of a stored DP run to re-cost with the scenario economic data (None runs a new DP)
     :return: none
     """
     scn_dir = p0
     obs_dir = p1
     runbin_dir = p2
     dp_res = p3
+    store_dir = p4
     scn_nm = scn_dir.split('/')[-1]
     display.waiting(p1='loading DP data', p4=3)
     # get data
@@ -357,12 +359,25 @@ def tui_dp_run(p0, p1, p2, p3):
     settings = set_dp(prj_yr1, prj_yrs_stp, len(prj_yrs), dp_res)
     # run
     display.okinput()
+    # the stage hydrology store is large (flow series of every LULC), so it is kept only on demand:
+    store = False
+    if store_dir is None:
+        ans = validate.string_ans(p2='Keep the stage hydrology for re-cost runs? It takes a lot of disk space')
+        store = ans == 'Y'
     validate.permission_protocol('Can we run? It may take a while!')
-    # pol = ((0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0))
-    dp_output, dp_logs, run_ts, run_cloud = run_dp(setts=settings, data=dp_data, prt_sts=True)
+    # create dp run directory (stage checkpoints and the hydrology store are saved in it):
+    run_ts = stringsf.nowsep()
+    if store_dir is None:
+        rundir = plans2.create_dp_rundir(runbin_dir, scn_nm, run_ts)
+        # pol = ((0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0))
+        dp_output, dp_logs, run_ts, run_cloud = run_dp(setts=settings, data=dp_data, prt_sts=True, rundir=rundir,
+                                                       run_ts=run_ts, store=store)
+    else:
+        # re-cost mode: the stage hydrology comes from the stored run:
+        rundir = plans2.create_dp_rundir(runbin_dir, '_RECOST_' + scn_nm, run_ts)
+        dp_output, dp_logs, run_ts, run_cloud = recost_dp(setts=settings, data=dp_data, store_dir=store_dir,
+                                                          prt_sts=True, rundir=rundir, run_ts=run_ts)
     display.okinput()
-    # create dp run directory:
-    rundir = plans2.create_dp_rundir(runbin_dir, scn_nm, run_ts)
     # export dp report file:
     report_file = plans2.export_dp_report(dp_logs, rundir, run_ts)
     print('\nReport file sucessfully exported to: {}'.format(report_file))
@@ -407,7 +422,8 @@ def tui_dp_sim(p0, p1, p2, p3, p4):
     # run
     display.okinput()
     validate.permission_protocol('Can we run? It may take a while!')
-    dp_output, dp_logs, run_ts, run_cloud = run_sim(setts=settings, data=dp_data, pol=p4, sim=True, prt_sts=True)
+    # only the policy decision sets are simulated:
+    dp_output, dp_logs, run_ts, run_cloud = sim_policy(setts=settings, data=dp_data, pol=p4, prt_sts=True)
     display.okinput()
     # create dp run directory:
     rundir = plans2.create_dp_rundir(runbin_dir, '_SIM_' + scn_nm, run_ts)
@@ -687,7 +703,14 @@ def main():
                             print('Single scenario run protocol')
                             print('Scenario dir: {}'.format(scn_dir))
                             # needed param : scn dir, obs_dir, runbin_dir,
-                            tui_dp_run(scn_dir, observed_dir, runbin_dir, dp_res)
+                            # re-cost a stored run with the scenario economic data (the stage hydrology is reused):
+                            store_dir = None
+                            store_lst = plans2.list_dp_store_rundirs(runbin_dir)
+                            if len(store_lst) > 0:
+                                ans = validate.string_ans(p2='Re-cost a stored DP run?')
+                                if ans == 'Y':
+                                    store_dir = runbin_dir + '/' + validate.string_menu(store_lst, 'Stored DP runs')
+                            tui_dp_run(scn_dir, observed_dir, runbin_dir, dp_res, store_dir)
                     else:
                         display.wrnginput('No scenarios was found.')
                         print('>> Go to Scenario Setup to set a scenario.')